@@ -0,0 +1,32 @@
+#!/bin/python3
+"""
+Summary table of the csv/<bms_id>/ logs: cell voltage spread, temperatures, error flags and
+SOC against coulomb SOC, per battery and per session (file).
+
+    python analyze_logs.py csv [--output summary.csv] [--processes 8] [--batteries-only]
+"""
+import logging
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from common.log_analysis import analyze_tree, write_summary
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Analyze csv logs")
+    parser.add_argument("csv", type=Path, help="csv folder")
+    parser.add_argument("--output", type=Path, help="summary csv file, stdout when not given")
+    parser.add_argument("--processes", type=int, help="parser processes, cpu count when not given")
+    parser.add_argument("--batteries-only", action="store_true", help="no per session rows")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    start = perf_counter()
+    rows = analyze_tree(args.csv, args.processes, not args.batteries_only)
+    if args.output is None:
+        write_summary(rows, sys.stdout)
+    else:
+        with open(args.output, "w") as output:
+            write_summary(rows, output)
+    logging.info(f"{len(rows)} rows in {perf_counter() - start:.1f} s")
@@ -0,0 +1,215 @@
+#!/bin/python3
+"""
+Frames decoded per second: the old if/elif chain with resize_bytes and format string unpack
+against the compiled register codec.
+
+    python benchmark_register_codec.py [frame count]
+"""
+import logging
+import sys
+from struct import unpack
+from time import perf_counter
+
+from common.bmsinfo import BmsInfo
+from common.data_handling import BMS_REGISTERS
+from common.helper import conv, resize_bytes
+
+logger = logging.getLogger('bms-data')
+logger.setLevel("ERROR")
+
+# typical poll pass of a foldy battery
+FRAMES = [
+    (0xc0, bytes.fromhex("0201003c12345678")),
+    (0xc1, bytes.fromhex("191a1b1c9c40ff38")),
+    (0xc3, bytes.fromhex("01002a5f0fa00010")),
+    (0xc5, bytes.fromhex("0100ff00640000")),
+    (0xd1, bytes.fromhex("0e740e750e760e77")),
+    (0xd2, bytes.fromhex("0e780e790e7a0e7b")),
+    (0xd3, bytes.fromhex("0e7c0e7d0e7e0e7f")),
+    (0xd4, bytes.fromhex("0e790e740e7f010c")),
+    (0xc6, bytes.fromhex("191a1b1c")),
+    (0xc9, bytes.fromhex("10680bb8")),
+    (0xc2, bytes.fromhex("00000000000000c2")),
+]
+
+
+# [START legacy decoding, as it was before the register codec]
+def log_debug(bms, msg: str, log_level=logger.debug):
+    log_level(msg)
+
+
+def legacy_c0(bms, data):
+    data = resize_bytes(data, 8)
+    bms.pack_state, bms.attach_status, bms.error_flags, bms.pack_soc, bms.bms_id_int = unpack(">BBBBI", data)
+    bms.bms_id = f"{bms.bms_id_int:08x}"
+    log_debug(bms, f"bms_id: {bms.bms_id}")
+    log_debug(bms, f"pack_soc: {bms.pack_soc}")
+    log_debug(bms, f"pack_state: {bms.pack_state}")
+    log_debug(bms, f"attach_status: {bms.attach_status}")
+    log_debug(bms, f"error_flags: {bms.error_flags}")
+
+
+def legacy_c1(bms, data):
+    data = resize_bytes(data, 8)
+    bms.fet_temp, bms.pack_left_temp, bms.pack_center_temp, bms.pack_right_temp, bms.voltage, bms.current = unpack(">bbbbHh", data)
+    log_debug(bms, f"fet_temp: {bms.fet_temp}")
+    log_debug(bms, f"pack_left_temp: {bms.pack_left_temp}")
+    log_debug(bms, f"pack_center_temp: {bms.pack_center_temp}")
+    log_debug(bms, f"pack_right_temp: {bms.pack_right_temp}")
+    log_debug(bms, f"voltage: {bms.voltage}")
+    log_debug(bms, f"current: {bms.current}")
+
+
+def legacy_c2(bms, data):
+    data = resize_bytes(data, 8)
+    bms.bq_sys_stat = conv(data, 7)
+    log_debug(bms, f"bq_sys_stat: {bms.bq_sys_stat}")
+
+
+def legacy_c3(bms, data):
+    data = resize_bytes(data, 8)
+    bms.precharge_result, bms.cycle_count, bms.coulomb_soc, bms.available_capacity, bms.collected_regen = unpack(">BHBhH", data)
+    log_debug(bms, f"precharge_result: {bms.precharge_result}")
+    log_debug(bms, f"cycle_count: {bms.cycle_count}")
+    log_debug(bms, f"coulomb_soc: {bms.coulomb_soc}")
+    log_debug(bms, f"available_capacity: {bms.available_capacity}")
+    log_debug(bms, f"collected_regen: {bms.collected_regen}")
+
+
+def legacy_c5(bms, data):
+    length = len(data)
+    if 8 == length:
+        bms.balance_state, bms.balance_pattern, bms.cap_sense_fill_time, bms.bms_unread_error_count, bms.bq_sys_stat = unpack(">BHHHB", data)
+        log_debug(bms, f"bq_sys_stat: {bms.bq_sys_stat}")
+        log_debug(bms, f"cap_sense_fill_time: {bms.cap_sense_fill_time}")
+        log_debug(bms, f"bms_unread_error_count: {bms.bms_unread_error_count}")
+    elif 7 == length:
+        bms.balance_state, bms.balance_pattern, bms.cap_sense_fill_time, bms.bms_unread_error_count = unpack(">BHHH", data)
+        log_debug(bms, f"cap_sense_fill_time: {bms.cap_sense_fill_time}")
+        log_debug(bms, f"bms_unread_error_count: {bms.bms_unread_error_count}")
+    log_debug(bms, f"balance_state: {bms.balance_state}")
+    log_debug(bms, f"balance_pattern: {bms.balance_pattern}")
+
+
+def legacy_c6(bms, data):
+    data = resize_bytes(data, 4)
+    bms.temp_ts_1, bms.temp_ts_2, bms.temp_ts_3, bms.temp_usb = unpack(">bbbb", data)
+    log_debug(bms, f"temp_usb: {bms.temp_usb}")
+    log_debug(bms, f"temp_ts_1: {bms.temp_ts_1}")
+    log_debug(bms, f"temp_ts_2: {bms.temp_ts_2}")
+    log_debug(bms, f"temp_ts_3: {bms.temp_ts_3}")
+
+
+def legacy_c9(bms, data):
+    data = resize_bytes(data, 4)
+    bms.overvoltage_limit, bms.undervoltage_limit = unpack(">HH", data)
+    log_debug(bms, f"overvoltage_limit: {bms.overvoltage_limit}")
+    log_debug(bms, f"undervoltage_limit: {bms.undervoltage_limit}")
+
+
+def legacy_d4(bms, data):
+    data = resize_bytes(data, 8)
+    bms.cell_voltage_avg, bms.cell_voltage_lowest, bms.cell_voltage_highest, bms.min_cell_no, bms.max_cell_no = unpack(">HHHBB", data)
+    log_debug(bms, f"cell_voltage_avg: {bms.cell_voltage_avg}")
+    log_debug(bms, f"cell_voltage_lowest: {bms.cell_voltage_lowest}")
+    log_debug(bms, f"cell_voltage_highest: {bms.cell_voltage_highest}")
+    log_debug(bms, f"min_cell_no: {bms.min_cell_no}")
+    log_debug(bms, f"max_cell_no: {bms.max_cell_no}")
+
+
+def legacy_d_cell(bms, data, off=0):
+    r0, r1, r2, r3 = unpack(">HHHH", data)
+    v = bms.cell_voltages
+    v[0+off] = r0
+    v[1+off] = r1
+    v[2+off] = r2
+    v[3+off] = r3
+    log_debug(bms, f"cell_{off+1}_voltage: {r0}")
+    log_debug(bms, f"cell_{off+2}_voltage: {r1}")
+    log_debug(bms, f"cell_{off+3}_voltage: {r2}")
+    log_debug(bms, f"cell_{off+4}_voltage: {r3}")
+
+
+def legacy_update_reg(reg_id, data, bms):
+    logger.debug(f"update_reg: {reg_id:04x}")
+    reg_nr = reg_id & 0xFF
+    if reg_nr == 0xc0:
+        legacy_c0(bms, data)
+    elif reg_nr == 0xc1:
+        legacy_c1(bms, data)
+    elif reg_nr == 0xc3:
+        legacy_c3(bms, data)
+    elif reg_nr == 0xc5:
+        legacy_c5(bms, data)
+    elif reg_nr == 0xc6:
+        legacy_c6(bms, data)
+    elif reg_nr == 0xd4:
+        legacy_d4(bms, data)
+    elif reg_nr == 0xff:
+        pass
+    elif reg_nr == 0xfe:
+        pass
+    elif reg_nr == 0xfc:
+        pass
+    elif reg_nr == 0xc2:
+        legacy_c2(bms, data)
+    elif reg_nr == 0xd1:
+        legacy_d_cell(bms, data)
+        bms.calculate_cells()
+    elif reg_nr == 0xd2:
+        legacy_d_cell(bms, data, 4)
+        bms.calculate_cells()
+    elif reg_nr == 0xd3:
+        legacy_d_cell(bms, data, 8)
+        bms.calculate_cells()
+        log_debug(bms, f"cell_voltage_avg: {bms.cell_voltage_avg}")
+        log_debug(bms, f"cell_voltage_lowest: {bms.cell_voltage_lowest}")
+        log_debug(bms, f"cell_voltage_highest: {bms.cell_voltage_highest}")
+        log_debug(bms, f"min_cell_no: {bms.min_cell_no}")
+        log_debug(bms, f"max_cell_no: {bms.max_cell_no}")
+    elif reg_nr == 0xca:
+        pass
+    elif reg_nr == 0xcc:
+        pass
+    elif reg_nr == 0xc8:
+        pass
+    elif reg_nr == 0xc9:
+        legacy_c9(bms, data)
+# [END legacy decoding]
+
+
+def codec_update_reg(reg_id, data, bms):
+    BMS_REGISTERS.decode(reg_id & 0xFF, bms, data)
+
+
+def fields(bms):
+    # the cell arrays as tuples, like in a snapshot
+    snapshot = bms.snapshot()
+    return {k: getattr(snapshot, k) for k in BmsInfo.__slots__ if k not in ("timestamp", "last_snapshot")}
+
+
+def run(decode, frame_count):
+    bms = BmsInfo(1)
+    frames = (FRAMES * (frame_count // len(FRAMES) + 1))[:frame_count]
+    start = perf_counter()
+    for reg_id, data in frames:
+        decode(0x200 | reg_id, data, bms)
+    return frame_count / (perf_counter() - start), bms
+
+
+def main():
+    frame_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    legacy_rate, legacy_bms = run(legacy_update_reg, frame_count)
+    codec_rate, codec_bms = run(codec_update_reg, frame_count)
+
+    if fields(legacy_bms) != fields(codec_bms):
+        print("decoded values differ!")
+        sys.exit(1)
+
+    print(f"legacy: {legacy_rate:12,.0f} frames/s")
+    print(f"codec:  {codec_rate:12,.0f} frames/s ({codec_rate / legacy_rate:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
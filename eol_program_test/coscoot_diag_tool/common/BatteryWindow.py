@@ -1,19 +1,18 @@
 #!/usr/bin/env python
 import json
 from pprint import pprint
-from time import time, sleep
+from time import time, sleep, monotonic
 from argparse import ArgumentParser
-from binascii import hexlify
-from copy import deepcopy
+from copy import copy
 from datetime import datetime, timezone
 from math import floor
 from pathlib import Path
 from queue import Empty
 from struct import pack
 
-from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QMainWindow
-from can import CanError
+from PyQt5.QtGui import QIcon, QKeySequence
+from PyQt5.QtWidgets import QMainWindow, QShortcut
+from can import Message
 from requests import get
 
 
@@ -26,7 +25,21 @@ import threading
 from PyQt5.QtCore import pyqtSignal
 
 from .bms_id_dialog_ui import Ui_bmsid_update_dialog
-from .bmsinfo import BmsInfo
+from .bmsinfo import BmsInfo, to_text
+from .alarms import AlarmEngine, Severity, bms_rules
+from .cells import MAX_CELLS, group_count
+from .csv_writer import CsvWriter
+from .fw_sessions import session_manager
+from .session_log import SessionLogWriter
+from .ring_history import RingHistory
+from .plot_widget import plot_window
+from .history_store import HistoryStore
+from .ui_binding import BindingSet
+from .can_dispatcher import MASK_EXACT
+from .poller import PipelinedPoller, PollSchedule, ScheduledPoll
+from .pycan import can_filter
+from .can_tx import PRIORITY_POLL
+from .tracing import log_fields
 
 from .usbinfo import USB_Info
 
@@ -55,6 +68,22 @@ stylesheet_display_error = stylesheet_display_red
 stylesheet_display_warn = stylesheet_display_yellow
 
 BATTERY_DATA_TIMEOUT = 3
+UI_UPDATE_PERIOD = 0.1
+
+# register: (poll period in seconds or None for once per connection, priority)
+REGISTER_POLL_RATES = {
+    0xc1: (0.1, 0),  # voltage, current, temperatures
+    0xc0: (0.5, 1),  # state, errors, soc
+    0xd1: (0.5, 1),  # cell voltages
+    0xd2: (0.5, 1),
+    0xd3: (0.5, 1),
+    0xc2: (1.0, 2),  # last register of a CSV row
+    0xfe: (1.0, 3),  # unix time, polled only with timesync
+    0xff: (None, 3),  # pack info
+    0xfc: (None, 3),  # pcb and fw types
+    0xc9: (None, 3),  # voltage limits, re-read after a write from the dialog
+}
+DEFAULT_POLL_RATE = (1.0, 2)
 
 
 logger = logging.getLogger('main')
@@ -97,47 +126,6 @@ def is_semver_new(cur, new):
     return res
 
 
-def calc_cell_percent(bms, cell):
-    res = 0
-    cell_voltage = bms.cell_voltages[cell]
-    if cell_voltage != "" and bms.cell_voltage_highest != "" and bms.cell_voltage_lowest != "":
-        # lowest = bms.cell_voltage_lowest
-        lowest = 3250
-        if bms.cell_voltage_lowest < lowest:
-            lowest = bms.cell_voltage_lowest
-
-        highest = 4000
-        if bms.cell_voltage_highest > highest:
-            highest = bms.cell_voltage_highest
-
-        res = (cell_voltage - lowest) / (highest - lowest) * 100
-
-    return res
-
-
-def calc_avg_temperature(bms):
-    if bms.bms_id_int == 0:
-        return 0
-
-    temperatures = [bms.pack_left_temp, bms.pack_right_temp, bms.pack_center_temp]
-
-    if bms.hw_type == 1 or bms.hw_type == 2:
-        temperatures.append(bms.temp_ts_1)
-        temperatures.append(bms.temp_ts_2)
-        temperatures.append(bms.temp_ts_3)
-
-    temperatures.sort()
-
-    temperatures.pop(0)
-    temperatures.pop(-1)
-
-    avg_temp = temperatures[0]
-    arr_len = len(temperatures)
-    if arr_len > 1:
-        avg_temp = sum(temperatures) / arr_len
-    return avg_temp
-
-
 def ui_pack_state(bms: BmsInfo):
     state_text = "N/A"
     if bms.pack_state == 0:
@@ -169,6 +157,166 @@ def ui_attach_status(bms: BmsInfo):
 
 
 
+# display stylesheets of the alarm severities
+ALARM_STYLESHEETS = {None: stylesheet_display_none,
+                     Severity.INFO: stylesheet_display_blue,
+                     Severity.WARNING: stylesheet_display_yellow,
+                     Severity.ERROR: stylesheet_display_red}
+
+
+def ui_bms_error_state(bms: BmsInfo):
+    if bms.error_flags is None:
+        return "N/A"
+
+    bms_error_state_text = f"{bms.error_flags}"
+    errors = []
+
+    if bms.error_flags & 1:
+        errors.append("Initial config")
+
+    if bms.error_flags & 2:
+        errors.append("REQUEST OFF")
+
+    if bms.error_flags & 4:
+        errors.append("BQ STATUS")
+        if bms.bq_sys_stat is None:
+            errors.append(f"BQ: N/A")
+        else:
+            errors.append(f"BQ: {bms.bq_sys_stat}")
+
+            if bms.bq_sys_stat & 1:
+                errors.append("BQ1: Overcurrent")
+
+            if bms.bq_sys_stat & 2:
+                errors.append("BQ2: Short-circuit")
+
+            if bms.bq_sys_stat & 4:
+                errors.append("BQ4: Overvoltage")
+
+            if bms.bq_sys_stat & 8:
+                errors.append("BQ8: Undervoltage")
+
+    if bms.error_flags & 8:
+        errors.append("PRECHARGE")
+
+    if bms.error_flags & 16:
+        errors.append("Under Voltage")
+
+    if bms.error_flags & 32:
+        errors.append("Over Voltage")
+
+    if bms.error_flags & 64:
+        errors.append("Over Current")
+
+    if bms.error_flags & 128:
+        errors.append("Over Temperature")
+
+    if len(errors):
+        errors_text = "\n".join(errors)
+        bms_error_state_text += f" ({errors_text})"
+    return bms_error_state_text
+
+
+def ui_power(bms: BmsInfo):
+    try:
+        power = (bms.voltage / 1000) * (bms.current / 1000)
+        return f"{power:.2f}"
+    except Exception:
+        return ""
+
+
+def ui_cell_diff(bms: BmsInfo):
+    """
+    Cell voltage difference, highlighted by the cell_diff alarms
+    """
+    if bms.cell_voltage_highest is None or bms.cell_voltage_lowest is None:
+        return ""
+    return f"{bms.cell_voltage_highest - bms.cell_voltage_lowest}"
+
+
+def ui_unix_time(bms: BmsInfo):
+    try:
+        time_obj = datetime.fromtimestamp(bms.unix_time, timezone.utc)
+        return f"{time_obj.strftime('%Y-%m-%d %H:%M:%S')} ({bms.time_diff:.3f})"
+    except Exception:
+        return "N/A"
+
+
+def cell_scale(bms: BmsInfo):
+    """
+    Range (lowest, highest) of the cell voltage bars
+    """
+    lowest = 0
+    highest = 4000
+    uv_limit = 3000
+    if bms.overvoltage_limit is not None and bms.overvoltage_limit != 0:
+        highest = bms.overvoltage_limit
+
+    if bms.undervoltage_limit is not None and bms.undervoltage_limit != 0:
+        uv_limit = bms.undervoltage_limit
+
+    if bms.cell_voltage_highest is not None and bms.cell_voltage_lowest is not None:
+        lowest = 3900
+
+        if bms.cell_voltage_lowest < lowest:
+            lowest = 3700
+
+        if bms.cell_voltage_lowest < lowest:
+            lowest = uv_limit
+
+        if bms.cell_voltage_lowest < uv_limit:
+            lowest = uv_limit - 200
+
+        if bms.cell_voltage_lowest < lowest:
+            lowest = 2000
+
+        if bms.cell_voltage_lowest < lowest:
+            lowest = 1000
+
+        if bms.cell_voltage_lowest < lowest:
+            lowest = 0
+
+        if bms.cell_voltage_highest > highest:
+            highest = 4040
+
+        if bms.cell_voltage_highest > highest:
+            highest = 4200
+
+        if bms.cell_voltage_highest > highest:
+            highest = 4250
+
+        if bms.cell_voltage_highest > highest:
+            highest = 4500
+
+    return lowest, highest
+
+
+def cell_stylesheet(balancing, alarm):
+    """
+    Cell bar stylesheet, alarm is set while the cell is outside the voltage limits
+    """
+    color = "#ff0000" if alarm else "#7bbd7b"
+
+    box_style = "border: 2px solid grey"
+    if balancing:
+        box_style = "border: 5px solid blue"
+
+    return (" QProgressBar { "
+            f"{box_style}; border-radius: 0px; text-align: center; "
+            "} QProgressBar::chunk {"
+            f"background-color: {color};"
+            "width: 1px;}")
+
+
+def cell_value(bms: BmsInfo, cell):
+    """
+    Bar value and text of a cell, the bars past the cell count are hidden
+    """
+    cell_voltage = bms.cell_voltages[cell] if cell < len(bms.cell_voltages) else None
+    if cell_voltage is None:
+        return 0, "N/A"
+    return cell_voltage, f"{cell + 1:02}: {cell_voltage}"
+
 
 class ValueChanged:
     def __init__(self):
@@ -197,13 +345,46 @@ class ValueChanged:
         return 0
 
 
+def session_writers(config: settings_data):
+    """
+    The session log (columnar csv/session_<date>.bmslog) and the SQLite history of all batteries,
+    None when not enabled. Only one CsvWriter of the application may own them.
+    """
+    session_log = None
+    if config.get('CSV', 'session_log', False, str2bool):
+        date_str = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+        session_log = SessionLogWriter(Path("csv") / f"session_{date_str}.bmslog",
+                                       chunk_rows=config.get('CSV', 'chunk_rows', 4096, int))
+
+    history = None
+    history_db = config.get('CSV', 'history_db', "")
+    if history_db:
+        history = HistoryStore(Path(history_db), batch_rows=config.get('CSV', 'history_batch', 500, int))
+    return session_log, history
+
+
 class CsvDataLogging:
-    def __init__(self, config: settings_data):
+    """
+    One CSV file per battery in csv/<bms_id>/, written by a CsvWriter thread.
+
+    mode "period" logs a row per second when the voltages (0xC2) are answered,
+    mode "frames" logs a row per received BMS frame with its CAN timestamp.
+    Standalone, the rows also go to the session log and the history (see session_writers),
+    embedded in the scooter window that window writes them for both batteries.
+    """
+
+    def __init__(self, config: settings_data, standalone=True):
         self.enabled = config.get('CSV', 'enabled', False, str2bool)
         self.data_period = config.get('CSV', 'data_period', 1, int)
+        self.high_rate = config.get('CSV', 'mode', "period") == "frames"
+        # the csv/<bms_id>/ files can be turned off when the history database is used
+        self.csv_files = config.get('CSV', 'csv_files', True, str2bool)
 
-        # self.output_file_path: Path = None
-        self.output_file = None
+        session_log, history = session_writers(config) if standalone else (None, None)
+        self.writer = CsvWriter(queue_size=config.get('CSV', 'queue_size', 10000, int),
+                                flush_interval=config.get('CSV', 'flush_interval', 1.0, float),
+                                flush_size=config.get('CSV', 'flush_size', 1 << 16, int),
+                                session_log=session_log, history=history)
 
         self.prev_bms_id = 0
         self.next_data_time = 0
@@ -215,35 +396,42 @@ class CsvDataLogging:
 
             self.prev_bms_id = data.bms_id_int
 
-        if data.bms_id_int:
+        if data.bms_id_int and not self.high_rate:
             # append to file
             time_now = time()
             if floor(time_now) != floor(self.next_data_time):
-                # logger.debug(f"Log to file time_now {time_now} {self.next_data_time}")
-                data.timestamp = utc_time_seconds()
-                self.output_file.write(data.to_csv_test())
-                self.output_file.write("\n")
-                self.output_file.flush()
+                self.writer.write(utc_time_seconds(), data.snapshot())
 
                 self.next_data_time = floor(time_now)
 
-    def reset(self, data: BmsInfo):
-        if self.output_file is not None:
-            self.output_file.close()
+    def frame(self, timestamp, data: BmsInfo):
+        """
+        High rate mode, called from the CAN receive thread after a frame is decoded
+        """
+        if self.high_rate and data.bms_id_int and data.bms_id_int == self.prev_bms_id:
+            self.writer.write(timestamp, data.snapshot())
 
-        if data.bms_id_int != 0:
-            csv_folder = Path("csv") / f"{data.bms_id}"
-            if not csv_folder.exists():
-                csv_folder.mkdir(parents=True)
+    def alarm(self, event):
+        """
+        Alarm events of the logged battery, to the .alarms file next to its csv file
+        """
+        if self.enabled and self.prev_bms_id:
+            self.writer.alarm(event)
+
+    def reset(self, data: BmsInfo):
+        if data.bms_id_int != 0 and self.csv_files:
             time_now = datetime.utcnow()
             date_str = time_now.strftime("%Y%m%d_%H%M%S")
-            output_file_path = csv_folder / f"{date_str}_{data.bms_id}.csv"
-
-            self.output_file = open(output_file_path, "a+")
+            self.writer.open(Path("csv") / f"{data.bms_id}" / f"{date_str}_{data.bms_id}.csv")
+        else:
+            self.writer.close()
 
-    def __del__(self):
-        if self.output_file is not None:
-            self.output_file.close()
+    def close(self):
+        """
+        Writes out the queued rows and stops the writer thread
+        """
+        self.writer.close()
+        self.writer.stop()
 
 
 def item_visibility(item, show):
@@ -262,15 +450,30 @@ def setup_settings(config_file=Path("config.conf")):
     settings.add_default("FIRMWARE", "DIR", "firmware")
     settings.add_default("FIRMWARE", "storage",
                               "https://storage.googleapis.com/46e5307363aa417e00bb26a6d999c142cbab1aeb/COSCOOTER")
+    settings.add_default("FIRMWARE", "verify_checksum", "True")
+    settings.add_default("FIRMWARE", "block_retries", "3")
+    settings.add_default("FIRMWARE", "retry_backoff", "0.5")
 
     settings.add_default("BMS", "timesync", "True")
     settings.add_default("BMS", "version", "80056")
 
     settings.add_default("APP", "show_untested_features", "False")
-    settings.add_default("APP", "polls_per_sec", "5")
     settings.add_default("CSV", "enabled", "True")
+    settings.add_default("CSV", "mode", "period")
+    settings.add_default("CSV", "flush_interval", "1.0")
+    settings.add_default("CSV", "session_log", "False")
+    settings.add_default("CSV", "history_db", "")
     settings.add_default("CSV", "data_period", "1")
 
+    settings.add_default("HISTORY", "window", "1800")
+    settings.add_default("HISTORY", "rate", "2")
+    settings.add_default("HISTORY", "export_minutes", "10")
+    settings.add_default("HISTORY", "plot_span", "600")
+
+    settings.add_default("ALARMS", "temp_hysteresis", "1")
+    settings.add_default("ALARMS", "cell_hysteresis", "10")
+    settings.add_default("ALARMS", "debounce", "1.0")
+
     settings.add_default("APP", "log_level", "INFO")
 
     settings.add_default("APP", "dark_mode", "False")
@@ -281,20 +484,14 @@ def setup_settings(config_file=Path("config.conf")):
     return settings
 
 
-def display_temp(display, temp, warn_high, warn_low=None, warn_diff=None, avg_temp=None):
-    stylesheet = stylesheet_display_none
-    if temp != "":
-        if temp >= warn_high:
-            stylesheet = stylesheet_display_red
-        elif warn_low is not None:
-            if temp <= warn_low:
-                stylesheet = stylesheet_display_blue
-        elif warn_diff is not None:
-            if abs(temp - avg_temp) >= warn_diff:
-                stylesheet = stylesheet_display_yellow
-
-    display.display(temp)
-    display.setStyleSheet(stylesheet)
+def set_num_known(label):
+    """
+    Label painter showing a number, unknown values leave the label as it is
+    """
+    def paint(value):
+        if value is not None:
+            label.setNum(value)
+    return paint
 
 
 class MyWindow(QMainWindow):
@@ -317,11 +514,9 @@ class MyWindow(QMainWindow):
 
         self.fullscreen_mode = self.settings.get('APP', 'fullscreen_mode', True, str2bool)
         
-        self.temp_high = self.settings.get('APP', 'warning_temp_high', 44, int)
-        self.temp_low = self.settings.get('APP', 'warning_temp_low', 4, int)
-        self.temp_diff = self.settings.get('APP', 'warning_temp_diff', 7, int)
-        self.fet_temp_high = self.settings.get('APP', 'warning_fet_temp_high', 65, int)
-        self.usb_temp_high = self.settings.get('APP', 'warning_usb_temp_high', 65, int)
+        # temperature and cell warnings, evaluated when the fields they read change
+        self.alarms = AlarmEngine(bms_rules(self.settings))
+        self.alarms.subscribe(self.on_alarm)
 
         self.ask_for_update = self.settings.get('APP', 'ask_for_update', False, str2bool)
         self.live_load_period = self.settings.get('APP', 'load_live_period', 600, float)
@@ -357,12 +552,24 @@ class MyWindow(QMainWindow):
 
         self.data_process_state = True
         self.bms_reader = data_handling.BmsReader(self.settings)
-
-        self.last_poll_time = 0
+        self.fw_sessions = session_manager(self.bms_reader)
+        if self.standalone:
+            # binary trace of all CAN frames, for debugging at full frame rate
+            self.trace_shortcut = QShortcut(QKeySequence("Ctrl+Shift+T"), self)
+            self.trace_shortcut.activated.connect(self.bms_reader.can_bus.trace.toggle)  # noqa
+            # the last minutes of data, exported with Ctrl+Shift+E
+            self.history = RingHistory(self.settings.get("HISTORY", "window", 1800, float),
+                                       self.settings.get("HISTORY", "rate", 2, float))
+            self.history_export_minutes = self.settings.get("HISTORY", "export_minutes", 10, float)
+            self.export_shortcut = QShortcut(QKeySequence("Ctrl+Shift+E"), self)
+            self.export_shortcut.activated.connect(self.export_history)  # noqa
+            # trend plot of the history
+            self.plot = None
+            self.plot_shortcut = QShortcut(QKeySequence("Ctrl+Shift+P"), self)
+            self.plot_shortcut.activated.connect(self.show_plot)  # noqa
 
         self.setWindowIcon(QIcon('icon.png'))
 
-        self.bms_register_poll_counter = 0
         self.bms_data_timeout = 0
 
         self.attach_foldy_bms = False
@@ -370,7 +577,6 @@ class MyWindow(QMainWindow):
         self.last_rx_data = 0
         self.can_bus_timeout = True
 
-        self.polls_per_sec = self.settings.get("APP", "polls_per_sec", 1, function=int )
 
         self.cell_progressbars = [self.ui.progressBar_0,
                                   self.ui.progressBar_1,
@@ -384,36 +590,35 @@ class MyWindow(QMainWindow):
                                   self.ui.progressBar_9,
                                   self.ui.progressBar_10,
                                   self.ui.progressBar_11]
+        # bars for packs with more cells, shown by the cell count of the hw_type
+        for cell in range(len(self.cell_progressbars), MAX_CELLS):
+            self.cell_progressbars.append(self.add_cell_progressbar(cell))
 
         self.prev_timesync = floor(time())
         self.prev_attach = 0
 
-        self.prev_lowest_scale = 0
-        self.prev_highest_scale = 0
-
         self.prev_bms_data = BmsInfo()
-        self.prev_usb_data = USB_Info()
-
-        self.cell_voltage_diff = ValueChanged()
 
         self.latest_fw_changed = ValueChanged()
-        self.prev_avg_temp = 0
 
         # data in can thread
-        self.next_poll_time = 0
-        self.bms_register_poll_counter = 0
-        self.prev_bms_data_can = BmsInfo()
+        self.poll_schedule = PollSchedule()
+        self.last_ui_update = 0
+        # firmware version and hardware type the register list was chosen for
+        self.read_regs_type = (0, 0)
 
         self.bms_info = BmsInfo(1)
         self.usb_info = USB_Info()
+        self.poller = PipelinedPoller(self.bms_reader.can_bus,
+                                                    self.settings.get("CAN", "poll_window", 4, int),
+                                                    self.settings.get("CAN", "poll_timeout", 100, int),
+                                                    max_timeout_ms=self.settings.get("CAN", "poll_timeout_max", 500, int))
 
         self.bms_read_regs = []
         self.reset_read_regs()
 
-        self.cell_format_stylesheets = {0: "", 1: "", 2: "", 3: "", 4: "", 5: "", 6: "", 7: "", 8: "", 9: "", 10: "", 11: ""}
-        self.cell_voltages_stylesheets = {0: "", 1: "", 2: "", 3: "", 4: "", 5: "", 6: "", 7: "", 8: "", 9: "", 10: "", 11: ""}
 
-        self.csv_logging = CsvDataLogging(self.settings)
+        self.csv_logging = CsvDataLogging(self.settings, self.standalone)
 
         self.fw_update_dialog = QtWidgets.QDialog()
         self.fw_update_dialog_ui = Ui_fw_update_dialog()
@@ -485,7 +690,9 @@ class MyWindow(QMainWindow):
         self.usbc_dialog_ui = Ui_usbc_dialog()
         self.usbc_dialog_ui.setupUi(self.usbc_dialog)
         self.ui.pushButton_usbc.clicked.connect(self.show_usbc_ui)
-        self.display_usb_data(self.prev_usb_data, self.prev_bms_data)
+        self.bms_bindings = self.bind_bms()
+        self.usb_bindings = self.bind_usb()
+        self.display_usb_data(USB_Info())
 
         self.display_bms_data(self.prev_bms_data, True)
 
@@ -653,59 +860,178 @@ class MyWindow(QMainWindow):
         item_visibility(self.sensors_dialog_ui.checkBox_dis_5, hw_type != 0)
         item_visibility(self.sensors_dialog_ui.checkBox_dis_6, hw_type != 0)
 
-    def set_cells(self, bms, cell):
-        # self.cell_lcd[cell].display(bms.cell_voltages[cell])
+    def bind_bms(self) -> BindingSet:
+        """
+        Battery data widgets, each repainted only when the fields it shows change
+        """
+        ui = self.ui
+        bindings = BindingSet()
+        bindings.bind(["bms_sw_version"], BmsInfo.ui_bms_sw_version, ui.label_fw_version.setText)
+        bindings.bind(["bms_id", "bms_id_int"], lambda bms: (bms.ui_bms_id(), bool(bms.bms_id_int)), self.paint_bms_id)
+        bindings.bind(["pack_state"], ui_pack_state, ui.label_battery_state.setText)
+        bindings.bind(["can_bus"], lambda bms: "Active" if bms.can_bus else "Inactive", ui.label_can_status.setText)
+        bindings.bind(["error_flags", "bq_sys_stat"], ui_bms_error_state, ui.label_bms_error_state.setText)
+        bindings.bind(["attach_status"], ui_attach_status, ui.label_attach_status.setText)
+
+        bindings.bind_field("bms_unread_error_count", ui.lcd_errors.display, to_text)
+        bindings.bind_field("available_capacity", ui.lcd_capacity.display, to_text)
+        bindings.bind_field("pack_soc", ui.display_soc.display, to_text)
+        bindings.bind_field("voltage", ui.display_voltage.display, to_text)
+        bindings.bind_field("current", ui.display_current.display, to_text)
+        bindings.bind(["voltage", "current"], ui_power, ui.lcd_power.display)
+        bindings.bind_field("cell_voltage_lowest", ui.display_min_cell_voltage.display, to_text)
+        bindings.bind_field("cell_voltage_highest", ui.display_max_cell_voltage.display, to_text)
+        bindings.bind_field("cap_sense_fill_time", ui.lcd_capsense.display,
+                            lambda value: "DEAD" if value == 0xDEAD else to_text(value))
+        bindings.bind(["cell_voltage_highest", "cell_voltage_lowest"], ui_cell_diff, ui.lcd_cell_diff.display)
+        bindings.bind_field("cycle_count", ui.lcd_cycle_count.display, to_text)
+
+        # the displays are highlighted by the alarms of their field
+        self.alarm_displays = {"fet_temp": ui.display_fet_temperature,
+                               "pack_left_temp": ui.lcd_temp1,
+                               "pack_center_temp": ui.lcd_temp2,
+                               "pack_right_temp": ui.lcd_temp3,
+                               "temp_ts_1": ui.lcd_ts1,
+                               "temp_ts_2": ui.lcd_ts2,
+                               "temp_ts_3": ui.lcd_ts3,
+                               "pack_temp_4": ui.lcd_temp4,
+                               "pack_temp_5": ui.lcd_temp5,
+                               "pack_temp_6": ui.lcd_temp6,
+                               "temp_usb": ui.lcd_temp_usb,
+                               "cell_diff": ui.lcd_cell_diff}
+        for field, display in self.alarm_displays.items():
+            if field != "cell_diff":
+                bindings.bind_field(field, display.display, to_text)
+
+        # the bar range before the bar values, values outside the range are not shown
+        self.cell_balancing = [False] * len(self.cell_progressbars)
+        bindings.bind(["cell_voltage_highest", "cell_voltage_lowest", "overvoltage_limit", "undervoltage_limit"],
+                      cell_scale, self.paint_cell_scale)
+        bindings.bind(["cell_voltages"], lambda bms: len(bms.cell_voltages), self.paint_cell_count)
+        for cell, progressbar in enumerate(self.cell_progressbars):
+            bindings.bind(["cell_voltages"], lambda bms, cell=cell: cell_value(bms, cell),
+                          self.cell_value_painter(progressbar))
+            bindings.bind(["balance_pattern"], lambda bms, cell=cell: bool(bms.ui_balance_pattern() & (1 << cell)),
+                          lambda balancing, cell=cell: self.paint_cell_balancing(cell, balancing))
+
+        bindings.bind_field("balance_state", self.balancing_dialog_ui.label_balancing.setText,
+                            lambda state: "N/A" if state is None else "Enabled" if state == 1 else "Disabled")
+        bindings.bind(["unix_time", "time_diff"], ui_unix_time, ui.label_time.setText)
+        bindings.bind_field("error_flags", self.paint_request_off)
+        bindings.bind_field("attach_pin_voltage", ui.lcd_attach_pin_voltage.display, to_text)
+        bindings.bind_field("digipot_value", self.usbc_dialog_ui.label_vsafe_3.setText,
+                            lambda value: f"Digipot: {to_text(value)}")
+        return bindings
+
+    def bind_usb(self) -> BindingSet:
+        """
+        USB-C debug dialog widgets
+        """
+        dialog = self.usbc_dialog_ui
+        bindings = BindingSet()
+        for field, label in (
+                # Role Control
+                ("rc_cc1", dialog.label_cc1), ("rc_cc2", dialog.label_cc2),
+                ("rp_value", dialog.label_rp), ("drp", dialog.label_drp),
+                # Message header
+                ("cable_plug", dialog.label_cable), ("data_role", dialog.label_role),
+                ("usb_spec", dialog.label_usbpd), ("power_role", dialog.label_power),
+                # CC Status
+                ("Looking4Connection", dialog.label_l4c), ("ConnectResult", dialog.label_connresult),
+                ("cc2_state", dialog.label_cc2state), ("cc1_state", dialog.label_cc1state),
+                # Power Status
+                ("vbus_sink", dialog.label_vbussink), ("vconn_present", dialog.label_vconnpresent),
+                ("vbus_present", dialog.label_vbuspresent), ("vbus_detect", dialog.label_vbusdetection),
+                ("vbus_source", dialog.label_vbussourcing), ("high_volt", dialog.label_highvolt),
+                ("tcpc_init", dialog.label_tcpcinit), ("debug_acc", dialog.label_debugacc),
+                # Extended Status
+                ("vsafe", dialog.label_vsafe)):
+            bindings.bind_field(field, set_num_known(label))
+
+        bindings.bind_field("vbus_voltage", dialog.lcd_vbus.display, to_text)
+        bindings.bind_field("i2c_state", self.paint_i2c_state)
+        return bindings
+
+    def paint_bms_id(self, value):
+        bms_id_text, has_bms_id = value
+        self.ui.label_battery_id.setText(bms_id_text)
+        if has_bms_id:
+            self.ui.label_time_2.show()
+        else:
+            self.ui.label_time_2.hide()
+            self.confirm_dialog.close()
+
+    def paint_cell_balancing(self, cell, balancing):
+        self.cell_balancing[cell] = balancing
+        self.paint_cell_style(cell)
+
+    def paint_cell_style(self, cell):
+        alarm = self.alarms.severity(f"cell_{cell + 1}") is not None
+        self.cell_progressbars[cell].setStyleSheet(cell_stylesheet(self.cell_balancing[cell], alarm))
+
+    def on_alarm(self, event):
+        """
+        Repaints the widget of the alarm target and logs the event
+        """
+        display = self.alarm_displays.get(event.target)
+        if display is not None:
+            display.setStyleSheet(ALARM_STYLESHEETS[self.alarms.severity(event.target)])
+        elif event.target.startswith("cell_"):
+            self.paint_cell_style(int(event.target[5:]) - 1)
+        logger.info(f"alarm {event.text()}")
+        if self.standalone:
+            self.csv_logging.alarm(event)
+
+    def paint_cell_scale(self, value):
+        lowest, highest = value
+        self.ui.gridGroupBox.setTitle(f"Cells ({round(lowest/1000,2)} ... {round(highest/1000,2)})")
+        for progressbar in self.cell_progressbars:
+            progressbar.setMaximum(highest)
+            progressbar.setMinimum(lowest)
+
+    def paint_cell_count(self, count):
+        for cell, progressbar in enumerate(self.cell_progressbars):
+            progressbar.setVisible(cell < count)
+
+    def add_cell_progressbar(self, cell):
+        """
+        Cell bar like the ones of the ui file, hidden until a pack has that many cells
+        """
+        template = self.ui.progressBar_0
+        progressbar = QtWidgets.QProgressBar(self.ui.gridGroupBox)
+        progressbar.setSizePolicy(template.sizePolicy())
+        progressbar.setFont(template.font())
+        progressbar.setMinimum(template.minimum())
+        progressbar.setMaximum(template.maximum())
+        progressbar.setAlignment(template.alignment())
+        progressbar.setTextVisible(True)
+        progressbar.setFormat("%v")
+        progressbar.setObjectName(f"progressBar_{cell}")
+        self.ui.gridLayout_2.addWidget(progressbar, cell + 1, 2, 1, 1)
+        progressbar.hide()
+        return progressbar
+
+    def paint_request_off(self, error_flags):
+        if error_flags is not None:
+            if error_flags & 0x2:
+                self.ui.pushButton_requestoff.setText("Request ON")
+            else:
+                self.ui.pushButton_requestoff.setText("Request OFF")
 
-        # percent = calc_cell_percent(bms, cell)
-        # # print(f"cell {cell} res: {percent}")
-        bms_cell_voltage = bms.cell_voltages[cell]
-        prev_bms_cell_voltage = self.prev_bms_data.cell_voltages[cell]
-        if bms_cell_voltage == prev_bms_cell_voltage and bms.balance_pattern == self.prev_bms_data.balance_pattern and bms.overvoltage_limit != self.prev_bms_data.overvoltage_limit:
+    def paint_i2c_state(self, i2c_state):
+        if i2c_state is None:
             return
-
-        prgrss = self.cell_progressbars[cell]
-
-        color = "#7bbd7b"
-
-        cell_voltage = 0
-        cell_format = "N/A"
-        if bms_cell_voltage != "":
-            cell_voltage = bms_cell_voltage
-            cell_format = f"{cell + 1:02}: {cell_voltage}"
-
-        overvoltage_limit = 4040
-        if bms.overvoltage_limit != "" and bms.overvoltage_limit != 0:
-            overvoltage_limit = bms.overvoltage_limit
-
-        undervoltage_limit = 3000
-        if bms.undervoltage_limit != "" and bms.undervoltage_limit != 0:
-            undervoltage_limit = bms.undervoltage_limit
-
-        if cell_voltage > overvoltage_limit or cell_voltage < undervoltage_limit:
-            color = "#ff0000"
-
-        box_style = "border: 2px solid grey"
-
-        if bms.balance_pattern != "":
-            if bms.balance_pattern & (1 << cell):
-                box_style = "border: 5px solid blue"
-
-        if bms_cell_voltage != prev_bms_cell_voltage:
-            # print(f"cell {cell} cell_voltage {cell_voltage} prev_bms_cell_voltage: {prev_bms_cell_voltage}")
-            self.cell_format_stylesheets[cell] = cell_format
-            prgrss.setValue(cell_voltage)
-
-            prgrss.setFormat(cell_format)
-
-        stylesheet = (" QProgressBar { "
-            f"{box_style}; border-radius: 0px; text-align: center; "
-            "} QProgressBar::chunk {"
-            f"background-color: {color};"
-            "width: 1px;}")
-
-        if stylesheet != self.cell_voltages_stylesheets[cell]:
-            prgrss.setStyleSheet(stylesheet)
-            self.cell_voltages_stylesheets[cell] = stylesheet
+        self.usbc_dialog_ui.label_i2c.setNum(i2c_state)
+        stylesheet = stylesheet_display_red if i2c_state > 0 else stylesheet_display_none
+        self.usbc_dialog_ui.label_i2c.setStyleSheet(stylesheet)
+
+    @staticmethod
+    def cell_value_painter(progressbar):
+        def paint(value):
+            cell_voltage, cell_format = value
+            progressbar.setValue(cell_voltage)
+            progressbar.setFormat(cell_format)
+        return paint
 
     def update_ui(self, value: BmsInfo, usb_value: USB_Info):
         self.update_ui_signal.emit(value, usb_value) # noqa
@@ -713,7 +1039,7 @@ class MyWindow(QMainWindow):
     def on_update_ui(self, value: BmsInfo, usb_value: USB_Info):
         try:
             self.display_bms_data(value, False)
-            self.display_usb_data(usb_value, value)
+            self.display_usb_data(usb_value)
         except Exception as e:
             logger.error(f"on_update_ui: {e}")
             pass
@@ -737,6 +1063,9 @@ class MyWindow(QMainWindow):
             self.fw_update_dialog_ui.label_info.hide()
             self.fw_update_dialog.close()
 
+        if percent == 100:
+            QtCore.QTimer.singleShot(2000, lambda: self.on_update_fw_msg("", -1))
+
     def to_worker(self, command):
         self.from_ui_queue.put(command)
 
@@ -879,70 +1208,13 @@ class MyWindow(QMainWindow):
         print(f"ui_write_sensor_mask: {mask:08x}")
         self.to_worker((UiCommand.MASTER_COMMAND, 8, 1, mask))
 
-    def display_usb_data(self, usb: USB_Info, bms:BmsInfo):
-        prev_usb = self.prev_usb_data
-
-        # Role Control
-        if usb.role_control != prev_usb.role_control:
-            self.usbc_dialog_ui.label_cc1.setNum(usb.rc_cc1)
-            self.usbc_dialog_ui.label_cc2.setNum(usb.rc_cc2)
-            self.usbc_dialog_ui.label_rp.setNum(usb.rp_value)
-            self.usbc_dialog_ui.label_drp.setNum(usb.drp)
-
-        # Message header
-        if usb.message_header != prev_usb.message_header:
-            self.usbc_dialog_ui.label_cable.setNum(usb.cable_plug)
-            self.usbc_dialog_ui.label_role.setNum(usb.data_role)
-            self.usbc_dialog_ui.label_usbpd.setNum(usb.usb_spec)
-            self.usbc_dialog_ui.label_power.setNum(usb.power_role)
-
-        # CC Status
-        if usb.cc_status != prev_usb.cc_status:
-            self.usbc_dialog_ui.label_l4c.setNum(usb.Looking4Connection)
-            self.usbc_dialog_ui.label_connresult.setNum(usb.ConnectResult)
-            self.usbc_dialog_ui.label_cc2state.setNum(usb.cc2_state)
-            self.usbc_dialog_ui.label_cc1state.setNum(usb.cc1_state)
-            
-        # Power Status
-        if usb.power_status != prev_usb.power_status:
-            self.usbc_dialog_ui.label_vbussink.setNum(usb.vbus_sink)
-            self.usbc_dialog_ui.label_vconnpresent.setNum(usb.vconn_present)
-            self.usbc_dialog_ui.label_vbuspresent.setNum(usb.vbus_present)
-            self.usbc_dialog_ui.label_vbusdetection.setNum(usb.vbus_detect)
-            self.usbc_dialog_ui.label_vbussourcing.setNum(usb.vbus_source)
-            self.usbc_dialog_ui.label_highvolt.setNum(usb.high_volt)
-            self.usbc_dialog_ui.label_tcpcinit.setNum(usb.tcpc_init)
-            self.usbc_dialog_ui.label_debugacc.setNum(usb.debug_acc)
-
-        # Extended Status
-        if usb.extended_status != prev_usb.extended_status:
-            self.usbc_dialog_ui.label_vsafe.setNum(usb.vsafe)
-        
-        if usb.vbus_voltage != prev_usb.vbus_voltage:
-            self.usbc_dialog_ui.lcd_vbus.display(usb.vbus_voltage)
-        
-        if usb.i2c_state != prev_usb.i2c_state:
-            self.usbc_dialog_ui.label_i2c.setNum(usb.i2c_state)
-            stylesheet = stylesheet_display_none
-            try:
-                if usb.i2c_state > 0:
-                    stylesheet = stylesheet_display_red
-            except Exception:
-                pass
-            self.usbc_dialog_ui.label_i2c.setStyleSheet(stylesheet)
-
-        self.usbc_dialog_ui.label_vsafe_3.setText(f"Digipot: {bms.digipot_value}")
+    def display_usb_data(self, usb: USB_Info):
+        self.usb_bindings.update(usb)
 
     def display_bms_data(self, bms: BmsInfo, is_changed=False):
         prev_bms = self.prev_bms_data
-        is_fw_type_changed = bms.hw_type != prev_bms.hw_type or bms.sw_profile != prev_bms.sw_profile or bms.bms_sw_version != prev_bms.bms_sw_version or is_changed
-        # logger.debug(f"prev hw {self.prev_bms_data.hw_type} sw {self.prev_bms_data.sw_profile} -> hw {bms.hw_type} sw {bms.sw_profile}")
-        # print(f"is_fw_type_changed {is_fw_type_changed}")
-        # if is_fw_type_changed:
-
-        if bms.bms_sw_version != prev_bms.bms_sw_version:
-            sw_ver_text = f"{bms.ui_bms_sw_version()}"
-            self.ui.label_fw_version.setText(sw_ver_text)
+        changed = self.bms_bindings.update(bms, force=is_changed)
+        self.alarms.update(bms, changed)
 
         cur_latest = 0
         if bms.is_reg_fc:
@@ -964,279 +1236,11 @@ class MyWindow(QMainWindow):
                     logger.info(f"new firmware available: {cur_latest}")
                     self.show_confirm_dialog("new_fw_update", "New firmware!", f"New firmware available: {cur_latest}\nWould you like to update?")
 
-        if bms.bms_id_int != prev_bms.bms_id_int:
-            self.ui.label_battery_id.setText(bms.ui_bms_id())
-            if bms.bms_id_int:
-                self.ui.label_time_2.show()
-            else:
-                self.ui.label_time_2.hide()
-                self.confirm_dialog.close()
-
-        if bms.pack_state != prev_bms.pack_state:
-            self.ui.label_battery_state.setText(ui_pack_state(bms))
-
-        if bms.can_bus != prev_bms.can_bus or is_changed:
-            if bms.can_bus:
-                self.ui.label_can_status.setText("Active")
-            else:
-                self.ui.label_can_status.setText("Inactive")
-
-        if bms.error_flags != prev_bms.error_flags or bms.bq_sys_stat != prev_bms.bq_sys_stat:
-            if bms.error_flags == "":
-                bms_error_state_text = "N/A"
-            else:
-                bms_error_state_text = f"{bms.error_flags}"
-                errors = []
-
-                if bms.error_flags & 1:
-                    errors.append("Initial config")
-
-                if bms.error_flags & 2:
-                    errors.append("REQUEST OFF")
-
-                if bms.error_flags & 4:
-                    errors.append("BQ STATUS")
-                    if bms.bq_sys_stat == "":
-                        errors.append(f"BQ: N/A")
-                    else:
-                        errors.append(f"BQ: {bms.bq_sys_stat}")
-
-                        if bms.bq_sys_stat & 1:
-                            errors.append("BQ1: Overcurrent")
-
-                        if bms.bq_sys_stat & 2:
-                            errors.append("BQ2: Short-circuit")
-
-                        if bms.bq_sys_stat & 4:
-                            errors.append("BQ4: Overvoltage")
-
-                        if bms.bq_sys_stat & 8:
-                            errors.append("BQ8: Undervoltage")
-
-                if bms.error_flags & 8:
-                    errors.append("PRECHARGE")
-
-                if bms.error_flags & 16:
-                    errors.append("Under Voltage")
-
-                if bms.error_flags & 32:
-                    errors.append("Over Voltage")
-
-                if bms.error_flags & 64:
-                    errors.append("Over Current")
-
-                if bms.error_flags & 128:
-                    errors.append("Over Temperature")
-
-                if len(errors):
-                    errors_text = "\n".join(errors)
-                    bms_error_state_text += f" ({errors_text})"
-
-            self.ui.label_bms_error_state.setText(bms_error_state_text)
-
-        if bms.attach_status != prev_bms.attach_status:
-
-            self.ui.label_attach_status.setText(ui_attach_status(bms))
-
-        if bms.bms_unread_error_count != prev_bms.bms_unread_error_count:
-            self.ui.lcd_errors.display(bms.bms_unread_error_count)
-
-        if bms.available_capacity != prev_bms.available_capacity:
-            self.ui.lcd_capacity.display(bms.available_capacity)
-
-        if bms.pack_soc != prev_bms.pack_soc:
-            self.ui.display_soc.display(bms.pack_soc)
-
-        update_power = is_changed
-        if bms.voltage != prev_bms.voltage:
-            self.ui.display_voltage.display(f"{bms.voltage}")
-            update_power = True
-
-        if bms.current != prev_bms.current:
-            self.ui.display_current.display(f"{bms.current}")
-            update_power = True
-        if update_power:
-            display_value = ""
-            try:
-                power = (bms.voltage / 1000) * (bms.current / 1000)
-                display_value = f"{power:.2f}"
-            except Exception:
-                pass
-            self.ui.lcd_power.display(display_value)
-        if bms.cell_voltage_lowest != prev_bms.cell_voltage_lowest:
-            self.ui.display_min_cell_voltage.display(f"{bms.cell_voltage_lowest}")
-
-        if bms.cell_voltage_highest != prev_bms.cell_voltage_highest:
-            self.ui.display_max_cell_voltage.display(f"{bms.cell_voltage_highest}")
-
-        if bms.cap_sense_fill_time != prev_bms.cap_sense_fill_time:
-            if bms.cap_sense_fill_time == 0xDEAD:
-                cap_sense_text = f"DEAD"
-            else:
-                cap_sense_text = f"{bms.cap_sense_fill_time}"
-            self.ui.lcd_capsense.display(cap_sense_text)
-
-        cell_diff_value = ""
-        if bms.cell_voltage_highest != "" and bms.cell_voltage_lowest != "":
-            cell_diff_value = bms.cell_voltage_highest - bms.cell_voltage_lowest
-
-        if self.cell_voltage_diff.is_changed_update(cell_diff_value):
-            stylesheet = stylesheet_display_none
-            try:
-                if abs(cell_diff_value) > 100:
-                    stylesheet = stylesheet_display_error
-
-                elif abs(cell_diff_value) > 45:
-                    stylesheet = stylesheet_display_warn
-            except Exception:
-                pass
-
-            self.ui.lcd_cell_diff.display(f"{cell_diff_value}")
-            self.ui.lcd_cell_diff.setStyleSheet(stylesheet)
-
-        if bms.cycle_count != prev_bms.cycle_count:
-            cell_cycle_count = ""
-            if bms.cycle_count != "":
-                cell_cycle_count = f"{bms.cycle_count}"
-
-            self.ui.lcd_cycle_count.display(cell_cycle_count)
-
-        avg_temp = int(calc_avg_temperature(bms))
-        avg_temp_change = avg_temp != self.prev_avg_temp
-
-        if bms.fet_temp != prev_bms.fet_temp or avg_temp_change:
-            display_temp(self.ui.display_fet_temperature, bms.fet_temp, self.fet_temp_high, self.temp_low, self.temp_diff, avg_temp)
-
-        if bms.pack_left_temp != prev_bms.pack_left_temp or avg_temp_change:
-            display_temp(self.ui.lcd_temp1, bms.pack_left_temp, self.temp_high, self.temp_low, self.temp_diff, avg_temp)
-        if bms.pack_center_temp != prev_bms.pack_center_temp or avg_temp_change:
-            display_temp(self.ui.lcd_temp2, bms.pack_center_temp, self.temp_high, self.temp_low, self.temp_diff, avg_temp)
-        if bms.pack_right_temp != prev_bms.pack_right_temp or avg_temp_change:
-            display_temp(self.ui.lcd_temp3, bms.pack_right_temp, self.temp_high, self.temp_low, self.temp_diff, avg_temp)
-
-        if bms.hw_type == 1 or bms.hw_type == 2:
-            if bms.temp_usb != prev_bms.temp_usb or avg_temp_change:
-                display_temp(self.ui.lcd_temp_usb, bms.temp_usb, self.usb_temp_high)
-            if bms.temp_ts_1 != prev_bms.temp_ts_1 or avg_temp_change:
-                display_temp(self.ui.lcd_ts1, bms.temp_ts_1, self.temp_high, self.temp_low, self.temp_diff, avg_temp)
-            if bms.temp_ts_2 != prev_bms.temp_ts_2 or avg_temp_change:
-                display_temp(self.ui.lcd_ts2, bms.temp_ts_2, self.temp_high, self.temp_low, self.temp_diff, avg_temp)
-            if bms.temp_ts_3 != prev_bms.temp_ts_3 or avg_temp_change:
-                display_temp(self.ui.lcd_ts3, bms.temp_ts_3, self.temp_high, self.temp_low, self.temp_diff, avg_temp)
-
-        if bms.hw_type == 2:
-            if bms.pack_temp_4 != prev_bms.pack_temp_4 or avg_temp_change:
-                display_temp(self.ui.lcd_temp4, bms.pack_temp_4, self.temp_high, self.temp_low, self.temp_diff,
-                             avg_temp)
-            if bms.pack_temp_5 != prev_bms.pack_temp_5 or avg_temp_change:
-                display_temp(self.ui.lcd_temp5, bms.pack_temp_5, self.temp_high, self.temp_low, self.temp_diff,
-                             avg_temp)
-            if bms.pack_temp_6 != prev_bms.pack_temp_6 or avg_temp_change:
-                display_temp(self.ui.lcd_temp6, bms.pack_temp_6, self.temp_high, self.temp_low, self.temp_diff,
-                             avg_temp)
-
-        self.prev_avg_temp = avg_temp
-        # is_low_high_changed = False
-        # lowest = self.prev_lowest_scale
-        # highest = self.prev_highest_scale
-
-        if bms.cell_voltage_highest != prev_bms.cell_voltage_highest or bms.cell_voltage_lowest != prev_bms.cell_voltage_lowest or bms.overvoltage_limit != prev_bms.overvoltage_limit or bms.undervoltage_limit != prev_bms.undervoltage_limit:
-
-            lowest = 0
-            highest = 4000
-            uv_limit = 3000
-            if bms.overvoltage_limit != "" and bms.overvoltage_limit != 0:
-                highest = bms.overvoltage_limit
-
-            if bms.undervoltage_limit != "" and bms.undervoltage_limit != 0:
-                uv_limit = bms.undervoltage_limit
-
-            if bms.cell_voltage_highest != "" and bms.cell_voltage_lowest != "":
-                lowest = 3900
-
-                if bms.cell_voltage_lowest < lowest:
-                    lowest = 3700
-
-                if bms.cell_voltage_lowest < lowest:
-                    lowest = uv_limit
-
-                if bms.cell_voltage_lowest < uv_limit:
-                    lowest = uv_limit - 200
-
-                if bms.cell_voltage_lowest < lowest:
-                    lowest = 2000
-
-                if bms.cell_voltage_lowest < lowest:
-                    lowest = 1000
-
-                if bms.cell_voltage_lowest < lowest:
-                    lowest = 0
-
-                if bms.cell_voltage_highest > highest:
-                    highest = 4040
-
-                if bms.cell_voltage_highest > highest:
-                    highest = 4200
-
-                if bms.cell_voltage_highest > highest:
-                    highest = 4250
-
-                if bms.cell_voltage_highest > highest:
-                    highest = 4500
-
-            is_low_high_changed = lowest != self.prev_lowest_scale or highest != self.prev_highest_scale
-
-            if is_low_high_changed:
-                self.ui.gridGroupBox.setTitle(f"Cells ({round(lowest/1000,2)} ... {round(highest/1000,2)})")
-
-                for i in range(12):
-                    progressbar = self.cell_progressbars[i]
-                    progressbar.setMaximum(highest)
-                    progressbar.setMinimum(lowest)
-
-                self.prev_lowest_scale = lowest
-                self.prev_highest_scale = highest
-
-        for i in range(12):
-            self.set_cells(bms, i)
-
-        if bms.balance_state != prev_bms.balance_state:
-            balance_text = "N/A"
-            if bms.balance_state != "":
-                if bms.balance_state == 1:
-                    balance_text = "Enabled"
-                else:
-                    balance_text = "Disabled"
-
-            self.balancing_dialog_ui.label_balancing.setText(balance_text)
-
-        if bms.unix_time != prev_bms.unix_time:
-            timetag_str = "N/A"
-            try:
-                time_obj = datetime.fromtimestamp(bms.unix_time, timezone.utc)
-                timetag_str = f"{time_obj.strftime('%Y-%m-%d %H:%M:%S')} ({bms.time_diff:.3f})"
-            except Exception:
-                pass
-
-            self.ui.label_time.setText(timetag_str)
-
-        if is_fw_type_changed:
+        if not changed.isdisjoint(("hw_type", "sw_profile", "bms_sw_version")):
             self.ui_show_hide_type(bms)
 
-        if bms.error_flags != prev_bms.error_flags and bms.error_flags != "":
-            if bms.error_flags & 0x2:
-                self.ui.pushButton_requestoff.setText("Request ON")
-            else:
-                self.ui.pushButton_requestoff.setText("Request OFF")
-
-        if bms.attach_pin_voltage != prev_bms.attach_pin_voltage:
-            attach_pin_voltage_txt = ""
-            if bms.attach_pin_voltage != "":
-                attach_pin_voltage_txt = f"{bms.attach_pin_voltage}"
-            self.ui.lcd_attach_pin_voltage.display(attach_pin_voltage_txt)
-
-        if bms.temp_sensor_mask != prev_bms.temp_sensor_mask or is_changed:
-            if bms.temp_sensor_mask == "":
+        if "temp_sensor_mask" in changed:
+            if bms.temp_sensor_mask is None:
                 self.sensors_dialog_ui.pushButton_sensors_write.hide()
             else:
                 self.sensors_dialog_ui.checkBox_dis_1.setChecked((bms.temp_sensor_mask >> 0) & 0x1)
@@ -1256,12 +1260,12 @@ class MyWindow(QMainWindow):
 
                 self.sensors_dialog_ui.pushButton_sensors_write.show()
 
-        if bms.overvoltage_limit != prev_bms.overvoltage_limit or bms.undervoltage_limit != prev_bms.undervoltage_limit or is_changed:
+        if "overvoltage_limit" in changed or "undervoltage_limit" in changed:
             label_text_ov = "N/A"
             label_text_uv = "N/A"
             label_lcd_ov = ""
             label_lcd_uv = ""
-            if bms.overvoltage_limit == "":
+            if bms.overvoltage_limit is None:
                 self.voltage_dialog_ui.pushButton_voltage_ov_write.hide()
                 self.voltage_dialog_ui.pushButton_voltage_uv_write.hide()
             else:
@@ -1274,10 +1278,10 @@ class MyWindow(QMainWindow):
                 label_text_uv = f"{bms.undervoltage_limit}"
                 label_lcd_uv = bms.undervoltage_limit
 
-            if prev_bms.overvoltage_limit == "" and bms.overvoltage_limit != "":
+            if prev_bms.overvoltage_limit is None and bms.overvoltage_limit is not None:
                 self.voltage_dialog_ui.spinBox.setValue(bms.overvoltage_limit)
 
-            if prev_bms.undervoltage_limit == "" and bms.undervoltage_limit != "":
+            if prev_bms.undervoltage_limit is None and bms.undervoltage_limit is not None:
                 self.voltage_dialog_ui.spinBox_undevoltage.setValue(bms.undervoltage_limit)
 
             self.voltage_dialog_ui.label_32.setText(label_text_ov)
@@ -1287,24 +1291,26 @@ class MyWindow(QMainWindow):
 
             pass
 
-        if bms.digipot_value != prev_bms.digipot_value or is_changed:
+        if "digipot_value" in changed:
             label_text = "N/A"
-            if bms.digipot_value == "":
+            if bms.digipot_value is None:
                 self.digipot_dialog_ui.pushButton_digipot_write.hide()
             else:
                 self.digipot_dialog_ui.pushButton_digipot_write.show()
                 label_text = f"{bms.digipot_value}"
-                if prev_bms.digipot_value == "":
+                if prev_bms.digipot_value is None:
                     self.digipot_dialog_ui.spinBox_digipot.setValue(bms.digipot_value)
 
             self.digipot_dialog_ui.label_digipot_value.setText(label_text)
 
-        # remember last state
-        self.prev_bms_data = deepcopy(bms)
+        # remember last state, snapshots are not modified after they are handed to the GUI thread
+        self.prev_bms_data = bms
 
     def reset_read_regs(self):
         # read pack info and pcb/fw types
         self.bms_read_regs = [0xff, 0xfc]
+        if self.standalone:
+            self.bms_reader.can_bus.set_filter_group("bms", self.read_reg_filters(0, 0xFF))
 
     def set_read_regs(self, bms: BmsInfo):
         self.reset_read_regs()
@@ -1319,7 +1325,7 @@ class MyWindow(QMainWindow):
         if is_feature_supported(80000, 80056, bms.bms_sw_version):
             self.bms_read_regs.append(0xc8)
 
-        self.bms_read_regs.extend([0xd1, 0xd2, 0xd3])
+        self.bms_read_regs.extend(data_handling.CELL_GROUP_REGISTERS[:group_count(len(bms.cell_voltages))])
 
         if is_feature_supported(80000, 80054, bms.bms_sw_version):
             self.bms_read_regs.append(0xc8)
@@ -1347,131 +1353,106 @@ class MyWindow(QMainWindow):
 
         # add 0xC2 last
         self.bms_read_regs.append(0xc2)
-        pass
+
+        if self.standalone:
+            self.bms_reader.can_bus.set_filter_group("bms", self.read_reg_filters(0, 0xFF))
+
+    def scheduled_polls(self, group, base_id=0, rx_mask=MASK_EXACT):
+        polls = []
+        for reg in dict.fromkeys(self.bms_read_regs):
+            if reg == 0xfe and not self.timesync_enabled:
+                continue
+            period, priority = REGISTER_POLL_RATES.get(reg, DEFAULT_POLL_RATE)
+            polls.append(ScheduledPoll(group, base_id | reg, period, priority, rx_mask=rx_mask))
+        return polls
+
+    def read_reg_filters(self, base_id, mask=MASK_EXACT):
+        """
+        Acceptance filters for the replies to the currently polled registers. Without base_id in the mask
+        a battery can answer from any base address, with 11-bit (0x0xx) or 29-bit IDs.
+        """
+        classes = (None,) if mask & ~0xFF else (False, True)
+        return [can_filter(base_id | reg, mask, extended) for reg in sorted(set(self.bms_read_regs)) for extended in classes]
 
     def send_poll_reg(self, reg_nr):
         try:
             tx_msg = []
-            self.bms_reader.can_bus.send_data(reg_nr, tx_msg)
+            self.bms_reader.can_bus.send_data(reg_nr, tx_msg, priority=PRIORITY_POLL)
 
         except Exception as e:
             logger.error(f"Could not TX to ask for data! {e}")
 
-    def update_battery_data(self):
-        poll_reg_nr = 0
-        time_now = utc_time_seconds()
-        if self.next_poll_time <= time_now:
-
-            if self.bms_info.bms_sw_version == 0:
-                self.bms_register_poll_counter = 0
-
-            if self.bms_register_poll_counter == 0:
-                self.last_poll_time = time_now
-
-            if self.bms_register_poll_counter == len(self.bms_read_regs)-1:
-                self.next_poll_time = self.last_poll_time + 1 / self.polls_per_sec
-
-        # print(f"len {len(self.bms_read_regs)} ctr: {self.bms_register_poll_counter}")
-
-            poll_reg_nr = self.bms_read_regs[self.bms_register_poll_counter]
+    def export_history(self):
+        path = self.history.export_csv(self.history_export_minutes * 60)
+        if path is None:
+            logger.info("no history to export")
 
-        received_some_data = 0
+    def show_plot(self):
+        if self.plot is None:
+            self.plot = plot_window(self.history, "Battery trends", self.settings.get("HISTORY", "plot_span", 600, float))
+        self.plot.show()
+        self.plot.activateWindow()
 
-        # logger.debug(f"get_bms_info: ask {poll_reg_nr:02X}")
-        #
-        # while read_messages_count > 0:
-        #     try:
-        #         bms_message = can_bus.read_data(100)
-        #         received_some_data = self.update_reg(bms_message.id, bms_message.data)
-        #
-        #     except Exception as e:
-        #         logger.error(f"Nothing received from CAN:{e}")
-        #
-        #     read_messages_count = read_messages_count - 1
+    def on_bms_frame(self, msg: Message):
+        # called from the CAN receive thread
+        if not msg.arbitration_id:
+            return
+        response_time = self.poller.reply_received(msg.arbitration_id)
+        self.last_rx_data = utc_time_seconds()
+        self.bms_reader.update_reg(msg.arbitration_id, msg.data, response_time or 0, self.bms_info, self.usb_info)
+        self.csv_logging.frame(msg.timestamp or utc_time_seconds(), self.bms_info)
 
-        start = utc_time_seconds()
-        timeout_ms = 20
-        if poll_reg_nr:
-            # logger.info(f"get_bms_info: ask {poll_reg_nr:02X}")
-            timeout_ms = 100
-            self.send_poll_reg(poll_reg_nr)
+    def update_battery_data(self):
+        time_now = utc_time_seconds()
         update_ui = False
-        try:
-            while utc_time_seconds() - start < timeout_ms / 1000:
-                try:
-                    # timeout_left = abs((timeout_ms / 1000 - (utc_time_seconds()-start))*1000)
-                    response_time = utc_time_seconds() - start
-                    bms_response = self.bms_reader.can_bus.read_data(timeout_ms)
-                    # logger.debug(f"bms_response: {bms_response}")
-                    # if bms_response is not None:
-                    if bms_response is not None and not bms_response.is_error_frame and bms_response.arbitration_id and len(bms_response.data):
-                        # logger.debug(bms_response)
-                        self.last_rx_data = utc_time_seconds()
-                        received_msg_id = bms_response.arbitration_id & 0xFF
-                        # print(f"{received_msg_id}")
-                        # received_msg_id = 0xCB
-                        if received_msg_id == 0xCB:
-                            data_handling.update_cb(self.usb_info, bms_response.data)
-                            pass
-                        else:
-                            self.bms_reader.update_reg(bms_response.arbitration_id, bms_response.data, response_time, self.bms_info, self.usb_info)
-
-                        if poll_reg_nr and poll_reg_nr & 0xFF == received_msg_id:
-
-                            self.set_next_reg()
-
-                            # if received_msg_id == 0xC1:
-                            #     update_ui = True
-
-                            if received_msg_id == 0xC2:
-                                self.csv_logging.update(self.bms_info)
-                                update_ui = True
-                            break
-                except CanError as e:
-                    logger.error(f"Message NOT received, canerror! {e}")
-                    sleep(1)
-                except Exception as e:
-                    logger.error(f"Could not RX asked data! {e}")
-            # detech data timeout
-            if utc_time_seconds() - start >= timeout_ms / 1000:
-                self.set_next_reg()
-        except Exception as e:
-            logger.error(f"Could not TX to ask for data! {e}")
+        now = monotonic()
+        # the battery answers with the polled register number in the lowest byte
+        self.poll_schedule.set_group("bms", self.scheduled_polls("bms", rx_mask=0xFF))
+        due = self.poll_schedule.due(now, 2 * self.poller.window)
+        if due:
+            result = self.poller.poll([poll.request() for poll in due])
+            self.poll_schedule.completed(due, result, now)
+
+            if 0xC2 in result.answered:
+                self.csv_logging.update(self.bms_info)
+            if result.answered:
+                self.history.append(time_now, self.bms_info.snapshot())
+            if result.answered and now - self.last_ui_update >= UI_UPDATE_PERIOD:
+                self.last_ui_update = now
+                update_ui = True
+        else:
+            # keeps the timesync and UI command handling responsive between passes
+            next_deadline = self.poll_schedule.next_deadline()
+            sleep(0.02 if next_deadline is None else min(max(next_deadline - now, 0), 0.02))
 
         if self.bms_info.bms_id_int == 0:
             self.csv_logging.update(self.bms_info)
 
         self.can_bus_timeout = utc_time_seconds() - self.last_rx_data > BATTERY_DATA_TIMEOUT
-        self.bms_info.can_bus = not self.can_bus_timeout
+        if self.bms_info.can_bus != (not self.can_bus_timeout):
+            self.bms_info.can_bus = not self.can_bus_timeout
+            self.bms_info.changed()
 
         if self.can_bus_timeout:
             self.reset_bms_info()
             self.reset_read_regs()
-            self.next_poll_time = 0
+            self.poll_schedule.reset_group("bms")
             update_ui = True
 
-        if self.bms_info.bms_sw_version != self.prev_bms_data_can.bms_sw_version or self.bms_info.hw_type != self.prev_bms_data_can.hw_type:
+        read_regs_type = (self.bms_info.bms_sw_version, self.bms_info.hw_type)
+        if read_regs_type != self.read_regs_type:
+            self.read_regs_type = read_regs_type
             self.set_read_regs(self.bms_info)
-            self.next_poll_time = 0
 
         if update_ui:
-            self.update_ui(deepcopy(self.bms_info), deepcopy(self.usb_info))
+            self.update_ui(self.bms_info.snapshot(), copy(self.usb_info))
 
         # Protect FETs and SCP from overtemp
-        # if self.bms_info.fet_temp != "":
+        # if self.bms_info.fet_temp is not None:
         #     if self.bms_info.fet_temp > 50:
         #         print("FET overtemp, putting BMS to shipping mode!")
         #         self.put_bms_to_shipping()
 
-        self.prev_bms_data_can = deepcopy(self.bms_info)
-
-    def set_next_reg(self):
-        if self.bms_info.bms_sw_version == 0 or self.bms_register_poll_counter >= len(
-                self.bms_read_regs) - 1:
-            self.bms_register_poll_counter = 0
-        else:
-            self.bms_register_poll_counter = self.bms_register_poll_counter + 1
-
     def send_timesync(self, utc_time):
 
         try:
@@ -1501,9 +1482,9 @@ class MyWindow(QMainWindow):
                     self.prev_timesync = utc_time
 
                 self.bms_reader.send_message_to_can(0xF000, msg)
-                logger.debug(f"timesync msg: {hexlify(msg)}")
+                log_fields(logger, logging.DEBUG, "timesync", data=msg)
         except Exception as e:
-            logger.debug(f"failed to send timesync: {e}")
+            log_fields(logger, logging.DEBUG, "failed to send timesync", error=e)
             raise
 
     def send_master_command(self, main_code, sub, data):
@@ -1512,6 +1493,7 @@ class MyWindow(QMainWindow):
 
     def windowThreadRun(self):
         # sleep(1)
+        rx_subscription = self.bms_reader.can_bus.subscribe(self.on_bms_frame, 0, 0)
         self.bms_reader.open_can()
         while self.testRunning.get():
             # logger.debug(f"looping")
@@ -1537,61 +1519,23 @@ class MyWindow(QMainWindow):
                     self.bms_reader.send_message_to_can(0xf123, msg)
 
                 elif data_cmd == UiCommand.FW_UPDATE:
-                    # do update
+                    # the update runs in its own session thread, the polling goes on
                     fw_version = data[1]
 
+                    selected_fw_type = self.bms_info.fw_type
+                    if data[2] is not None:
+                        selected_fw_type = data[2]
 
-                    # use_temporary_attach = self.bms_info.attach_status == 0
-
-                    use_temporary_attach = False
-
-                    new_id = 0x20
-
-                    # if self.bms_info.fw_type == 0 or self.bms_info.fw_type == 1:
                     logger.debug(f"updat_fw attach_status = {self.bms_info.attach_status}")
-                    if self.bms_info.attach_status != 0xFF:
-                        # new_id = self.bms_info.attach_status | 0xD0
-                        if self.bms_info.fw_type == 0:
-                            self.bms_reader.tx_identifier = 0xF000 | ((self.bms_info.attach_status | 0xD0) << 4) | 0xD
-                        else:
-                            self.bms_reader.tx_identifier = 0xFD0D
-                        self.bms_reader.rx_identifier = 0xF000 | ((self.bms_info.attach_status | 0xD0) << 4) | 0xA
-                    # elif self.bms_info.fw_type == 1:
-                    else:
-
-                        self.bms_reader.tx_identifier = 0xF000 | (new_id << 4) | 0xD
-                        self.bms_reader.rx_identifier = 0xF000 | (new_id << 4) | 0xA
-                        use_temporary_attach = True
-
                     try:
-
-                        if use_temporary_attach:
-                            msg = pack(">IBBH", self.bms_info.bms_id_int, 1, 1, new_id)
-                            logger.debug(f"send_new_aid {new_id:x}")
-                            self.bms_reader.can_bus.send_data(0xFB01, msg, True)
-
-                        selected_fw_type = self.bms_info.fw_type
-                        if data[2] is not None:
-                            selected_fw_type = data[2]
-
-                        logger.info(f"do fw update: {fw_version} fw_type: {selected_fw_type:02x}")
-                        self.update_fw_msg("Starting", 0)
-                        self.bms_reader.fw_update(fw_version, self.update_fw_msg, selected_fw_type)
-                        self.update_fw_msg("Done", 100)
-                        sleep(2)
-                        self.update_fw_msg("", -1)
+                        self.fw_sessions.start(fw_version, selected_fw_type, self.bms_info.bms_id_int,
+                                               self.bms_info.attach_status, self.bms_info.fw_type, self.update_fw_msg)
                     except Exception as e:
                         self.update_fw_msg(f"Failed: {e}", -2)
                         logger.error(f"UiCommand.FW_UPDATE error: {e}")
-                    pass
-
-                    if use_temporary_attach:
-                        msg = pack(">IBBH", self.bms_info.bms_id_int, 1, 2, 0)
-                        logger.debug(f"send_new_aid {new_id:x}")
-                        self.bms_reader.can_bus.send_data(0xFB01, msg, True)
 
                 elif data_cmd == UiCommand.POLL_REG:
-                    logger.debug(f"poll_reg: {data[1]:02x}")
+                    log_fields(logger, logging.DEBUG, "poll_reg", reg_id=data[1])
                     self.send_poll_reg(data[1])
                     pass
 
@@ -1633,6 +1577,7 @@ class MyWindow(QMainWindow):
             #     # logger.info(f"ms_stamp: {ms_stamp} to sleep: {time_to_sleep}")
             #     sleep(time_to_sleep)
 
+        self.bms_reader.can_bus.unsubscribe(rx_subscription)
         self.bms_reader.close_can()
 
     def update_checker(self):
@@ -1696,6 +1641,10 @@ class MyWindow(QMainWindow):
 
         print("Thread finished")
 
+        self.csv_logging.close()
+        if self.standalone and self.plot is not None:
+            self.plot.close()
+
         self.fw_update_dialog.close()
         self.bmsid_update_dialog.close()
         self.sensors_dialog.close()
@@ -0,0 +1,117 @@
+"""
+Control commands sent without waiting for the reply of the previous one.
+
+The BMS answers a command with its bytes 2-3 repeated and the result in byte 7 (77: done), so
+replies are matched to the commands by these bytes and several commands can be outstanding.
+"""
+import logging
+from collections import deque
+from time import monotonic
+
+from .can_dispatcher import FrameQueue
+from .tracing import log_fields
+
+logger = logging.getLogger('ack-tracker')
+
+ACK_OK = 77
+
+
+class CommandFailed(Exception):
+    pass
+
+
+class PendingCommand:
+    __slots__ = ("data", "error", "deadline")
+
+    def __init__(self, data, error, deadline):
+        self.data = data
+        self.error = error
+        self.deadline = deadline
+
+    @property
+    def key(self):
+        return self.data[2], self.data[3]
+
+
+class AckTracker:
+    """
+    Sends commands from tx_id and collects their replies on rx_id, use it in a with block.
+
+    send() does not wait, wait() returns when the commands sent so far are acknowledged and raises
+    CommandFailed with the error text of the first command that gets another result or no reply
+    within timeout_ms. Nothing is waited for after a failure, the commands still outstanding are dropped.
+    """
+
+    def __init__(self, can_bus, tx_id, rx_id, is_extended_id=True, timeout_ms=10000, latency=None):
+        self.can_bus = can_bus
+        self.tx_id = tx_id
+        self.rx_id = rx_id
+        self.is_extended_id = is_extended_id
+        self.timeout = timeout_ms / 1000
+        # a LatencyTracker, fed with the reply times of the commands
+        self.latency = latency
+        self.replies = FrameQueue()
+        self.subscription = None
+        # outstanding commands in the order they were sent
+        self.pending = deque()
+
+    def __enter__(self):
+        self.subscription = self.can_bus.subscribe(self.replies, self.rx_id)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.can_bus.unsubscribe(self.subscription)
+        self.subscription = None
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the outstanding commands and the replies received so far, before commands are sent again
+        """
+        self.pending.clear()
+        self.replies.clear()
+
+    def send(self, data, error):
+        """
+        Sends a command, error is the text of CommandFailed when it does not succeed
+        """
+        sent_at = monotonic()
+        self.can_bus.send_data(self.tx_id, data, self.is_extended_id, False)
+        self.pending.append(PendingCommand(data, error, sent_at + self.timeout))
+        log_fields(logger, logging.DEBUG, "command sent", tx_id=self.tx_id, data=data, outstanding=len(self.pending))
+
+    def command(self, data, error):
+        """
+        Sends a command and waits for all outstanding ones
+        """
+        self.send(data, error)
+        self.wait()
+
+    def wait(self):
+        while self.pending:
+            first = self.pending[0]
+            time_left = first.deadline - monotonic()
+            if time_left <= 0:
+                self.pending.clear()
+                raise CommandFailed(f"{first.error}: no reply")
+            msg = self.replies.get(time_left * 1000)
+            if msg is not None:
+                self.acknowledge(msg)
+
+    def acknowledge(self, msg):
+        if len(msg.data) < 8:
+            return
+        key = msg.data[2], msg.data[3]
+        # a reply belongs to the oldest outstanding command with the same bytes 2-3
+        command = next((command for command in self.pending if command.key == key), None)
+        if command is None:
+            log_fields(logger, logging.DEBUG, "reply discarded", rx_id=msg.arbitration_id, data=msg.data)
+            return
+        self.pending.remove(command)
+        if self.latency is not None:
+            self.latency.sample(self.rx_id, monotonic() - (command.deadline - self.timeout))
+        result = msg.data[7]
+        log_fields(logger, logging.DEBUG, "command reply", rx_id=msg.arbitration_id, data=msg.data, result=result)
+        if result != ACK_OK:
+            self.pending.clear()
+            raise CommandFailed(f"{command.error} ({result})")
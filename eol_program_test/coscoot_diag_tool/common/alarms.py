@@ -0,0 +1,319 @@
+"""
+Alarm rules evaluated when the fields they read change.
+
+A rule raises its alarm when a value reaches the high (or low) threshold and clears it only after
+the value has moved `hysteresis` back, a change of state has to last `debounce` seconds. Every
+raise and clear is an AlarmEvent handed to the listeners of the engine (widgets, CSV log, error log).
+"""
+import logging
+from enum import IntEnum
+from .bmsinfo import BmsInfo, ERROR_FLAGS, BQ_SYS_STAT_FLAGS
+from .cells import MAX_CELLS
+from .helper import utc_time_seconds
+
+logger = logging.getLogger('alarms')
+
+
+class Severity(IntEnum):
+    INFO = 0
+    WARNING = 1
+    ERROR = 2
+
+
+# temperatures the average temperature is calculated from
+AVG_TEMP_INPUTS = ("bms_id_int", "hw_type", "pack_left_temp", "pack_right_temp", "pack_center_temp",
+                   "temp_ts_1", "temp_ts_2", "temp_ts_3")
+
+# temperatures with high and low alarms, all but the FET temperature also by their difference to the average
+TEMPERATURE_FIELDS = ("fet_temp", "pack_left_temp", "pack_center_temp", "pack_right_temp", "temp_ts_1", "temp_ts_2",
+                      "temp_ts_3", "pack_temp_4", "pack_temp_5", "pack_temp_6")
+
+DEFAULT_OVERVOLTAGE_LIMIT = 4040
+DEFAULT_UNDERVOLTAGE_LIMIT = 3000
+
+
+def avg_temperature(bms: BmsInfo):
+    """
+    Average of the pack temperatures without the lowest and highest one, None when less than 3 are known
+    """
+    if bms.bms_id_int == 0:
+        return None
+
+    temperatures = [bms.pack_left_temp, bms.pack_right_temp, bms.pack_center_temp]
+
+    if bms.hw_type == 1 or bms.hw_type == 2:
+        temperatures.append(bms.temp_ts_1)
+        temperatures.append(bms.temp_ts_2)
+        temperatures.append(bms.temp_ts_3)
+
+    temperatures = [temp for temp in temperatures if temp is not None]
+    if len(temperatures) < 3:
+        return None
+
+    temperatures.sort()
+    temperatures = temperatures[1:-1]
+    return sum(temperatures) / len(temperatures)
+
+
+class AlarmRule:
+    """
+    value(model) gives the checked value, None (unknown) clears the alarm at once.
+    high and low are numbers or functions of the model. target is what the alarm marks
+    (a field or widget name), text the message, formatted with the value.
+    With inclusive off the alarm is raised only beyond the thresholds, not when the value equals them.
+    """
+
+    def __init__(self, name, inputs, value, severity=Severity.WARNING, high=None, low=None, hysteresis=0,
+                 debounce=0.0, text=None, target=None, inclusive=True):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.value = value
+        self.severity = severity
+        self.high = high
+        self.low = low
+        self.hysteresis = hysteresis
+        self.debounce = debounce
+        self.text = name if text is None else text
+        self.target = self.inputs[0] if target is None else target
+        self.inclusive = inclusive
+
+    def check(self, model, value, active):
+        """
+        State of the alarm for value, active is the current state
+        """
+        if value is None:
+            return False
+        if self.high is not None:
+            high = self.high(model) if callable(self.high) else self.high
+            if value > high or (self.inclusive and value == high) or (active and value > high - self.hysteresis):
+                return True
+        if self.low is not None:
+            low = self.low(model) if callable(self.low) else self.low
+            if value < low or (self.inclusive and value == low) or (active and value < low + self.hysteresis):
+                return True
+        return False
+
+
+class AlarmEvent:
+    """
+    An alarm raised (active) or cleared, raised is the event that raised a cleared alarm
+    """
+
+    __slots__ = ("timestamp", "source", "rule", "active", "value", "raised")
+
+    def __init__(self, timestamp, source, rule: AlarmRule, active, value, raised=None):
+        self.timestamp = timestamp
+        self.source = source
+        self.rule = rule
+        self.active = active
+        self.value = value
+        self.raised = raised
+
+    @property
+    def name(self):
+        return self.rule.name
+
+    @property
+    def severity(self):
+        return self.rule.severity
+
+    @property
+    def target(self):
+        return self.rule.target
+
+    def text(self):
+        if self.raised is not None:
+            return f"{self.raised.text()} cleared"
+        try:
+            return self.rule.text.format(value=self.value)
+        except (ValueError, TypeError):
+            return self.rule.text
+
+    def to_csv(self):
+        return f"{self.timestamp:.3f};{self.source};{self.name};{self.severity.name};{int(self.active)};" \
+               f"{'' if self.value is None else self.value};{self.text()}"
+
+
+class AlarmEngine:
+    """
+    Rules of one data object (a battery, the vehicle). update() evaluates only the rules reading a
+    changed field and the ones waiting for their debounce time, so the cost follows the changes
+    and not how often the data is shown.
+    """
+
+    def __init__(self, rules, source=""):
+        self.rules = list(rules)
+        self.source = source
+        self.by_field = {}
+        for rule in self.rules:
+            for field in rule.inputs:
+                self.by_field.setdefault(field, []).append(rule)
+        # rule name: the event that raised it
+        self.active = {}
+        # rule: time its condition started to differ from the alarm state
+        self.pending = {}
+        self.listeners = []
+
+    def subscribe(self, listener):
+        """
+        listener(event) is called for every raised and cleared alarm
+        """
+        self.listeners.append(listener)
+
+    def affected(self, changed):
+        rules = dict.fromkeys(self.pending)
+        for field in changed:
+            for rule in self.by_field.get(field, ()):
+                rules[rule] = None
+        return rules
+
+    def update(self, model, changed=None, timestamp=None):
+        """
+        changed: names of the changed fields, all rules are evaluated when not given.
+        Returns the events of this update.
+        """
+        if timestamp is None:
+            timestamp = utc_time_seconds()
+        rules = self.rules if changed is None else self.affected(changed)
+
+        events = []
+        for rule in rules:
+            active = rule.name in self.active
+            value = rule.value(model)
+            if rule.check(model, value, active) == active:
+                self.pending.pop(rule, None)
+                continue
+            since = self.pending.setdefault(rule, timestamp)
+            if value is not None and timestamp - since < rule.debounce:
+                continue
+            del self.pending[rule]
+            if active:
+                event = AlarmEvent(timestamp, self.source, rule, False, value, self.active.pop(rule.name))
+            else:
+                event = AlarmEvent(timestamp, self.source, rule, True, value)
+                self.active[rule.name] = event
+            events.append(event)
+
+        for event in events:
+            for listener in self.listeners:
+                try:
+                    listener(event)
+                except Exception as e:
+                    logger.error(f"alarm listener: {e}")
+        return events
+
+    def severity(self, target):
+        """
+        Highest severity of the active alarms of a target, None when there is none
+        """
+        severities = [event.severity for event in self.active.values() if event.target == target]
+        return max(severities) if severities else None
+
+
+def field_value(field):
+    return lambda model: getattr(model, field)
+
+
+def flag_value(field, bit):
+    def value(model):
+        flags = getattr(model, field)
+        return None if flags is None else int(flags & bit != 0)
+    return value
+
+
+def temperature_diff(field):
+    def value(bms):
+        temp, avg = getattr(bms, field), avg_temperature(bms)
+        return None if temp is None or avg is None else abs(temp - avg)
+    return value
+
+
+def cell_voltage(cell):
+    def value(bms):
+        cells = bms.cell_voltages
+        return cells[cell] if cell < len(cells) else None
+    return value
+
+
+def cell_diff(bms: BmsInfo):
+    if bms.cell_voltage_highest is None or bms.cell_voltage_lowest is None:
+        return None
+    return abs(bms.cell_voltage_highest - bms.cell_voltage_lowest)
+
+
+def overvoltage_limit(bms: BmsInfo):
+    return bms.overvoltage_limit or DEFAULT_OVERVOLTAGE_LIMIT
+
+
+def undervoltage_limit(bms: BmsInfo):
+    return bms.undervoltage_limit or DEFAULT_UNDERVOLTAGE_LIMIT
+
+
+def bms_rules(config):
+    """
+    The battery rules, thresholds from [APP] warning_*, hysteresis and debounce from [ALARMS]
+    """
+    temp_high = config.get('APP', 'warning_temp_high', 44, int)
+    temp_low = config.get('APP', 'warning_temp_low', 4, int)
+    temp_diff = config.get('APP', 'warning_temp_diff', 7, int)
+    fet_temp_high = config.get('APP', 'warning_fet_temp_high', 65, int)
+    usb_temp_high = config.get('APP', 'warning_usb_temp_high', 65, int)
+    temp_hysteresis = config.get('ALARMS', 'temp_hysteresis', 1, int)
+    cell_hysteresis = config.get('ALARMS', 'cell_hysteresis', 10, int)
+    debounce = config.get('ALARMS', 'debounce', 1.0, float)
+
+    rules = []
+    for field in TEMPERATURE_FIELDS:
+        high = fet_temp_high if field == "fet_temp" else temp_high
+        rules.append(AlarmRule(f"{field}_high", [field], field_value(field), Severity.ERROR, high=high,
+                               hysteresis=temp_hysteresis, debounce=debounce, text=f"{field} high {{value}} °C"))
+        rules.append(AlarmRule(f"{field}_low", [field], field_value(field), Severity.INFO, low=temp_low,
+                               hysteresis=temp_hysteresis, debounce=debounce, text=f"{field} low {{value}} °C"))
+        if field != "fet_temp":
+            rules.append(AlarmRule(f"{field}_diff", (field,) + AVG_TEMP_INPUTS, temperature_diff(field),
+                                   Severity.WARNING, high=temp_diff, hysteresis=temp_hysteresis, debounce=debounce,
+                                   target=field, text=f"{field} differs {{value:.1f}} °C from the average"))
+    rules.append(AlarmRule("temp_usb_high", ["temp_usb"], field_value("temp_usb"), Severity.ERROR, high=usb_temp_high,
+                           hysteresis=temp_hysteresis, debounce=debounce, text="temp_usb high {value} °C"))
+
+    # a cell voltage or difference equal to its limit is not an alarm yet, the temperatures are
+    diff_inputs = ["cell_voltage_highest", "cell_voltage_lowest"]
+    rules.append(AlarmRule("cell_diff_warn", diff_inputs, cell_diff, Severity.WARNING, high=45,
+                           hysteresis=cell_hysteresis, debounce=debounce, target="cell_diff", inclusive=False,
+                           text="Cell voltage difference {value} mV"))
+    rules.append(AlarmRule("cell_diff_error", diff_inputs, cell_diff, Severity.ERROR, high=100,
+                           hysteresis=cell_hysteresis, debounce=debounce, target="cell_diff", inclusive=False,
+                           text="Cell voltage difference {value} mV"))
+
+    for cell in range(MAX_CELLS):
+        rules.append(AlarmRule(f"cell_{cell + 1}_overvoltage", ["cell_voltages", "overvoltage_limit"],
+                               cell_voltage(cell), Severity.ERROR, high=overvoltage_limit, hysteresis=cell_hysteresis,
+                               debounce=debounce, target=f"cell_{cell + 1}", inclusive=False,
+                               text=f"Cell {cell + 1} overvoltage {{value}} mV"))
+        rules.append(AlarmRule(f"cell_{cell + 1}_undervoltage", ["cell_voltages", "undervoltage_limit"],
+                               cell_voltage(cell), Severity.ERROR, low=undervoltage_limit, hysteresis=cell_hysteresis,
+                               debounce=debounce, target=f"cell_{cell + 1}", inclusive=False,
+                               text=f"Cell {cell + 1} undervoltage {{value}} mV"))
+
+    rules.extend(flag_rules())
+    return rules
+
+
+def flag_rules():
+    """
+    A rule per error_flags and primary protection (bq_sys_stat) bit, not debounced
+    """
+    rules = [AlarmRule(f"error_{bit:02x}", ["error_flags"], flag_value("error_flags", bit), Severity.ERROR, high=1,
+                       text=text) for bit, text in ERROR_FLAGS]
+    rules.extend(AlarmRule(f"bq_{bit:02x}", ["bq_sys_stat"], flag_value("bq_sys_stat", bit), Severity.ERROR, high=1,
+                           text=f"[Primary] {text}") for bit, text in BQ_SYS_STAT_FLAGS)
+    return rules
+
+
+def vehicle_rules():
+    """
+    Batteries seen on the bus that are not attached to the vehicle
+    """
+    return [AlarmRule(f"unattached_battery_{slot}", [f"unattached_battery_{slot}_id"],
+                      field_value(f"unattached_battery_{slot}_id"), Severity.WARNING, high=1,
+                      text="Unattached battery detected! ID: {value:08X}") for slot in ("one", "two")]
@@ -4,6 +4,7 @@ from math import floor
 
 # import psutil
 
+from .cells import CellModel
 from .helper import utc_time_seconds
 from .settings import settings
 
@@ -16,9 +17,30 @@ import random
 warn_cell_voltage_diff = 89
 warn_temperature_diff = 10
 
+# cell columns of the csv files and logs, a pack with more cells logs its first CELL_COUNT cells
+CELL_COUNT = 12
+
+# error_flags bits
+ERROR_FLAGS = ((0x01, "Initial config error"),
+               (0x02, "Requested off error"),
+               (0x04, "Primary error present"),
+               (0x08, "Precharge error"),
+               (0x10, "Undervoltage error"),
+               (0x20, "Overvoltage error"),
+               (0x40, "Overcurrent error"),
+               (0x80, "Overtemperature error"))
+
+# bq_sys_stat bits (masked with 0x3F), primary protection chip
+BQ_SYS_STAT_FLAGS = ((0x01, "Overcurrent detected"),
+                     (0x02, "Short circuit detected"),
+                     (0x04, "Cell overvoltage detected"),
+                     (0x08, "Cell undervoltage detected"),
+                     (0x10, "Alert pin external override detected"),
+                     (0x20, "Internal chip fault detected"))
+
 
 def to_ui(value, unit: str = "", divider: int = 1, rounding: int = 0):
-    if value != "":
+    if value is not None:
         if value < 0 < rounding:
             rounding -= 1
         val = round(value / divider, rounding)
@@ -29,6 +51,13 @@ def to_ui(value, unit: str = "", divider: int = 1, rounding: int = 0):
         return f"{val}{unit}"
     return ""
 
+
+def to_text(value):
+    """
+    Display and CSV text of a field, unknown (None) is empty
+    """
+    return "" if value is None else f"{value}"
+
 #
 # def get_cpu_temp():
 #     cpu_temp = 0
@@ -50,6 +79,22 @@ def to_ui(value, unit: str = "", divider: int = 1, rounding: int = 0):
 #     return uptime() / 3600 / 24
 
 
+# columns of to_csv_test(), cell voltages are cell_1 ... cell_12
+CSV_TEST_COLUMNS = ("timestamp", "ambient_temp", "pack_state", "attach_status", "error_flags", "pack_soc", "voltage",
+                    "current", "bq_sys_stat", "cycle_count", "coulomb_soc", "available_capacity",
+                    *(f"cell_{i + 1}" for i in range(CELL_COUNT)), "balance_pattern", "cap_sense_fill_time",
+                    "fet_temp", "pack_left_temp", "pack_center_temp", "pack_right_temp", "temp_ts_1", "temp_ts_2",
+                    "temp_ts_3", "temp_usb")
+
+
+def log_cells(cells):
+    """
+    Exactly CELL_COUNT cell voltages for the fixed log columns, missing cells are None
+    """
+    cells = tuple(cells[:CELL_COUNT])
+    return cells + (None,) * (CELL_COUNT - len(cells))
+
+
 def battery_test_csv_headers():
     return "timestamp,cell_1_v,cell_2_v,cell_3_v,cell_4_v,cell_5_v,cell_6_v,cell_7_v,cell_8_v,cell_9_v,cell_10_v,cell_11_v,cell_12_v,pack_current,pack_center_temp,ambient_temp"
 
@@ -88,71 +133,89 @@ class BmsInfo:
         cell_voltage_highest
         min_cell_no
         max_cell_no
+
+        Unknown values are None. Fields are slots, the worker thread hands the GUI thread snapshot()s
+        instead of deep copies. cell_voltages is a CellModel and cell_deltas its per-cell changes,
+        both are tuples in a snapshot.
     """
 
+    __slots__ = ("timestamp", "connected_bat", "charging_bat", "slot_no", "bms_id", "bms_id_int", "pack_state",
+                 "attach_status", "error_flags", "pack_soc", "fet_temp", "pack_left_temp", "pack_center_temp",
+                 "pack_right_temp", "voltage", "current", "bq_sys_stat", "precharge_result", "cycle_count",
+                 "coulomb_soc", "available_capacity", "collected_regen", "cell_voltages", "cell_deltas",
+                 "cell_voltage_avg", "cell_voltage_lowest", "cell_voltage_highest", "min_cell_no", "max_cell_no",
+                 "balance_state", "balance_pattern", "cap_sense_fill_time", "temp_ts_1", "temp_ts_2", "temp_ts_3",
+                 "temp_usb", "pack_temp_4", "pack_temp_5", "pack_temp_6", "attach_pin_voltage", "unix_time",
+                 "time_diff", "bms_sw_version", "sw_upgrade_text", "relay_board", "can_bus", "ambient_temp",
+                 "up_time", "cpu_usage", "cpu_temp", "mem_usage", "storage_usage", "can_problem", "is_slow_charging",
+                 "flash_write_count", "bms_unread_error_count", "production_date", "production_message", "is_reg_fc",
+                 "pcb_version", "fw_type", "hw_type", "sw_profile", "temp_sensor_mask", "overvoltage_limit",
+                 "undervoltage_limit", "digipot_value", "version", "last_snapshot")
+
     # [START __init__]
-    def __init__(self, slot_no=""):
+    def __init__(self, slot_no=None):
         # timestamp - seconds since unix epoch
         self.timestamp = utc_time_seconds()
         # connected_bat - how many batteries currently connected
-        self.connected_bat = ""
+        self.connected_bat = None
         # charging_bat - how many batteries currently charging
-        self.charging_bat = ""
+        self.charging_bat = None
         # slot_no - slot no of current BMS
         self.slot_no = slot_no
-        self.bms_id = ""
+        self.bms_id = None
         self.bms_id_int = 0
-        self.pack_state = ""
-        self.attach_status = ""
-        self.error_flags = ""
+        self.pack_state = None
+        self.attach_status = None
+        self.error_flags = None
         # battery State Of Charge
-        self.pack_soc = ""
-        self.fet_temp = ""
-        self.pack_left_temp = ""
-        self.pack_center_temp = ""
-        self.pack_right_temp = ""
-        self.voltage = ""
-        self.current = ""
-        self.bq_sys_stat = ""
-        self.precharge_result = ""
-        self.cycle_count = ""
-        self.coulomb_soc = ""
-        self.available_capacity = ""
-        self.collected_regen = ""
-        self.cell_voltages = {0: "", 1: "", 2: "", 3: "", 4: "", 5: "", 6: "", 7: "", 8: "", 9: "", 10: "", 11: ""}
-        self.cell_voltage_avg = ""
-        self.cell_voltage_lowest = ""
-        self.cell_voltage_highest = ""
-        self.min_cell_no = ""
-        self.max_cell_no = ""
-        self.balance_state = ""
-        self.balance_pattern = ""
-        self.cap_sense_fill_time = ""
-
-        self.temp_ts_1 = ""
-        self.temp_ts_2 = ""
-        self.temp_ts_3 = ""
-        self.temp_usb = ""
-
-        self.pack_temp_4 = ""
-        self.pack_temp_5 = ""
-        self.pack_temp_6 = ""
-
-        self.attach_pin_voltage = ""
-
-        self.unix_time = ""
-        self.time_diff = ""
+        self.pack_soc = None
+        self.fet_temp = None
+        self.pack_left_temp = None
+        self.pack_center_temp = None
+        self.pack_right_temp = None
+        self.voltage = None
+        self.current = None
+        self.bq_sys_stat = None
+        self.precharge_result = None
+        self.cycle_count = None
+        self.coulomb_soc = None
+        self.available_capacity = None
+        self.collected_regen = None
+        self.cell_voltages = CellModel()
+        self.cell_deltas = self.cell_voltages.deltas
+        self.cell_voltage_avg = None
+        self.cell_voltage_lowest = None
+        self.cell_voltage_highest = None
+        self.min_cell_no = None
+        self.max_cell_no = None
+        self.balance_state = None
+        self.balance_pattern = None
+        self.cap_sense_fill_time = None
+
+        self.temp_ts_1 = None
+        self.temp_ts_2 = None
+        self.temp_ts_3 = None
+        self.temp_usb = None
+
+        self.pack_temp_4 = None
+        self.pack_temp_5 = None
+        self.pack_temp_6 = None
+
+        self.attach_pin_voltage = None
+
+        self.unix_time = None
+        self.time_diff = None
 
         self.bms_sw_version = 0
-        self.sw_upgrade_text = ""
-        self.relay_board = ""
-        self.can_bus = ""
-        self.ambient_temp = ""
-        self.up_time = ""
-        self.cpu_usage = ""
-        self.cpu_temp = ""
-        self.mem_usage = ""
-        self.storage_usage = ""
+        self.sw_upgrade_text = None
+        self.relay_board = None
+        self.can_bus = None
+        self.ambient_temp = None
+        self.up_time = None
+        self.cpu_usage = None
+        self.cpu_temp = None
+        self.mem_usage = None
+        self.storage_usage = None
         self.can_problem = False
 
         self.is_slow_charging = False
@@ -160,21 +223,46 @@ class BmsInfo:
         self.flash_write_count = 0
         self.bms_unread_error_count = 0
 
-        self.production_date = ""
-        self.production_message = ""
+        self.production_date = None
+        self.production_message = None
         self.is_reg_fc = False
         self.pcb_version = 0
         self.fw_type = 0
         self.hw_type = 0
         self.sw_profile = 0
 
-        self.temp_sensor_mask = ""
-        self.overvoltage_limit = ""
-        self.undervoltage_limit = ""
-        self.digipot_value = ""
+        self.temp_sensor_mask = None
+        self.overvoltage_limit = None
+        self.undervoltage_limit = None
+        self.digipot_value = None
+
+        # bumped by every change, snapshots are reused while it stays the same
+        self.version = 0
+        self.last_snapshot = None
 
     # [END __init__]
 
+    def changed(self):
+        """
+        Call after modifying fields, outdates the last snapshot
+        """
+        self.version += 1
+
+    def snapshot(self):
+        """
+        Shallow read-only copy for another thread, the same copy is returned until the next changed()
+        """
+        snapshot = self.last_snapshot
+        if snapshot is None or snapshot.version != self.version:
+            snapshot = BmsInfo.__new__(BmsInfo)
+            for name in BmsInfo.__slots__:
+                setattr(snapshot, name, getattr(self, name))
+            snapshot.cell_voltages = tuple(self.cell_voltages)
+            snapshot.cell_deltas = tuple(self.cell_deltas)
+            snapshot.last_snapshot = None
+            self.last_snapshot = snapshot
+        return snapshot
+
     # def update_stats(self):
     #     self.up_time = get_uptime()
     #     self.cpu_usage = cpu_load()
@@ -184,40 +272,48 @@ class BmsInfo:
 
     # [START to_csv]
     def to_csv(self):
-        v = self.cell_voltages
+        v = log_cells(self.cell_voltages)
         ambient = ""
-        if self.ambient_temp != "":
+        if self.ambient_temp is not None:
             ambient = f"{self.ambient_temp:.1f}"
         return f"{floor(self.timestamp)};{self.cpu_usage};{self.cpu_temp:.1f};{self.mem_usage:.1f};{self.storage_usage:.1f};{self.connected_bat};{self.charging_bat};{self.slot_no + 1};{self.up_time:.3f};{self.relay_board};{self.can_bus};{ambient};{self.bms_id};{self.pack_state};{self.attach_status};{self.error_flags};{self.pack_soc};{self.fet_temp};{self.pack_left_temp};{self.pack_center_temp};{self.pack_right_temp};{self.voltage};{self.current};{self.bq_sys_stat};{self.cycle_count};{self.coulomb_soc};{self.available_capacity};{v[0]};{v[1]};{v[2]};{v[3]};{v[4]};{v[5]};{v[6]};{v[7]};{v[8]};{v[9]};{v[10]};{v[11]};{self.balance_pattern};{self.cap_sense_fill_time}"
 
     # [END to_csv]
 
-    def to_csv_test(self):
-        v = self.cell_voltages
+    def to_csv_test(self, timestamp=None):
+        if timestamp is None:
+            timestamp = self.timestamp
+        v = log_cells(self.cell_voltages)
         ambient = ""
-        if self.ambient_temp != "":
+        if self.ambient_temp is not None:
             ambient = f"{self.ambient_temp:.1f}"
 
-        return f"{self.timestamp:.3f};{ambient};{self.pack_state};{self.attach_status};{self.error_flags};{self.pack_soc};{self.voltage};{self.current};{self.bq_sys_stat};{self.cycle_count};{self.coulomb_soc};{self.available_capacity};{v[0]};{v[1]};{v[2]};{v[3]};{v[4]};{v[5]};{v[6]};{v[7]};{v[8]};{v[9]};{v[10]};{v[11]};{self.balance_pattern};{self.cap_sense_fill_time};{self.fet_temp};{self.pack_left_temp};{self.pack_center_temp};{self.pack_right_temp};{self.temp_ts_1};{self.temp_ts_2};{self.temp_ts_3};{self.temp_usb}"
+        values = (self.pack_state, self.attach_status, self.error_flags, self.pack_soc, self.voltage, self.current,
+                  self.bq_sys_stat, self.cycle_count, self.coulomb_soc, self.available_capacity, *v,
+                  self.balance_pattern, self.cap_sense_fill_time, self.fet_temp, self.pack_left_temp,
+                  self.pack_center_temp, self.pack_right_temp, self.temp_ts_1, self.temp_ts_2, self.temp_ts_3,
+                  self.temp_usb)
+        return f"{timestamp:.3f};{ambient};" + ";".join(to_text(value) for value in values)
 
     def to_battery_test_csv(self, start_time=0):
-        v = self.cell_voltages
-        ambient = f"{self.ambient_temp:.1f}" if self.ambient_temp != "" else ""
+        v = log_cells(self.cell_voltages)
+        ambient = f"{self.ambient_temp:.1f}" if self.ambient_temp is not None else ""
         return f"{self.timestamp-start_time:.3f},{v[0]/1000:.3f},{v[1]/1000:.3f},{v[2]/1000:.3f},{v[3]/1000:.3f},{v[4]/1000:.3f},{v[5]/1000:.3f},{v[6]/1000:.3f},{v[7]/1000:.3f},{v[8]/1000:.3f},{v[9]/1000:.3f},{v[10]/1000:.3f},{v[11]/1000:.3f},{self.current/1000:.3f},{self.pack_center_temp},{ambient}"
 
     def is_connected(self):
-        return self.pack_state != ""
+        return self.pack_state is not None
 
     def set_disconnected(self):
-        self.pack_state = ""
+        self.pack_state = None
+        self.changed()
 
     def is_charging(self):
-        if self.pack_state != "":
+        if self.pack_state is not None:
             return self.pack_state == 4 or self.pack_state == 5 or self.is_slow_charge()
         return False
 
     def is_attached(self):
-        if self.attach_status != "":
+        if self.attach_status is not None:
             return self.attach_status == 6 or self.pack_state == 3 or 0x20 <= self.attach_status <= 0x4F
         return False
 
@@ -228,13 +324,13 @@ class BmsInfo:
         return self.is_slow_charging
 
     def is_reg_c1(self):
-        return self.current != ""
+        return self.current is not None
 
     def is_reg_c3(self):
-        return self.precharge_result != ""
+        return self.precharge_result is not None
 
     def is_reg_c4(self):
-        return self.cell_voltage_avg != ""
+        return self.cell_voltage_avg is not None
 
     def lowest_temp(self):
         return min(self.pack_center_temp, self.pack_left_temp, self.pack_right_temp)
@@ -243,7 +339,7 @@ class BmsInfo:
         return max(self.pack_center_temp, self.pack_left_temp, self.pack_right_temp)
 
     def current_int(self):
-        return self.current if self.current != "" else 0
+        return self.current if self.current is not None else 0
 
     def ui_current(self):
         return to_ui(self.current, "A", 1000, 2)
@@ -276,16 +372,16 @@ class BmsInfo:
 
 
     def ui_bms_id(self):
-        return "N/A" if self.bms_id == "" else self.bms_id.upper()
+        return "N/A" if self.bms_id is None else self.bms_id.upper()
 
     def ui_soc_int(self):
-        return 0 if self.pack_soc == "" else self.pack_soc
+        return 0 if self.pack_soc is None else self.pack_soc
 
     def ui_error_flags(self):
-        return 0 if self.error_flags == "" else self.error_flags
+        return 0 if self.error_flags is None else self.error_flags
 
     def ui_error_bq_flags(self):
-        return 0 if self.bq_sys_stat == "" else self.bq_sys_stat
+        return 0 if self.bq_sys_stat is None else self.bq_sys_stat
 
     def is_errors(self):
         return self.ui_error_flags() != 0
@@ -302,7 +398,7 @@ class BmsInfo:
         return False
 
     def is_updatable(self, version: int, custom_address: bool = False):
-        if version == 0 or self.bms_sw_version == "":
+        if version == 0 or self.bms_sw_version is None:
             return False
         if self.is_slow_charging:
             return False
@@ -319,35 +415,25 @@ class BmsInfo:
 
         return ret_val
 
+    def set_cell_count(self, count):
+        if count != len(self.cell_voltages):
+            self.cell_voltages.resize(count)
+
     def calculate_cells(self):
-        if self.cell_voltages[0] != "" and self.cell_voltages[4] != "" and self.cell_voltages[8] != "":
-            avg = 0
-            min_v = 0xFFFF
-            max_v = 0
-            min_c = 0
-            max_c = 0
-
-            for i, v in self.cell_voltages.items():
-                avg += v
-                if v < min_v:
-                    min_v = v
-                    min_c = i+1
-
-                if v > max_v:
-                    max_v = v
-                    max_c = i+1
-
-            self.cell_voltage_avg = round(avg/12)
-            self.cell_voltage_lowest = min_v
-            self.cell_voltage_highest = max_v
-            self.min_cell_no = min_c
-            self.max_cell_no = max_c
+        cells = self.cell_voltages
+        if cells.complete():
+            lowest, highest = cells.lowest_cell(), cells.highest_cell()
+            self.cell_voltage_avg = cells.average()
+            self.cell_voltage_lowest = cells.voltages[lowest]
+            self.cell_voltage_highest = cells.voltages[highest]
+            self.min_cell_no = lowest + 1
+            self.max_cell_no = highest + 1
 
     def ui_balance_pattern(self):
-        return 0 if self.balance_pattern == "" else self.balance_pattern
+        return 0 if self.balance_pattern is None else self.balance_pattern
 
     def ui_moisture_count(self):
-        return 0 if self.cap_sense_fill_time == "" else (self.cap_sense_fill_time * 0.01)
+        return 0 if self.cap_sense_fill_time is None else (self.cap_sense_fill_time * 0.01)
 
 # [END class BmsInfo]
 
@@ -0,0 +1,156 @@
+import logging
+import threading
+from queue import Queue, Empty
+from time import sleep
+
+from can import Message, CanError
+
+from .mvar import LockableBoolean
+from .tracing import TRACE_RX, log_fields
+
+logger = logging.getLogger('can-dispatcher')
+
+MASK_EXACT = 0x1FFFFFFF
+# BMS registers: left battery 0x2xx, right battery 0x1xx
+MASK_BMS = 0x1FFFFF00
+
+
+class Subscription:
+    """
+    Handler registered for all frames where (arbitration_id & mask) == (id & mask)
+    """
+
+    def __init__(self, handler, arbitration_id: int, mask: int):
+        self.handler = handler
+        self.arbitration_id = arbitration_id & mask
+        self.mask = mask
+
+    def matches(self, arbitration_id: int) -> bool:
+        return arbitration_id & self.mask == self.arbitration_id
+
+
+class FrameQueue:
+    """
+    Frame handler that hands received frames over to another thread.
+
+    Frames are never dropped, the consumer blocks in get() instead of spinning on the bus.
+    """
+
+    def __init__(self):
+        self.queue = Queue()
+
+    def __call__(self, msg: Message):
+        self.queue.put(msg)
+
+    def get(self, timeout_in_ms=0):
+        try:
+            if timeout_in_ms <= 0:
+                return self.queue.get(False)
+            return self.queue.get(True, timeout_in_ms / 1000)
+        except Empty:
+            return None
+
+    def clear(self):
+        while self.get(0) is not None:
+            pass
+
+
+class CanDispatcher:
+    """
+    Owns the receive side of PyCan.bus and calls the registered handlers for every frame.
+
+    Handlers are called from the receive thread, they must not block.
+    Exact-ID subscriptions are looked up from a dict, masked subscriptions are checked in order.
+    """
+
+    def __init__(self, can_bus, rx_timeout_ms=500):
+        self.can_bus = can_bus
+        self.rx_timeout = rx_timeout_ms / 1000
+
+        self.lock = threading.RLock()
+        # copy-on-write tables, the receive thread reads them without locking
+        self.exact_subscriptions = {}
+        self.masked_subscriptions = []
+
+        self.running = LockableBoolean()
+        self.thread = None
+
+    def subscribe(self, handler, arbitration_id: int, mask: int = None) -> Subscription:
+        if mask is None:
+            mask = MASK_EXACT
+
+        subscription = Subscription(handler, arbitration_id, mask)
+        with self.lock:
+            if mask == MASK_EXACT:
+                exact = dict(self.exact_subscriptions)
+                exact[subscription.arbitration_id] = exact.get(subscription.arbitration_id, ()) + (subscription,)
+                self.exact_subscriptions = exact
+            else:
+                self.masked_subscriptions = self.masked_subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            exact = dict(self.exact_subscriptions)
+            subscriptions = exact.get(subscription.arbitration_id, ())
+            if subscription in subscriptions:
+                subscriptions = tuple(s for s in subscriptions if s is not subscription)
+                if subscriptions:
+                    exact[subscription.arbitration_id] = subscriptions
+                else:
+                    del exact[subscription.arbitration_id]
+                self.exact_subscriptions = exact
+            self.masked_subscriptions = [s for s in self.masked_subscriptions if s is not subscription]
+
+    def dispatch(self, msg: Message):
+        arbitration_id = msg.arbitration_id
+        for subscription in self.exact_subscriptions.get(arbitration_id, ()):
+            self.call_handler(subscription, msg)
+
+        for subscription in self.masked_subscriptions:
+            if subscription.matches(arbitration_id):
+                self.call_handler(subscription, msg)
+
+    @staticmethod
+    def call_handler(subscription: Subscription, msg: Message):
+        try:
+            subscription.handler(msg)
+        except Exception as e:
+            log_fields(logger, logging.ERROR, "handler failed", arbitration_id=msg.arbitration_id, error=e)
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name="can-rx", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2 * self.rx_timeout + 1)
+        self.thread = None
+
+    def run(self):
+        while self.running.get():
+            try:
+                # blocks in the driver, no CPU is used while the bus is quiet
+                msg = self.can_bus.bus.recv(self.rx_timeout)
+            except CanError as e:
+                self.can_bus.can_status = 0
+                logger.error(f"Message NOT received, canerror! {e}")
+                sleep(1)
+                continue
+            except Exception as e:
+                logger.error(f"receive failed: {e}")
+                sleep(1)
+                continue
+
+            if msg is None or msg.is_error_frame or not len(msg.data):
+                continue
+
+            trace = self.can_bus.trace
+            if trace.enabled:
+                trace.record(msg, TRACE_RX)
+
+            self.dispatch(msg)
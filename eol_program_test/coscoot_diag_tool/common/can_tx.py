@@ -0,0 +1,171 @@
+import logging
+import threading
+from concurrent.futures import Future
+from itertools import count
+from queue import PriorityQueue, Empty, Full
+from time import monotonic, sleep
+
+from can import Message, CanError
+
+from .helper import TransmitBufferFull
+from .mvar import LockableBoolean
+from .tracing import TRACE_TX, log_fields
+
+logger = logging.getLogger('can-tx')
+
+# lower value is sent first
+PRIORITY_CONTROL = 0
+PRIORITY_POLL = 1
+PRIORITY_BULK = 2
+
+
+def is_buffer_full_error(e: CanError):
+    error_str = str(e)
+    # [Errno 105] No buffer space available
+    return error_str.find("[Errno 105]") >= 0 or error_str.find("Transmit buffer overflow") >= 0 or error_str.find("[Error Code 105]") >= 0
+
+
+def frame_bits(msg: Message):
+    """
+    Worst case bits on the wire including bit stuffing
+    """
+    if msg.is_extended_id:
+        bits = 67 + 8 * msg.dlc
+    else:
+        bits = 47 + 8 * msg.dlc
+    return bits * 6 // 5
+
+
+class TxRequest:
+    def __init__(self, msg: Message, update_can_status: bool):
+        self.msg = msg
+        self.update_can_status = update_can_status
+        self.future = Future()
+
+
+class TxScheduler:
+    """
+    Paced transmit queue in front of PyCan.bus.
+
+    Frames are sent in priority order (control commands before polls before firmware blocks),
+    a token bucket keeps our own traffic below max_bus_load percent of the bitrate and a full
+    driver buffer is waited out here instead of being raised to every caller.
+    The returned futures complete when the frame has been accepted by the driver.
+
+    Frames of the same priority can belong to a flow (e.g. a firmware update session). Flows get
+    turns frame by frame (start time fair queuing), so one flow queueing a long burst does not hold
+    back the others. Frames without a flow are queued in order at the current virtual time.
+    """
+
+    def __init__(self, can_bus, bitrate, max_bus_load=50, queue_size=256, retry_timeout_ms=1000):
+        self.can_bus = can_bus
+        self.queue = PriorityQueue(queue_size)
+        self.sequence = count()
+        # fair queuing: tag of the last frame taken from the queue, last tag of every flow
+        self.virtual_time = 0
+        self.flow_tags = {}
+        self.flow_lock = threading.Lock()
+
+        self.rate = bitrate * max_bus_load / 100
+        # allow a burst of ~10ms worth of bus time
+        self.bucket_size = max(self.rate / 100, 160)
+        self.tokens = self.bucket_size
+        self.last_refill = monotonic()
+
+        self.retry_timeout = retry_timeout_ms / 1000
+
+        self.running = LockableBoolean()
+        self.thread = None
+
+    def submit(self, msg: Message, priority=PRIORITY_CONTROL, update_can_status=True, timeout=None, flow=None) -> Future:
+        """
+        Queue a frame, blocks while the queue is full (backpressure) and raises TransmitBufferFull after timeout
+        """
+        request = TxRequest(msg, update_can_status)
+        with self.flow_lock:
+            if flow is None:
+                tag = self.virtual_time
+            else:
+                tag = max(self.virtual_time, self.flow_tags.get(flow, 0)) + 1
+                self.flow_tags[flow] = tag
+        try:
+            self.queue.put((priority, tag, next(self.sequence), request), timeout=timeout)
+        except Full:
+            raise TransmitBufferFull("TX queue full")
+        return request.future
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name="can-tx", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2)
+        self.thread = None
+
+        # nothing will send the queued frames anymore
+        while True:
+            try:
+                _, _, _, request = self.queue.get(False)
+            except Empty:
+                break
+            if request.future.set_running_or_notify_cancel():
+                request.future.set_exception(CanError("CAN bus closed"))
+
+    def take_tokens(self, bits):
+        while True:
+            now = monotonic()
+            self.tokens = min(self.bucket_size, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= bits:
+                self.tokens -= bits
+                return
+            sleep((bits - self.tokens) / self.rate)
+
+    def transmit(self, request: TxRequest):
+        retry_end = monotonic() + self.retry_timeout
+        backoff = 0.001
+        while True:
+            try:
+                self.can_bus.bus.send(request.msg)
+                if request.update_can_status:
+                    self.can_bus.can_status = 1
+                trace = self.can_bus.trace
+                if trace.enabled:
+                    trace.record(request.msg, TRACE_TX)
+                return
+            except CanError as e:
+                if not is_buffer_full_error(e):
+                    if request.update_can_status:
+                        self.can_bus.can_status = 0
+                    raise
+                if monotonic() > retry_end or not self.running.get():
+                    raise TransmitBufferFull("Buffer full") from e
+                # driver queue is full, wait until it drains
+                sleep(backoff)
+                backoff = min(backoff * 2, 0.01)
+
+    def run(self):
+        while self.running.get():
+            try:
+                _, tag, _, request = self.queue.get(timeout=0.5)
+            except Empty:
+                continue
+            with self.flow_lock:
+                self.virtual_time = max(self.virtual_time, tag)
+
+            if not request.future.set_running_or_notify_cancel():
+                continue
+
+            self.take_tokens(frame_bits(request.msg))
+            try:
+                self.transmit(request)
+            except Exception as e:
+                log_fields(logger, logging.DEBUG, "TX failed", arbitration_id=request.msg.arbitration_id, error=e)
+                request.future.set_exception(e)
+            else:
+                request.future.set_result(request.msg)
@@ -0,0 +1,174 @@
+"""
+Cell voltages of a pack in typed arrays, the statistics are kept up to date per cell group.
+
+The BMS sends the cell voltages in groups of GROUP_SIZE cells (registers 0xd1, 0xd2, ...).
+When a group arrives only its own sum, lowest and highest cell are computed, the pack values
+are combined from the group values. The cell count depends on the hw_type, see [CELLS] in the config.
+"""
+import logging
+from array import array
+
+logger = logging.getLogger('cells')
+
+GROUP_SIZE = 4
+DEFAULT_CELL_COUNT = 12
+# cell bars in the battery window
+MAX_CELLS = 16
+
+# hw_type: cell count, 0 Beyonder, 1 Foldy, 2 Aike 11
+cell_counts = {0: 12, 1: 12, 2: 12}
+
+
+def load_cell_counts(config, max_cells=MAX_CELLS):
+    """
+    Reads the [CELLS] section of a settings object, keys are hw_<type> = <cell count>.
+    A count above max_cells (the cells of the group registers that are polled) is capped.
+    """
+    if not config.config.has_section("CELLS"):
+        return
+    max_cells = min(max_cells, MAX_CELLS)
+    for key, value in config.config.items("CELLS"):
+        if key.startswith("hw_"):
+            count = int(value)
+            if count > max_cells:
+                logger.warning(f"[CELLS] {key} = {count}: only {max_cells} cells are read, count capped")
+                count = max_cells
+            cell_counts[int(key[3:], 0)] = count
+
+
+def cell_count(hw_type):
+    return cell_counts.get(hw_type, DEFAULT_CELL_COUNT)
+
+
+def group_count(count):
+    return (count + GROUP_SIZE - 1) // GROUP_SIZE
+
+
+class CellModel:
+    """
+    Cell voltages in mV, unknown until the group of the cell has arrived (None when read).
+    deltas has the change of every cell at the last update of its group, 0 for the first value.
+    """
+
+    __slots__ = ("voltages", "deltas", "known", "group_sum", "group_low", "group_high", "total")
+
+    def __init__(self, count=DEFAULT_CELL_COUNT):
+        self.voltages = array("H")
+        self.deltas = array("i")
+        self.group_sum = array("I")
+        # index of the lowest and highest cell of every group
+        self.group_low = array("B")
+        self.group_high = array("B")
+        self.resize(count)
+
+    def resize(self, count):
+        """
+        Forgets all values, the arrays are reused so references to them stay valid
+        """
+        groups = group_count(count)
+        for values, size in ((self.voltages, count), (self.deltas, count), (self.group_sum, groups),
+                             (self.group_low, groups), (self.group_high, groups)):
+            del values[:]
+            values.extend([0] * size)
+        # bit per group
+        self.known = 0
+        self.total = 0
+
+    def set_group(self, group, values):
+        """
+        Values of a group from its register, the cells past the cell count are ignored.
+        Returns False for a group the pack does not have.
+        """
+        start = group * GROUP_SIZE
+        end = min(start + GROUP_SIZE, len(self.voltages))
+        if start >= end:
+            return False
+        voltages = self.voltages
+        deltas = self.deltas
+        known = self.known >> group & 1
+        low = high = start
+        total = 0
+        for i, value in zip(range(start, end), values):
+            deltas[i] = value - voltages[i] if known else 0
+            voltages[i] = value
+            total += value
+            if value < voltages[low]:
+                low = i
+            elif value > voltages[high]:
+                high = i
+        self.total += total - self.group_sum[group]
+        self.group_sum[group] = total
+        self.group_low[group] = low
+        self.group_high[group] = high
+        self.known |= 1 << group
+        return True
+
+    def complete(self):
+        return self.known == (1 << len(self.group_sum)) - 1
+
+    def average(self):
+        return round(self.total / len(self.voltages)) if self.complete() else None
+
+    def lowest_cell(self):
+        """
+        Index of the lowest known cell (the first one of equal cells), None when nothing is known
+        """
+        voltages = self.voltages
+        lowest = None
+        for group, cell in enumerate(self.group_low):
+            if self.known >> group & 1 and (lowest is None or voltages[cell] < voltages[lowest]):
+                lowest = cell
+        return lowest
+
+    def highest_cell(self):
+        voltages = self.voltages
+        highest = None
+        for group, cell in enumerate(self.group_high):
+            if self.known >> group & 1 and (highest is None or voltages[cell] > voltages[highest]):
+                highest = cell
+        return highest
+
+    def lowest(self):
+        cell = self.lowest_cell()
+        return None if cell is None else self.voltages[cell]
+
+    def highest(self):
+        cell = self.highest_cell()
+        return None if cell is None else self.voltages[cell]
+
+    def spread(self):
+        low, high = self.lowest(), self.highest()
+        return None if low is None else high - low
+
+    def __len__(self):
+        return len(self.voltages)
+
+    def __getitem__(self, cell):
+        if isinstance(cell, slice):
+            return [self[i] for i in range(*cell.indices(len(self.voltages)))]
+        value = self.voltages[cell]
+        if cell < 0:
+            cell += len(self.voltages)
+        return value if self.known >> (cell // GROUP_SIZE) & 1 else None
+
+    def __setitem__(self, cell, value):
+        """
+        A single cell, its group is updated with the other cells as they are
+        """
+        group = cell // GROUP_SIZE
+        cells = slice(group * GROUP_SIZE, (group + 1) * GROUP_SIZE)
+        values = self.voltages[cells].tolist()
+        values[cell % GROUP_SIZE] = value
+        # the other cells keep their deltas
+        deltas = self.deltas[cells]
+        self.set_group(group, values)
+        deltas[cell % GROUP_SIZE] = self.deltas[cell]
+        self.deltas[cells] = deltas
+
+    def __iter__(self):
+        if self.complete():
+            return iter(self.voltages)
+        return iter([self[i] for i in range(len(self.voltages))])
+
+    def __repr__(self):
+        return f"CellModel({list(self)})"
@@ -0,0 +1,172 @@
+import atexit
+import logging
+import threading
+from pathlib import Path
+from queue import Queue, Empty, Full
+from time import monotonic
+
+logger = logging.getLogger('csv-writer')
+
+OPEN = 0
+ROW = 1
+CLOSE = 2
+VEHICLE = 3
+ALARM = 4
+
+
+class CsvWriter:
+    """
+    Writes BmsInfo CSV rows from a background thread, the CAN threads only queue snapshots.
+
+    Rows are formatted in the writer thread and written in batches, flushed when flush_size bytes
+    are buffered or flush_interval seconds have passed, and always on close and exit.
+    The queue is bounded, rows are dropped (and counted) instead of blocking the CAN polling.
+    Rows of all batteries are also appended to session_log (a SessionLogWriter) and history
+    (a HistoryStore) when given. Alarm events go to <file>.alarms next to the open file.
+    """
+
+    def __init__(self, queue_size=10000, flush_interval=1.0, flush_size=1 << 16, session_log=None, history=None):
+        self.queue = Queue(maxsize=queue_size)
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.dropped = 0
+        self.session_log = session_log
+        self.history = history
+
+        self.file = None
+        self.alarm_path = None
+        self.alarm_file = None
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = monotonic()
+
+        self.thread = threading.Thread(target=self.run, name="csv-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def open(self, path: Path):
+        """
+        Starts a new file, the folder is created when missing
+        """
+        self.put((OPEN, path))
+
+    def write(self, timestamp, data):
+        """
+        Queues a row of data (a BmsInfo snapshot) with the given timestamp
+        """
+        self.put((ROW, timestamp, data))
+
+    def vehicle(self, timestamp, ccu, iot):
+        """
+        Vehicle data (copies of CCUData and IoTData) for the history sessions
+        """
+        self.put((VEHICLE, timestamp, ccu, iot))
+
+    def alarm(self, event):
+        """
+        An AlarmEvent of the battery of the open file
+        """
+        self.put((ALARM, event))
+
+    def close(self):
+        self.put((CLOSE,))
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"csv queue full, {self.dropped} rows dropped")
+
+    def stop(self, timeout=5.0):
+        """
+        Writes everything queued so far and ends the writer thread
+        """
+        if not self.thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Full:
+            logger.error("csv writer not responding")
+            return
+        self.thread.join(timeout)
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except Empty:
+                self.flush()
+                if self.history is not None and self.history.pending:
+                    self.history.flush()
+                continue
+
+            if item is None:
+                break
+            try:
+                self.handle(item)
+            except Exception as e:
+                logger.error(f"csv write failed: {e}")
+
+            if self.buffered >= self.flush_size or monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+        self.close_file()
+        if self.session_log is not None:
+            self.session_log.close()
+        if self.history is not None:
+            self.history.close()
+
+    def handle(self, item):
+        kind = item[0]
+        if kind == ROW:
+            _, timestamp, data = item
+            if self.session_log is not None and data.bms_id_int:
+                self.session_log.append(timestamp, data)
+            if self.history is not None and data.bms_id_int:
+                self.history.append(timestamp, data)
+            if self.file is not None:
+                line = data.to_csv_test(timestamp) + "\n"
+                self.buffer.append(line)
+                self.buffered += len(line)
+        elif kind == OPEN:
+            self.close_file()
+            path = item[1]
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.file = open(path, "a+")
+            self.alarm_path = path.with_suffix(".alarms")
+        elif kind == CLOSE:
+            self.close_file()
+        elif kind == VEHICLE:
+            if self.history is not None:
+                self.history.vehicle(*item[1:])
+        elif kind == ALARM:
+            if self.file is not None:
+                if self.alarm_file is None:
+                    self.alarm_file = open(self.alarm_path, "a+")
+                # rare, written at once
+                self.alarm_file.write(item[1].to_csv() + "\n")
+                self.alarm_file.flush()
+
+    def flush(self):
+        self.last_flush = monotonic()
+        if not self.buffer:
+            return
+        try:
+            if self.file is not None:
+                self.file.write("".join(self.buffer))
+                self.file.flush()
+        except Exception as e:
+            logger.error(f"csv write failed: {e}")
+        self.buffer = []
+        self.buffered = 0
+
+    def close_file(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.alarm_file is not None:
+            self.alarm_file.close()
+            self.alarm_file = None
@@ -0,0 +1,212 @@
+"""
+Firmware images and their transfer plans, shared by all batteries updated to the same version.
+
+The files are downloaded once into the firmware directory (COMO_bms_fw_<version>[_<type>].bin and
+the checksum file COMO_bms_cs_<version>[_<type>].txt) and verified before they are used: the
+checksum file holds the CRC-32/MPEG-2 of the image as 8 hex digits. Images are kept in memory by
+their SHA-256, versions with the same content share one image. A TransferPlan has everything sent
+per block (commands, block CRC, ISO-TP frames) for one packet size, it is built on first use.
+"""
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+import crcmod.predefined
+import requests
+
+from .isotp import segment
+
+logger = logging.getLogger('fw-cache')
+
+crc32_mpeg = crcmod.predefined.mkCrcFun('crc-32-mpeg')
+
+# erased flash, the last block is padded with it for the block CRC
+PADDING = 0xFF
+# blocks of up to 6 bytes are the end of the file, they are not sent
+MIN_BLOCK = 7
+DOWNLOAD_TIMEOUT = 30
+
+
+class FirmwareError(Exception):
+    pass
+
+
+def file_names(fw_version, fw_type=0):
+    fw_type_txt = ""
+    if fw_type != 0:
+        fw_type_txt = f"_{fw_type:02X}"
+    return f"COMO_bms_fw_{fw_version}{fw_type_txt}.bin", f"COMO_bms_cs_{fw_version}{fw_type_txt}.txt"
+
+
+def parse_checksum(text):
+    text = text.strip()
+    try:
+        if len(text) < 8:
+            raise ValueError(text)
+        return int(text[:8], 16)
+    except ValueError:
+        raise FirmwareError(f"invalid checksum file content: {text[:16]!r}")
+
+
+def command(cmd, value):
+    return [0x07, 0xfd, cmd, 0x05, (value >> 24) & 0xFF, (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF]
+
+
+class Block:
+    """
+    A block of the image: its commands, CRC and ISO-TP frames (first None for the end of the file)
+    """
+
+    __slots__ = ("number", "data", "crc", "number_command", "checksum_command", "first", "frames")
+
+    def __init__(self, number, data, packet_size):
+        self.number = number
+        self.data = data
+        if len(data) < packet_size:
+            self.crc = crc32_mpeg(bytes([PADDING]) * (packet_size - len(data)), crc32_mpeg(data))
+        else:
+            self.crc = crc32_mpeg(data)
+        self.number_command = command(0x14, number)
+        self.checksum_command = command(0x15, self.crc)
+        if len(data) >= MIN_BLOCK:
+            self.first, self.frames = segment(data)
+        else:
+            self.first, self.frames = None, []
+
+
+class TransferPlan:
+    def __init__(self, image: "FirmwareImage", packet_size):
+        self.packet_size = packet_size
+        self.digest = image.digest
+        view = memoryview(image.data)
+        self.blocks = [Block(number, view[offset:offset + packet_size], packet_size)
+                       for number, offset in enumerate(range(0, len(view), packet_size), 1)]
+
+    def __len__(self):
+        return len(self.blocks)
+
+
+class FirmwareImage:
+    def __init__(self, data, checksum):
+        self.data = data
+        self.checksum = checksum
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.plans = {}
+        self.lock = threading.Lock()
+
+    @property
+    def checksum_command(self):
+        return command(0x05, self.checksum)
+
+    def plan(self, packet_size) -> TransferPlan:
+        with self.lock:
+            plan = self.plans.get(packet_size)
+            if plan is None:
+                plan = self.plans[packet_size] = TransferPlan(self, packet_size)
+                logger.info(f"transfer plan {self.digest[:12]}: {packet_size} byte blocks, {len(plan)} blocks")
+            return plan
+
+
+class FirmwareCache:
+    """
+    Images by (version, fw_type), downloaded from storage_url when not in directory.
+    With verify off a checksum mismatch is only logged.
+    """
+
+    def __init__(self, directory: Path, storage_url, verify=True):
+        self.directory = Path(directory)
+        self.storage_url = storage_url
+        self.verify = verify
+        self.lock = threading.Lock()
+        # sha256: FirmwareImage
+        self.images = {}
+        # (version, fw_type): sha256
+        self.versions = {}
+
+    def paths(self, fw_version, fw_type=0):
+        return tuple(self.directory / name for name in file_names(fw_version, fw_type))
+
+    def get(self, fw_version, fw_type=0) -> FirmwareImage:
+        with self.lock:
+            digest = self.versions.get((fw_version, fw_type))
+            if digest is not None:
+                return self.images[digest]
+
+            fw_path, cs_path = self.paths(fw_version, fw_type)
+            if not (fw_path.exists() and cs_path.exists()):
+                self.download(fw_path, cs_path)
+            image = self.load(fw_path, cs_path)
+            image = self.images.setdefault(image.digest, image)
+            self.versions[(fw_version, fw_type)] = image.digest
+            return image
+
+    def load(self, fw_path: Path, cs_path: Path) -> FirmwareImage:
+        data = fw_path.read_bytes()
+        checksum = parse_checksum(cs_path.read_text())
+        self.check(data, checksum, fw_path.name)
+        return FirmwareImage(data, checksum)
+
+    def check(self, data, checksum, name):
+        crc = crc32_mpeg(data)
+        if crc == checksum:
+            return
+        text = f"{name}: checksum {crc:08X}, expected {checksum:08X}"
+        if self.verify:
+            raise FirmwareError(text)
+        logger.warning(text)
+
+    def download(self, fw_path: Path, cs_path: Path):
+        """
+        Downloads both files next to their target and renames them only when they match
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fw_part = fw_path.with_name(fw_path.name + ".part")
+        cs_part = cs_path.with_name(cs_path.name + ".part")
+        try:
+            if not fw_path.exists():
+                self.fetch(fw_path.name, fw_part)
+            if not cs_path.exists():
+                self.fetch(cs_path.name, cs_part)
+            self.check((fw_part if fw_part.exists() else fw_path).read_bytes(),
+                       parse_checksum((cs_part if cs_part.exists() else cs_path).read_text()), fw_path.name)
+            for part, path in ((fw_part, fw_path), (cs_part, cs_path)):
+                if part.exists():
+                    part.replace(path)
+        except Exception as e:
+            logger.error(f"Failed to download files: {e}")
+            raise
+        finally:
+            for part in (fw_part, cs_part):
+                if part.exists():
+                    part.unlink()
+
+    def fetch(self, name, path: Path):
+        url = f"{self.storage_url}/{name}"
+        logger.info(f"Downloading from: {url}")
+        with requests.get(url, allow_redirects=True, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+            if r.status_code != 200:
+                raise FirmwareError(f"{name} download failed ({r.status_code})")
+            size = 0
+            with open(path, "wb") as f:
+                for chunk in r.iter_content(1 << 16):
+                    f.write(chunk)
+                    size += len(chunk)
+            expected = r.headers.get("Content-Length")
+            if expected is not None and "Content-Encoding" not in r.headers and int(expected) != size:
+                raise FirmwareError(f"{name} download incomplete ({size} of {expected} bytes)")
+
+
+caches = {}
+caches_lock = threading.Lock()
+
+
+def firmware_cache(directory: Path, storage_url, verify=True) -> FirmwareCache:
+    """
+    The cache of a firmware directory, shared by all BmsReaders using it
+    """
+    with caches_lock:
+        cache = caches.get(Path(directory))
+        if cache is None:
+            cache = caches[Path(directory)] = FirmwareCache(directory, storage_url, verify)
+        return cache
@@ -0,0 +1,90 @@
+"""
+Progress of the firmware updates, kept in a JSON file so an interrupted update can be resumed.
+
+An entry is kept per battery, firmware version, fw type and packet size. It holds the number of
+blocks the BMS has validated and the SHA-256 of the image they were cut from. The file is read
+again before every write, several diag tools can share the firmware directory.
+"""
+import json
+import logging
+import threading
+from pathlib import Path
+from time import monotonic
+
+from .helper import utc_time_seconds
+
+logger = logging.getLogger('fw-progress')
+
+
+def progress_key(bms_id, fw_version, fw_type, packet_size):
+    return f"{bms_id:08X}:{fw_version}:{fw_type:02X}:{packet_size}"
+
+
+class UpdateProgress:
+    """
+    save() writes at most every save_interval seconds unless forced, the file is replaced atomically.
+    A key of None (unknown battery) is never saved.
+    """
+
+    def __init__(self, path: Path, save_interval=1.0):
+        self.path = Path(path)
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.last_save = 0
+        # key: entry (None: removed) not written yet
+        self.changes = {}
+
+    def load(self):
+        try:
+            return json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"update progress not loaded: {e}")
+            return {}
+
+    def validated_blocks(self, key, digest):
+        """
+        Blocks validated by an earlier update of the same image, 0 when there is nothing to resume
+        """
+        if key is None:
+            return 0
+        with self.lock:
+            entries = self.load()
+            entries.update(self.changes)
+        entry = entries.get(key)
+        if entry is None or entry.get("digest") != digest:
+            return 0
+        return entry.get("blocks", 0)
+
+    def save(self, key, digest, blocks, force=False):
+        if key is None:
+            return
+        with self.lock:
+            self.changes[key] = {"digest": digest, "blocks": blocks, "time": round(utc_time_seconds())}
+            if force or monotonic() - self.last_save >= self.save_interval:
+                self.write()
+
+    def clear(self, key):
+        if key is None:
+            return
+        with self.lock:
+            self.changes[key] = None
+            self.write()
+
+    def write(self):
+        self.last_save = monotonic()
+        entries = self.load()
+        for key, entry in self.changes.items():
+            if entry is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = entry
+        self.changes = {}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            part = self.path.with_name(self.path.name + ".part")
+            part.write_text(json.dumps(entries, indent=1))
+            part.replace(self.path)
+        except Exception as e:
+            logger.error(f"update progress not saved: {e}")
@@ -0,0 +1,354 @@
+"""
+Firmware update sessions, several batteries can be updated at once on one PyCan.
+
+Every battery is updated through its own bootloader identifiers: 0xF000 | (aid << 4) | 0xD / 0xA,
+aid is attach_status | 0xD0 for an attached battery or a temporary id given with master command
+0xFB01. A session has its own command tracker, ISO-TP sender and progress. The consecutive frames
+of the sessions are separate TX flows, the scheduler gives them turns on the bus (see TxScheduler).
+"""
+import logging
+import threading
+from functools import partial
+from struct import pack
+from time import sleep
+
+from .ack_tracker import AckTracker, CommandFailed
+from .fw_cache import FirmwareImage, TransferPlan
+from .fw_progress import progress_key
+from .helper import TransmitBufferFull
+from .isotp import IsoTpSender, IsoTpError
+from .pycan import can_filter
+from .tracing import log_fields
+
+logger = logging.getLogger('fw-sessions')
+
+# master command assigning a temporary bootloader id to an unattached battery
+TEMPORARY_ATTACH_ID = 0xFB01
+TEMPORARY_IDS = range(0x20, 0x30)
+# bootloader tx id of the batteries with fw_type != 0, shared by all of them
+SHARED_TX_IDENTIFIER = 0xFD0D
+
+
+def bootloader_identifiers(aid, fw_type=0, attached=True):
+    """
+    tx and rx identifier of a bootloader
+    """
+    tx_identifier = 0xF000 | (aid << 4) | 0xD
+    if attached and fw_type != 0:
+        tx_identifier = SHARED_TX_IDENTIFIER
+    return tx_identifier, 0xF000 | (aid << 4) | 0xA
+
+
+class FwSession:
+    """
+    Firmware update of one battery. reader is the BmsReader owning the CAN bus, the firmware
+    cache and the update settings. progress(text, percent) gets the state of the update, the last
+    call is ("Done", 100) or ("Failed: <error>", -2) when the session is run by FwSessionManager.
+    """
+
+    def __init__(self, reader, tx_identifier, rx_identifier, bms_id=0, progress=None):
+        self.reader = reader
+        self.can_bus = reader.can_bus
+        self.tx_identifier = tx_identifier
+        self.rx_identifier = rx_identifier
+        self.bms_id = bms_id
+        self.progress = progress
+        # temporary bootloader id, None for an attached battery
+        self.temporary_id = None
+
+        self.status = ""
+        self.percent = 0
+        self.error = None
+        self.done = threading.Event()
+
+    def __repr__(self):
+        return f"FwSession(bms_id={self.bms_id:08X}, tx={self.tx_identifier:04X}, rx={self.rx_identifier:04X})"
+
+    def report(self, text, percent):
+        self.status = text
+        self.percent = percent
+        if self.progress is not None:
+            self.progress(text, percent)
+
+    def send_command(self, msg, index=7, count=1, timeout=1000):
+        return self.reader.send_command(msg, index, count, timeout, self.tx_identifier, self.rx_identifier)
+
+    def update(self, fw_version, fw_type=0):
+        """
+        With the bms_id the progress is saved, a failed update of the same image is resumed after
+        its last validated block when the bootloader is still prepared.
+        """
+        self.report(f"Downloading", 0)
+        image = self.reader.download_fw_files(fw_version, fw_type)
+
+        self.can_bus.can_bus_on()
+
+        timeout = 10000
+
+        msg = [0x03, 0xfd, 0x12, 0x02]
+
+        # Get packet size
+        packet_size = self.send_command(msg, 6, 2, timeout=timeout)
+        log_fields(logger, logging.DEBUG, "packet size", packet_size=packet_size)
+        if not (64 <= packet_size <= 1024):
+            raise Exception("Received invalid packet size")
+
+        plan = image.plan(packet_size)
+        log_fields(logger, logging.DEBUG, "total packet number", total_packet_no=len(plan))
+
+        key = progress_key(self.bms_id, fw_version, fw_type, packet_size) if self.bms_id else None
+        validated = self.reader.fw_progress.validated_blocks(key, image.digest)
+        if validated:
+            self.report(f"Resuming at block {validated + 1}", 6)
+            try:
+                self.check_ready(timeout)
+                self.send_blocks(plan, validated, timeout, key)
+            except Exception as e:
+                if self.reader.fw_progress.validated_blocks(key, image.digest) > validated:
+                    raise
+                # nothing was accepted, the bootloader has lost the state of the update
+                log_fields(logger, logging.WARNING, "resume failed", key=key, error=e)
+                validated = 0
+        if not validated:
+            self.reader.fw_progress.clear(key)
+            self.prepare(image, plan, timeout)
+            self.send_blocks(plan, 0, timeout, key)
+
+        self.report(f"Validating", 95)
+        # Validate firmware image, the update starts over after it
+        self.reader.fw_progress.clear(key)
+        msg = [0x07, 0xfd, 0x18, 0x05, 0x01, 0x02, 0x03, 0x04]
+        update_valid_response = self.send_command(msg, timeout=timeout)
+        if update_valid_response != 77:
+            raise Exception("Failed to validate firmware image")
+
+    def prepare(self, image: FirmwareImage, plan: TransferPlan, timeout):
+        self.report(f"Erasing", 3)
+        # Erase fw update area
+        msg = [0x07, 0xfd, 0x11, 0x05, 0x01, 0x02, 0x03, 0x04]
+        erase_response = self.send_command(msg, timeout=timeout)
+        log_fields(logger, logging.DEBUG, "erase", response=erase_response)
+        if erase_response != 77:
+            raise Exception("Failed to erase FW update area")
+
+        # Write update checksum
+        log_fields(logger, logging.DEBUG, "total checksum", total_checksum=f"{image.checksum:08X}")
+        checksum_write_response = self.send_command(image.checksum_command, timeout=timeout)
+        log_fields(logger, logging.DEBUG, "checksum write", response=checksum_write_response)
+        if checksum_write_response != 77:
+            raise Exception("Failed to set write checksum")
+
+        # Write update status
+        msg = [0x07, 0xfd, 0x04, 0x05, 0xD0, 0xD1, 0xD2, 0xD3]
+        status_write_response = self.send_command(msg, timeout=timeout)
+        log_fields(logger, logging.DEBUG, "status write", response=status_write_response)
+        if status_write_response != 77:
+            raise Exception("Failed to write update status")
+
+        # Set total block count for the update
+        total_packet_no = len(plan)
+        total_packet_no_low = (total_packet_no >> 8) & 0xff
+        total_packet_no_high = total_packet_no & 0xff
+        msg = [0x07, 0xfd, 0x13, 0x05, 0x00, 0x00, total_packet_no_low, total_packet_no_high]
+        block_response = self.send_command(msg, timeout=timeout)
+        log_fields(logger, logging.DEBUG, "block count set", response=block_response)
+        if block_response != 77:
+            raise Exception("Failed to set total block count")
+
+        self.report(f"Ready?", 6)
+        self.check_ready(timeout)
+
+    def check_ready(self, timeout):
+        # Ask if BMS is prepared
+        msg = [0x03, 0xfd, 0x10, 0x02]
+        ready_response = self.send_command(msg, timeout=timeout)
+        log_fields(logger, logging.DEBUG, "ready", response=ready_response)
+        if ready_response != 77:
+            raise Exception("BMS is not prepared")
+
+    def send_blocks(self, plan: TransferPlan, validated, timeout, key):
+        """
+        Sends the blocks after the first validated ones. A failed block is sent again after a backoff
+        delay, up to fw_block_retries times. The progress is saved as blocks get validated.
+        """
+        total_packet_no = len(plan)
+        iso_tp = IsoTpSender(self.can_bus, self.tx_identifier, self.rx_identifier, True, fc_timeout=timeout / 1000)
+        digest = plan.digest
+        retries = 0
+        failed_at = None
+
+        # The block commands are pipelined: the commands of a block are sent at once and the validation
+        # of a block is acknowledged together with the commands of the next one
+        with AckTracker(self.can_bus, self.tx_identifier, self.rx_identifier, True, timeout, self.reader.latency) as commands:
+            while True:
+                try:
+                    for block in plan.blocks[validated:]:
+                        package = block.number
+                        percent = 10 + (package / (total_packet_no + 1))*80
+                        self.report(f"Sending block: {package} / {total_packet_no + 1}", int(percent))
+                        # Set block number and block checksum
+                        commands.send(block.number_command, "Failed to set block number")
+                        log_fields(logger, logging.DEBUG, "packet checksum", block=package, checksum=block.crc)
+                        commands.send(block.checksum_command, "Failed to set block checksum")
+
+                        # Send start command
+                        msg = [0x07, 0xfd, 0x16, 0x05, 0x01, 0x02, 0x03, 0x04]
+                        commands.send(msg, "Failed to set block start")
+
+                        # the data is sent only when the BMS has accepted the block
+                        commands.wait()
+                        log_fields(logger, logging.DEBUG, "block started", block=package)
+                        if validated < package - 1:
+                            validated = package - 1
+                            self.reader.fw_progress.save(key, digest, validated)
+
+                        # Send the block over ISO TP, a block of up to 6 bytes is the end of the file
+                        if block.first is None:
+                            logger.debug("end of file")
+                        else:
+                            iso_tp.send_frames(block.first, block.frames)
+
+                            # Validate block
+                            msg = [0x07, 0xfd, 0x17, 0x05, 0x01, 0x02, 0x03, 0x04]
+                            commands.send(msg, "Failed write block")
+
+                    commands.wait()
+                    return
+                except (CommandFailed, IsoTpError, TransmitBufferFull) as e:
+                    # send_burst has cancelled the frames of the failed block still in the TX queue,
+                    # the block is sent again from its first frame
+                    self.reader.fw_progress.save(key, digest, validated, force=True)
+                    if failed_at != validated:
+                        failed_at = validated
+                        retries = 0
+                    retries += 1
+                    if retries > self.reader.fw_block_retries:
+                        raise
+                    delay = self.reader.fw_retry_backoff * 2 ** (retries - 1)
+                    log_fields(logger, logging.WARNING, "block failed", block=validated + 1, retry=retries,
+                               delay=delay, error=e)
+                    self.report(f"Retrying block {validated + 1}: {e}", int(10 + (validated / (total_packet_no + 1))*80))
+                    sleep(delay)
+                    commands.reset()
+
+
+class FwSessionManager:
+    """
+    Runs every session in its own thread. Batteries sharing a bootloader tx identifier (attached
+    ones with fw_type != 0) cannot be told apart by the bootloader, their sessions run one after another.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.lock = threading.Lock()
+        # bms_id: running FwSession
+        self.sessions = {}
+        # tx identifier: lock held by the session using it
+        self.tx_locks = {}
+
+    def start(self, fw_version, fw_type, bms_id, attach_status, bms_fw_type=0, progress=None) -> FwSession:
+        """
+        Starts the update of a battery, attach_status 0xFF: not attached, a temporary id is given.
+        fw_type is the firmware type to install, bms_fw_type the one the battery runs now.
+        """
+        with self.lock:
+            if bms_id in self.sessions:
+                raise Exception("Update already running")
+            if attach_status != 0xFF:
+                temporary_id = None
+                tx_identifier, rx_identifier = bootloader_identifiers(attach_status | 0xD0, bms_fw_type)
+            else:
+                used = {session.temporary_id for session in self.sessions.values()}
+                temporary_id = next((aid for aid in TEMPORARY_IDS if aid not in used), None)
+                if temporary_id is None:
+                    raise Exception("No free temporary id")
+                tx_identifier, rx_identifier = bootloader_identifiers(temporary_id, attached=False)
+            if any(session.rx_identifier == rx_identifier for session in self.sessions.values()):
+                raise Exception(f"Bootloader id {rx_identifier:04X} is in use")
+
+            session = FwSession(self.reader, tx_identifier, rx_identifier, bms_id, progress)
+            session.temporary_id = temporary_id
+            self.sessions[bms_id] = session
+            tx_lock = self.tx_locks.setdefault(tx_identifier, threading.Lock())
+
+        threading.Thread(target=self.run, args=(session, tx_lock, fw_version, fw_type), name=f"fw-{bms_id:08X}",
+                         daemon=True).start()
+        return session
+
+    def start_all(self, fw_version, batteries, fw_type=None, progress=None):
+        """
+        Starts the updates of several batteries on the bus, batteries are (bms_id, attach_status, bms_fw_type).
+        fw_type None installs the type each battery runs now. progress(bms_id, text, percent) gets the state
+        of every update, a battery that cannot be started gets ("Failed: <error>", -2).
+        Returns the started sessions.
+        """
+        sessions = []
+        for bms_id, attach_status, bms_fw_type in batteries:
+            if not bms_id:
+                continue
+            battery_progress = None if progress is None else partial(progress, bms_id)
+            try:
+                sessions.append(self.start(fw_version, bms_fw_type if fw_type is None else fw_type, bms_id,
+                                           attach_status, bms_fw_type, battery_progress))
+            except Exception as e:
+                logger.error(f"fw update {bms_id:08X} not started: {e}")
+                if battery_progress is not None:
+                    battery_progress(f"Failed: {e}", -2)
+        return sessions
+
+    def run(self, session: FwSession, tx_lock, fw_version, fw_type):
+        filter_group = f"bootloader-{session.rx_identifier:04X}"
+        self.reader.can_bus.set_filter_group(filter_group, [can_filter(session.rx_identifier)])
+        try:
+            session.report("Starting", 0)
+            with tx_lock:
+                if session.temporary_id is not None:
+                    logger.debug(f"send_new_aid {session.temporary_id:x}")
+                    msg = pack(">IBBH", session.bms_id, 1, 1, session.temporary_id)
+                    self.reader.can_bus.send_data(TEMPORARY_ATTACH_ID, msg, True)
+                try:
+                    logger.info(f"do fw update: {fw_version} fw_type: {fw_type:02x} {session}")
+                    session.update(fw_version, fw_type)
+                finally:
+                    if session.temporary_id is not None:
+                        msg = pack(">IBBH", session.bms_id, 1, 2, 0)
+                        self.reader.can_bus.send_data(TEMPORARY_ATTACH_ID, msg, True)
+            session.report("Done", 100)
+        except Exception as e:
+            session.error = e
+            logger.error(f"fw update {session} error: {e}")
+            session.report(f"Failed: {e}", -2)
+        finally:
+            self.reader.can_bus.set_filter_group(filter_group, [])
+            with self.lock:
+                self.sessions.pop(session.bms_id, None)
+            session.done.set()
+
+    def active(self):
+        with self.lock:
+            return list(self.sessions.values())
+
+    def wait(self, timeout=None):
+        """
+        Waits until the running sessions have ended, returns False on timeout
+        """
+        for session in self.active():
+            if not session.done.wait(timeout):
+                return False
+        return True
+
+
+managers = {}
+managers_lock = threading.Lock()
+
+
+def session_manager(reader) -> FwSessionManager:
+    """
+    The session manager of the PyCan of a reader, shared by all windows using that bus so the
+    bootloader and temporary ids are handed out once per bus
+    """
+    with managers_lock:
+        manager = managers.get(reader.can_bus)
+        if manager is None:
+            manager = managers[reader.can_bus] = FwSessionManager(reader)
+        return manager
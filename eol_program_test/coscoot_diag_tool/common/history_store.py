@@ -0,0 +1,250 @@
+"""
+SQLite history of BmsInfo samples, an alternative to the csv/<bms_id>/ folders.
+
+    sessions  one row per battery connection (or imported csv file), linked to the vehicle record
+              valid when it started
+    samples   the to_csv_test columns and the cell voltage spread, per session
+    vehicles  CCUData / IoTData seen while logging, a new row when they change
+
+The database is in WAL mode and samples are inserted in batched transactions.
+
+    every session of a battery:
+        SELECT * FROM sessions WHERE bms_id_int = ?
+    batteries with a cell voltage spread over 89 mV in the last week:
+        SELECT DISTINCT bms_id_int FROM samples WHERE timestamp > ? AND cell_diff > 89
+"""
+import json
+import logging
+import sqlite3
+from multiprocessing import Pool
+from pathlib import Path
+from time import monotonic
+
+from .bmsinfo import BmsInfo, CSV_TEST_COLUMNS, CELL_COUNT, log_cells
+
+logger = logging.getLogger('history-store')
+
+CELLS = slice(CSV_TEST_COLUMNS.index("cell_1"), CSV_TEST_COLUMNS.index("cell_1") + CELL_COUNT)
+SAMPLE_COLUMNS = ("session_id", "bms_id_int", *CSV_TEST_COLUMNS, "cell_diff")
+REAL_COLUMNS = {"timestamp": "REAL NOT NULL", "ambient_temp": "REAL"}
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS vehicles (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    iot_nrf_id INTEGER,
+    ccu_fw_version INTEGER,
+    ccu TEXT,
+    iot TEXT
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    bms_id TEXT NOT NULL,
+    bms_id_int INTEGER NOT NULL,
+    started REAL NOT NULL,
+    ended REAL NOT NULL,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    vehicle_id INTEGER REFERENCES vehicles(id),
+    source TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS samples (
+    {", ".join(f"{column} {REAL_COLUMNS.get(column, 'INTEGER')}" for column in SAMPLE_COLUMNS)}
+);
+CREATE INDEX IF NOT EXISTS sessions_bms_id ON sessions (bms_id_int, started);
+CREATE INDEX IF NOT EXISTS samples_bms_id ON samples (bms_id_int, timestamp);
+CREATE INDEX IF NOT EXISTS samples_timestamp ON samples (timestamp);
+CREATE INDEX IF NOT EXISTS samples_error_flags ON samples (error_flags);
+"""
+
+INSERT_SAMPLE = f"INSERT INTO samples ({', '.join(SAMPLE_COLUMNS)}) VALUES ({', '.join('?' * len(SAMPLE_COLUMNS))})"
+
+
+def connect(path: Path):
+    """
+    Opens (and creates) the database, the connection may be used from another thread than
+    the one opening it but only from one at a time
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(path), check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    # with WAL a crash loses at most the last transactions, never corrupts the database
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def cell_diff(cells):
+    known = [cell for cell in cells if cell is not None]
+    return max(known) - min(known) if known else None
+
+
+def sample_row(session_id, bms_id_int, values):
+    """
+    values: to_csv_test columns
+    """
+    return (session_id, bms_id_int, *values, cell_diff(values[CELLS]))
+
+
+def csv_test_values(timestamp, data: BmsInfo):
+    return (timestamp, data.ambient_temp, data.pack_state, data.attach_status, data.error_flags, data.pack_soc,
+            data.voltage, data.current, data.bq_sys_stat, data.cycle_count, data.coulomb_soc,
+            data.available_capacity, *log_cells(data.cell_voltages), data.balance_pattern, data.cap_sense_fill_time,
+            data.fet_temp, data.pack_left_temp, data.pack_center_temp, data.pack_right_temp, data.temp_ts_1,
+            data.temp_ts_2, data.temp_ts_3, data.temp_usb)
+
+
+class Session:
+    def __init__(self, session_id, started):
+        self.id = session_id
+        self.started = started
+        self.ended = started
+        self.rows = 0
+
+
+class HistoryStore:
+    """
+    Writes samples of live batteries, used from the CsvWriter thread.
+
+    A session ends when its battery has not been seen for session_gap seconds. Samples are
+    committed when batch_rows are pending or batch_period seconds passed, and on flush()/close().
+    """
+
+    def __init__(self, path: Path, batch_rows=500, batch_period=5.0, session_gap=60.0):
+        self.db = connect(path)
+        self.batch_rows = batch_rows
+        self.batch_period = batch_period
+        self.session_gap = session_gap
+
+        self.pending = []
+        self.last_commit = monotonic()
+        self.sessions = {}
+        self.vehicle_id = None
+        self.vehicle_key = None
+
+    def append(self, timestamp, data: BmsInfo):
+        session = self.sessions.get(data.bms_id_int)
+        if session is None or timestamp - session.ended > self.session_gap:
+            session = self.start_session(timestamp, data)
+        session.ended = timestamp
+        session.rows += 1
+        self.pending.append(sample_row(session.id, data.bms_id_int, csv_test_values(timestamp, data)))
+
+        if len(self.pending) >= self.batch_rows or monotonic() - self.last_commit >= self.batch_period:
+            self.flush()
+
+    def start_session(self, timestamp, data: BmsInfo):
+        cursor = self.db.execute("INSERT INTO sessions (bms_id, bms_id_int, started, ended, vehicle_id) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 (f"{data.bms_id_int:08x}", data.bms_id_int, timestamp, timestamp, self.vehicle_id))
+        session = Session(cursor.lastrowid, timestamp)
+        self.sessions[data.bms_id_int] = session
+        return session
+
+    def vehicle(self, timestamp, ccu, iot):
+        """
+        ccu, iot: CCUData and IoTData, a vehicle record is added when they identify another vehicle
+        or firmware
+        """
+        key = (getattr(iot, "iot_nrf_id", None), getattr(iot, "iot_nrf_fw_version", None),
+               getattr(ccu, "ccu_fw_version", None))
+        if key == self.vehicle_key or not any(value is not None for value in key):
+            return
+        self.vehicle_key = key
+        cursor = self.db.execute("INSERT INTO vehicles (timestamp, iot_nrf_id, ccu_fw_version, ccu, iot) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 (timestamp, key[0], key[2], json.dumps(vars(ccu), default=str),
+                                  json.dumps(vars(iot), default=str)))
+        self.vehicle_id = cursor.lastrowid
+        # sessions started before the vehicle was identified
+        ids = [session.id for session in self.sessions.values()]
+        self.db.executemany("UPDATE sessions SET vehicle_id = ? WHERE id = ? AND vehicle_id IS NULL",
+                            [(self.vehicle_id, session_id) for session_id in ids])
+
+    def flush(self):
+        self.last_commit = monotonic()
+        try:
+            with self.db:
+                self.db.executemany(INSERT_SAMPLE, self.pending)
+                self.db.executemany("UPDATE sessions SET ended = ?, sample_count = ? WHERE id = ?",
+                                    [(session.ended, session.rows, session.id) for session in self.sessions.values()])
+        except sqlite3.Error as e:
+            logger.error(f"history write failed, {len(self.pending)} samples lost: {e}")
+        self.pending = []
+        if self.sessions:
+            # forget sessions that have ended
+            latest = max(session.ended for session in self.sessions.values())
+            self.sessions = {bms_id_int: session for bms_id_int, session in self.sessions.items()
+                             if latest - session.ended <= self.session_gap}
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+# [START csv import]
+def parse_value(text):
+    if text == "" or text == "None":
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def parse_csv_file(path: Path):
+    """
+    Reads a csv/<bms_id>/<date>_<bms_id>.csv file, runs in the importer processes.
+    Returns (path, bms_id, rows of to_csv_test values), rows is None when the file can not be read.
+    """
+    bms_id = path.parent.name
+    try:
+        rows = []
+        with open(path) as f:
+            for line in f:
+                values = line.rstrip("\n").split(";")
+                if len(values) != len(CSV_TEST_COLUMNS):
+                    continue
+                rows.append([parse_value(value) for value in values])
+        return str(path), bms_id, rows
+    except (OSError, ValueError) as e:
+        logger.error(f"{path}: {e}")
+        return str(path), bms_id, None
+
+
+def import_csv_tree(root: Path, database: Path, processes=None, commit_files=100):
+    """
+    One-time import of the csv/ tree, every file becomes a session. Files are parsed in a process
+    pool, the inserts are done here (SQLite has one writer). Already imported files are skipped,
+    an interrupted import can be run again. Returns the number of imported files.
+    """
+    db = connect(database)
+    imported = {source for source, in db.execute("SELECT source FROM sessions WHERE source IS NOT NULL")}
+    # history_* files are exported windows of the live log (older versions wrote them to csv/)
+    files = [path for path in sorted(Path(root).glob("*/*.csv"))
+             if str(path) not in imported and not path.name.startswith("history_")]
+    logger.info(f"importing {len(files)} files, {len(imported)} already imported")
+
+    count = 0
+    with Pool(processes) as pool:
+        for source, bms_id, rows in pool.imap_unordered(parse_csv_file, files, chunksize=16):
+            if not rows:
+                continue
+            try:
+                bms_id_int = int(bms_id, 16)
+            except ValueError:
+                logger.error(f"{source}: folder is not a bms id")
+                continue
+            timestamps = [row[0] for row in rows]
+            cursor = db.execute("INSERT INTO sessions (bms_id, bms_id_int, started, ended, sample_count, source) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                (bms_id, bms_id_int, min(timestamps), max(timestamps), len(rows), source))
+            db.executemany(INSERT_SAMPLE, [sample_row(cursor.lastrowid, bms_id_int, row) for row in rows])
+            count += 1
+            if count % commit_files == 0:
+                db.commit()
+                logger.info(f"imported {count} / {len(files)} files")
+    db.commit()
+    db.close()
+    return count
+# [END csv import]
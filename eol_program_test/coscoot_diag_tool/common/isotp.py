@@ -0,0 +1,214 @@
+"""
+ISO-TP (ISO 15765-2) sender for the firmware blocks.
+
+    single frame:       0x0L data[0:L]            L <= 7
+    first frame:        0x1L LL data[0:6]         12 bit length
+    consecutive frame:  0x2N data[7 bytes]        N = sequence number 1, 2, ... 15, 0, 1, ...
+    flow control:       0x3F BS STmin             F: 0 continue, 1 wait, 2 overflow
+
+The receiver answers the first frame and every BS consecutive frames (BS 0: the rest) with a
+flow control frame. Frames are cut from a memoryview of the payload, the consecutive frames of
+a block are queued to PyCan in bursts that keep the STmin pace on average.
+"""
+import logging
+from concurrent.futures import TimeoutError as FutureTimeout
+from time import monotonic, sleep
+
+from .can_dispatcher import FrameQueue
+from .can_tx import PRIORITY_BULK
+from .helper import TransmitBufferFull
+from .tracing import log_fields
+
+logger = logging.getLogger('isotp')
+
+SINGLE_FRAME = 0x00
+FIRST_FRAME = 0x10
+CONSECUTIVE_FRAME = 0x20
+FLOW_CONTROL = 0x30
+
+FC_CONTINUE = 0
+FC_WAIT = 1
+FC_OVERFLOW = 2
+
+MAX_LENGTH = 0xFFF
+FRAME_SIZE = 8
+
+
+class IsoTpError(Exception):
+    pass
+
+
+def decode_st_min(value):
+    """
+    STmin byte in seconds: 0x00-0x7F ms, 0xF1-0xF9 100-900 us, reserved values are the maximum 127 ms
+    """
+    if value <= 0x7F:
+        return value / 1000
+    if 0xF1 <= value <= 0xF9:
+        return (value - 0xF0) / 10000
+    return 0x7F / 1000
+
+
+class FlowControl:
+    def __init__(self, data):
+        self.flag = data[0] & 0x0F
+        self.block_size = data[1] if len(data) > 1 else 0
+        self.st_min = decode_st_min(data[2]) if len(data) > 2 else 0
+
+    def __repr__(self):
+        return f"FlowControl(flag={self.flag}, block_size={self.block_size}, st_min={self.st_min})"
+
+
+def single_frame(payload, padding=0x00):
+    payload = memoryview(payload)
+    frame = bytearray([padding]) * FRAME_SIZE
+    frame[0] = SINGLE_FRAME | len(payload)
+    frame[1:1 + len(payload)] = payload
+    return frame
+
+
+def segment(payload, padding=0x00):
+    """
+    First frame and the consecutive frames of a payload longer than 7 bytes, padded to 8 bytes
+    """
+    payload = memoryview(payload)
+    length = len(payload)
+    if length > MAX_LENGTH:
+        raise IsoTpError(f"payload of {length} bytes is too long")
+    first = bytearray(FRAME_SIZE)
+    first[0] = FIRST_FRAME | (length >> 8)
+    first[1] = length & 0xFF
+    first[2:] = payload[:FRAME_SIZE - 2]
+
+    frames = []
+    sequence = 1
+    for offset in range(FRAME_SIZE - 2, length, FRAME_SIZE - 1):
+        data = payload[offset:offset + FRAME_SIZE - 1]
+        frame = bytearray([padding]) * FRAME_SIZE
+        frame[0] = CONSECUTIVE_FRAME | sequence
+        frame[1:1 + len(data)] = data
+        frames.append(frame)
+        sequence = (sequence + 1) & 0x0F
+    return first, frames
+
+
+class IsoTpSender:
+    """
+    Sends payloads from tx_id to a receiver answering on rx_id.
+
+    fc_timeout is the time to wait for a flow control frame, max_wait_frames the number of wait
+    frames accepted in a row, max_burst the number of frames queued at once when behind the STmin pace.
+    The consecutive frames are queued as the TX flow tx_id, senders to different receivers get
+    turns on the bus.
+    """
+
+    def __init__(self, can_bus, tx_id, rx_id, is_extended_id=True, fc_timeout=1.0, max_wait_frames=10,
+                 max_burst=8, padding=0x00):
+        self.can_bus = can_bus
+        self.tx_id = tx_id
+        self.rx_id = rx_id
+        self.is_extended_id = is_extended_id
+        self.fc_timeout = fc_timeout
+        self.max_wait_frames = max_wait_frames
+        self.max_burst = max_burst
+        self.padding = padding
+
+    def send(self, payload):
+        """
+        Sends a payload, raises IsoTpError when the receiver aborts or does not answer
+        """
+        payload = memoryview(payload)
+        if len(payload) <= FRAME_SIZE - 1:
+            self.can_bus.send_data(self.tx_id, single_frame(payload, self.padding), self.is_extended_id, False)
+            return
+        self.send_frames(*segment(payload, self.padding))
+
+    def send_frames(self, first, frames):
+        """
+        Sends a segmented payload, first frame and consecutive frames as made by segment()
+        """
+        # subscribe before sending, so that a fast flow control frame is not lost
+        replies = FrameQueue()
+        subscription = self.can_bus.subscribe(replies, self.rx_id)
+        try:
+            self.can_bus.send_data(self.tx_id, first, self.is_extended_id, False)
+            index = 0
+            while index < len(frames):
+                flow_control = self.wait_flow_control(replies)
+                count = flow_control.block_size or len(frames) - index
+                self.send_burst(frames[index:index + count], flow_control.st_min)
+                index += count
+        finally:
+            self.can_bus.unsubscribe(subscription)
+
+    def wait_flow_control(self, replies: FrameQueue) -> FlowControl:
+        waits = 0
+        deadline = monotonic() + self.fc_timeout
+        while True:
+            time_left = deadline - monotonic()
+            if time_left <= 0:
+                raise IsoTpError("flow control timeout")
+            msg = replies.get(time_left * 1000)
+            if msg is None or not msg.data or msg.data[0] & 0xF0 != FLOW_CONTROL:
+                continue
+            flow_control = FlowControl(msg.data)
+            log_fields(logger, logging.DEBUG, "flow control", rx_id=self.rx_id, flag=flow_control.flag,
+                       block_size=flow_control.block_size, st_min=flow_control.st_min)
+            if flow_control.flag == FC_CONTINUE:
+                return flow_control
+            if flow_control.flag == FC_WAIT:
+                waits += 1
+                if waits > self.max_wait_frames:
+                    raise IsoTpError(f"more than {self.max_wait_frames} wait frames")
+                deadline = monotonic() + self.fc_timeout
+                continue
+            if flow_control.flag == FC_OVERFLOW:
+                raise IsoTpError("receiver overflow, transfer aborted")
+            raise IsoTpError(f"invalid flow control flag {flow_control.flag}")
+
+    def send_burst(self, frames, st_min):
+        """
+        Queues the frames at one frame per st_min on average. Sleeping is only as exact as the OS
+        timer, so the frames that became due meanwhile are queued together (at most max_burst).
+        Returns when the last frame has left the driver. On failure the frames still queued are cancelled
+        before the error is raised, so a retry of the block is never interleaved with stale frames.
+        """
+        start = monotonic()
+        sent = 0
+        futures = []
+        try:
+            while sent < len(frames):
+                if st_min:
+                    due = int((monotonic() - start) / st_min) + 1
+                    end = min(max(due, sent + 1), sent + self.max_burst, len(frames))
+                else:
+                    end = len(frames)
+                futures += self.can_bus.send_many([(self.tx_id, frame) for frame in frames[sent:end]], PRIORITY_BULK,
+                                                  self.is_extended_id, self.tx_id)
+                sent = end
+                if sent < len(frames):
+                    delay = start + sent * st_min - monotonic()
+                    if delay > 0:
+                        sleep(delay)
+            for future in futures:
+                future.result(self.can_bus.tx_timeout)
+        except FutureTimeout:
+            self.cancel(futures)
+            raise TransmitBufferFull("TX timeout")
+        except BaseException:
+            self.cancel(futures)
+            raise
+
+    def cancel(self, futures):
+        """
+        Cancels the frames not sent yet and waits for the one the scheduler is sending
+        """
+        running = [future for future in futures if not future.cancel()]
+        for future in running:
+            try:
+                future.result()
+            except Exception:
+                pass
+        cancelled = len(futures) - len(running)
+        if cancelled:
+            log_fields(logger, logging.DEBUG, "frames cancelled", tx_id=self.tx_id, count=cancelled)
@@ -0,0 +1,87 @@
+import threading
+from collections import deque
+
+# samples needed before the learned timeout replaces the initial one
+MIN_SAMPLES = 3
+# longest wait for a register that has never answered, as a multiple of the initial timeout
+UNANSWERED_MAX_BACKOFF = 4
+
+
+class LatencyEstimator:
+    """
+    Running response time estimate of one device register: EWMA and a percentile of the recent samples
+    """
+
+    def __init__(self, alpha=0.125, window=32):
+        self.alpha = alpha
+        self.samples = deque(maxlen=window)
+        self.ewma = None
+        self.sorted_samples = None
+        # doubled on every timeout, reset by the next reply
+        self.backoff = 1
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.sorted_samples = None
+        self.backoff = 1
+        if self.ewma is None:
+            self.ewma = seconds
+        else:
+            self.ewma += self.alpha * (seconds - self.ewma)
+
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        if self.sorted_samples is None:
+            self.sorted_samples = sorted(self.samples)
+        index = min(int(q * len(self.sorted_samples)), len(self.sorted_samples) - 1)
+        return self.sorted_samples[index]
+
+
+class LatencyTracker:
+    """
+    Response timeouts learned per device register.
+
+    The timeout is the larger of 2 * EWMA and margin * p95 of the observed response times, clamped
+    between min_ms and max_ms. max_ms is how long a dead device is waited for. Replies to retried
+    requests are not sampled, they can not be told apart from a late reply to the first try.
+    """
+
+    def __init__(self, min_ms=10, max_ms=1000, margin=1.5):
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.margin = margin
+
+        self.lock = threading.Lock()
+        self.estimators = {}
+
+    def get_estimator(self, key) -> LatencyEstimator:
+        estimator = self.estimators.get(key)
+        if estimator is None:
+            estimator = self.estimators[key] = LatencyEstimator()
+        return estimator
+
+    def sample(self, key, seconds):
+        with self.lock:
+            self.get_estimator(key).add(seconds)
+
+    def timed_out(self, key):
+        with self.lock:
+            estimator = self.get_estimator(key)
+            # a register that never answered is probably not supported, do not wait for it up to max_ms
+            max_backoff = 64 if estimator.samples else UNANSWERED_MAX_BACKOFF
+            estimator.backoff = min(estimator.backoff * 2, max_backoff)
+
+    def timeout_ms(self, key, initial_ms, max_ms=None):
+        """
+        Learned timeout, initial_ms until MIN_SAMPLES replies have been seen
+        """
+        max_ms = self.max_ms if max_ms is None else max_ms
+        with self.lock:
+            estimator = self.get_estimator(key)
+            if len(estimator.samples) < MIN_SAMPLES:
+                timeout = initial_ms
+            else:
+                timeout = max(2 * estimator.ewma, self.margin * estimator.percentile(0.95)) * 1000
+            timeout *= estimator.backoff
+        return min(max(timeout, self.min_ms), max_ms)
@@ -0,0 +1,188 @@
+"""
+Statistics of the csv/<bms_id>/<date>_<bms_id>.csv files written by CsvDataLogging.
+
+Every file (a session) is parsed into one float array with numpy, unknown values are NaN,
+and reduced to a row of summary values. Sessions are merged per battery.
+"""
+import io
+import logging
+import re
+import warnings
+from math import nan
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+from .bmsinfo import CSV_TEST_COLUMNS, CELL_COUNT, ERROR_FLAGS, BQ_SYS_STAT_FLAGS, warn_cell_voltage_diff, \
+    warn_temperature_diff
+
+logger = logging.getLogger('log-analysis')
+
+COLUMN = {name: i for i, name in enumerate(CSV_TEST_COLUMNS)}
+CELLS = slice(COLUMN["cell_1"], COLUMN["cell_1"] + CELL_COUNT)
+# the temperatures ui_warn_temperature_diff compares
+PACK_TEMPS = [COLUMN["pack_left_temp"], COLUMN["pack_center_temp"], COLUMN["pack_right_temp"]]
+
+# empty fields (unknown values) and the None of older files
+UNKNOWN = re.compile(r"(?<=;)(?=;|$)|None", re.MULTILINE)
+
+ERROR_COLUMNS = [f"error {text}" for _, text in ERROR_FLAGS]
+BQ_COLUMNS = [f"bq {text}" for _, text in BQ_SYS_STAT_FLAGS]
+
+# columns of the summary table, in order
+SUMMARY_COLUMNS = ["level", "bms_id", "session", "sessions", "rows", "start", "end", "duration",
+                   "cell_spread_max", "cell_spread_mean", "cell_spread_warn_rows",
+                   "temp_min", "temp_max", "temp_spread_max", "temp_spread_warn_rows",
+                   "error_rows", *ERROR_COLUMNS, *BQ_COLUMNS,
+                   "soc_drift_mean", "soc_drift_max", "soc_drift_end"]
+
+# how the session values are merged into the battery row
+SUM_COLUMNS = {"sessions", "rows", "duration", "cell_spread_warn_rows", "temp_spread_warn_rows", "error_rows",
+               *ERROR_COLUMNS, *BQ_COLUMNS}
+MIN_COLUMNS = {"start", "temp_min"}
+MAX_COLUMNS = {"end", "cell_spread_max", "temp_max", "temp_spread_max", "soc_drift_max"}
+# weighted by rows
+MEAN_COLUMNS = {"cell_spread_mean", "soc_drift_mean"}
+
+
+def load_csv(path: Path):
+    """
+    The file as a (rows, len(CSV_TEST_COLUMNS)) float array, NaN for unknown values
+    """
+    text = UNKNOWN.sub("nan", Path(path).read_text())
+    try:
+        data = np.loadtxt(io.StringIO(text), delimiter=";", ndmin=2)
+    except ValueError:
+        # a cut or foreign line, parse the complete ones
+        lines = [line for line in text.splitlines() if line.count(";") == len(CSV_TEST_COLUMNS) - 1]
+        data = np.loadtxt(io.StringIO("\n".join(lines)), delimiter=";", ndmin=2)
+    if data.size == 0:
+        return np.empty((0, len(CSV_TEST_COLUMNS)))
+    return data
+
+
+def nan_stat(function, values, default=nan):
+    values = values[~np.isnan(values)]
+    return float(function(values)) if values.size else default
+
+
+def bit_counts(values, flags, mask=0xFF):
+    known = values[~np.isnan(values)].astype(np.int64) & mask
+    return [int(np.count_nonzero(known & bit)) for bit, _ in flags]
+
+
+def session_stats(data, warn_cell_diff=warn_cell_voltage_diff, warn_temp_diff=warn_temperature_diff):
+    """
+    Summary values of one session, data as returned by load_csv
+    """
+    timestamps = data[:, COLUMN["timestamp"]]
+    stats = {"sessions": 1, "rows": len(data)}
+    if not len(data):
+        return stats
+    stats["start"] = float(timestamps.min())
+    stats["end"] = float(timestamps.max())
+    stats["duration"] = stats["end"] - stats["start"]
+
+    with warnings.catch_warnings():
+        # rows without any cell or temperature value yet give NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        cells = data[:, CELLS]
+        # like ui_warn_cell_voltage_diff: only counted above 10 % SOC
+        spread = np.nanmax(cells, axis=1) - np.nanmin(cells, axis=1)
+        soc = data[:, COLUMN["pack_soc"]]
+        stats["cell_spread_max"] = nan_stat(np.max, spread)
+        stats["cell_spread_mean"] = nan_stat(np.mean, spread)
+        stats["cell_spread_warn_rows"] = int(np.count_nonzero((spread > warn_cell_diff) & (soc > 10)))
+
+        temps = data[:, PACK_TEMPS]
+        temp_spread = np.nanmax(temps, axis=1) - np.nanmin(temps, axis=1)
+        stats["temp_min"] = nan_stat(np.min, temps.ravel())
+        stats["temp_max"] = nan_stat(np.max, temps.ravel())
+        stats["temp_spread_max"] = nan_stat(np.max, temp_spread)
+        stats["temp_spread_warn_rows"] = int(np.count_nonzero(temp_spread > warn_temp_diff))
+
+    error_flags = data[:, COLUMN["error_flags"]]
+    stats["error_rows"] = int(np.count_nonzero(error_flags > 0))
+    stats.update(zip(ERROR_COLUMNS, bit_counts(error_flags, ERROR_FLAGS)))
+    stats.update(zip(BQ_COLUMNS, bit_counts(data[:, COLUMN["bq_sys_stat"]], BQ_SYS_STAT_FLAGS, 0x3F)))
+
+    drift = data[:, COLUMN["pack_soc"]] - data[:, COLUMN["coulomb_soc"]]
+    known = drift[~np.isnan(drift)]
+    stats["soc_drift_mean"] = float(known.mean()) if known.size else nan
+    stats["soc_drift_max"] = float(np.abs(known).max()) if known.size else nan
+    stats["soc_drift_end"] = float(known[-1]) if known.size else nan
+    return stats
+
+
+def analyze_file(path: Path):
+    """
+    Runs in the pool processes, returns (path, stats) and stats None when the file can not be read
+    """
+    try:
+        return path, session_stats(load_csv(path))
+    except (OSError, ValueError) as e:
+        logger.error(f"{path}: {e}")
+        return path, None
+
+
+def merge(battery, session):
+    """
+    Adds the values of a session to the battery totals
+    """
+    rows, session_rows = battery.get("rows", 0), session["rows"]
+    for name, value in session.items():
+        current = battery.get(name, nan)
+        if value != value:
+            continue
+        if current != current:
+            battery[name] = value
+        elif name in SUM_COLUMNS:
+            battery[name] = current + value
+        elif name in MIN_COLUMNS:
+            battery[name] = min(current, value)
+        elif name in MAX_COLUMNS:
+            battery[name] = max(current, value)
+        elif name in MEAN_COLUMNS:
+            battery[name] = (current * rows + value * session_rows) / (rows + session_rows)
+        elif name == "soc_drift_end" and session["end"] >= battery["end"]:
+            # "end" is merged before, equal when this is the latest session
+            battery[name] = value
+
+
+def analyze_tree(root: Path, processes=None, sessions=True):
+    """
+    Statistics of every csv file under root, files are parsed in a process pool.
+    Returns the summary rows: a "session" row per file (when sessions) and a "battery" row per bms_id.
+    """
+    # exported history windows repeat rows of the logged files
+    files = [path for path in sorted(Path(root).glob("*/*.csv")) if not path.name.startswith("history_")]
+    logger.info(f"analyzing {len(files)} files")
+
+    rows = []
+    batteries = {}
+    with Pool(processes) as pool:
+        for path, stats in pool.imap_unordered(analyze_file, files, chunksize=32):
+            if stats is None or not stats["rows"]:
+                continue
+            bms_id = path.parent.name
+            merge(batteries.setdefault(bms_id, {"level": "battery", "bms_id": bms_id}), stats)
+            if sessions:
+                rows.append({"level": "session", "bms_id": bms_id, "session": path.name, **stats})
+
+    rows.sort(key=lambda row: (row["bms_id"], row.get("start", 0)))
+    return [batteries[bms_id] for bms_id in sorted(batteries)] + rows
+
+
+def format_value(value):
+    if value is None or value != value:
+        return ""
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return f"{value}"
+
+
+def write_summary(rows, output):
+    output.write(";".join(SUMMARY_COLUMNS) + "\n")
+    for row in rows:
+        output.write(";".join(format_value(row.get(name)) for name in SUMMARY_COLUMNS) + "\n")
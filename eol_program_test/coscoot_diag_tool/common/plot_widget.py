@@ -0,0 +1,242 @@
+"""
+Trend plot of a RingHistory: the cell voltages, pack current and temperatures in three panels.
+
+The time axis is divided into slots of one pixel, a slot is drawn as the min/max range of its
+samples. The traces are kept in a pixmap that is scrolled when time advances, new samples only
+redraw the newest slot. The whole pixmap is redrawn when the widget is resized, a trace leaves
+the value range of its panel or another battery is connected.
+"""
+import logging
+import warnings
+
+import numpy as np
+from PyQt5.QtCore import Qt, QTimer, QLineF, QRect
+from PyQt5.QtGui import QColor, QPainter, QPixmap, QPen
+from PyQt5.QtWidgets import QWidget
+
+from .ring_history import RingHistory, CELL_COLUMNS
+
+logger = logging.getLogger('plot')
+
+TEMPERATURE_COLUMNS = ["fet_temp", "pack_left_temp", "pack_center_temp", "pack_right_temp",
+                       "temp_ts_1", "temp_ts_2", "temp_ts_3"]
+
+BACKGROUND = QColor(20, 20, 20)
+GRID = QColor(70, 70, 70)
+TEXT = QColor(200, 200, 200)
+LABEL_WIDTH = 72
+
+
+class Panel:
+    """
+    Traces sharing a value range, values are divided by unit_divider for the labels
+    """
+
+    def __init__(self, title, columns, unit, unit_divider=1, min_range=1.0):
+        self.title = title
+        self.columns = columns
+        self.unit = unit
+        self.unit_divider = unit_divider
+        self.min_range = min_range
+        self.colors = [QColor.fromHsv(360 * i // len(columns), 200, 240) for i in range(len(columns))]
+        self.low = None
+        self.high = None
+        self.top = 0
+        self.height = 1
+
+    def fits(self, low, high):
+        return self.low is not None and self.low <= low and high <= self.high
+
+    def expand(self, low, high):
+        """
+        Range with a margin, a slowly drifting trace does not redraw the plot every slot
+        """
+        if self.low is not None:
+            low, high = min(low, self.low), max(high, self.high)
+        margin = max(high - low, self.min_range) * 0.1
+        self.low, self.high = low - margin, high + margin
+
+    def y(self, value):
+        return self.top + self.height - (value - self.low) * self.height / (self.high - self.low)
+
+
+def decimate(timestamps, values, slot_time):
+    """
+    Min, max and last value of the samples in every slot: (slots, min, max, last), values is (rows, traces)
+    """
+    slots = np.floor(timestamps / slot_time).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, slots[1:] != slots[:-1]])
+    ends = np.r_[starts[1:], len(slots)] - 1
+    return slots[starts], np.fmin.reduceat(values, starts), np.fmax.reduceat(values, starts), values[ends]
+
+
+def value_range(lows, highs):
+    with warnings.catch_warnings():
+        # a trace without any value yet
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmin(lows), np.nanmax(highs)
+
+
+class PlotWidget(QWidget):
+    """
+    Plots the last `span` seconds of a RingHistory, checked for new samples `fps` times a second
+    """
+
+    def __init__(self, history: RingHistory, span=600.0, fps=30, parent=None):
+        super().__init__(parent)
+        self.history = history
+        self.span = span
+        self.panels = [Panel("Cells", CELL_COLUMNS, "V", 1000, 10),
+                       Panel("Current", ["current"], "A", 1000, 100),
+                       Panel("Temperature", TEMPERATURE_COLUMNS, "°C", 1, 2)]
+        self.columns = [column for panel in self.panels for column in panel.columns]
+
+        self.pixmap = None
+        self.slot_time = 1.0
+        self.bms_id_int = 0
+        # newest drawn slot, the values its traces start from (last of the slot before) and end at
+        self.last_slot = None
+        self.start_values = None
+        self.last_values = None
+        # samples drawn in the newest slot
+        self.last_count = 0
+        self.setMinimumSize(400, 300)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)  # noqa
+        self.timer.start(max(int(1000 / fps), 1))
+
+    def resizeEvent(self, event):
+        self.redraw()
+        super().resizeEvent(event)
+
+    def redraw(self):
+        """
+        Draws everything again from the history
+        """
+        width, height = max(self.width() - LABEL_WIDTH, 1), max(self.height(), 1)
+        self.pixmap = QPixmap(width, height)
+        self.pixmap.fill(BACKGROUND)
+        self.slot_time = self.span / width
+        self.bms_id_int = self.history.bms_id_int
+        self.last_slot = None
+        self.start_values = None
+        self.last_values = None
+        self.last_count = 0
+        for i, panel in enumerate(self.panels):
+            panel.low = panel.high = None
+            panel.top = i * height // len(self.panels) + 4
+            panel.height = height // len(self.panels) - 8
+
+        timestamps, values = self.history.last(self.span, self.columns)
+        if len(timestamps):
+            self.draw(timestamps, values)
+        self.update()
+
+    def poll(self):
+        if self.pixmap is None or not self.isVisible():
+            return
+        if self.history.bms_id_int != self.bms_id_int:
+            self.redraw()
+            return
+        if self.last_slot is None:
+            timestamps, values = self.history.last(self.span, self.columns)
+        else:
+            # the samples of the newest drawn slot again, it is drawn whole
+            timestamps, values = self.history.since(self.last_slot * self.slot_time, self.columns)
+        if len(timestamps) > self.last_count:
+            self.draw(timestamps, values)
+            self.update()
+
+    def draw(self, timestamps, values):
+        slots, lows, highs, lasts = decimate(timestamps, values, self.slot_time)
+
+        offset = 0
+        for panel in self.panels:
+            traces = slice(offset, offset + len(panel.columns))
+            low, high = value_range(lows[:, traces], highs[:, traces])
+            if low == low and not panel.fits(low, high):
+                panel.expand(low, high)
+                if self.last_slot is not None:
+                    # the drawn traces are in the old range
+                    self.redraw()
+                    return
+            offset += len(panel.columns)
+
+        width, height = self.pixmap.width(), self.pixmap.height()
+        newest = int(slots[-1])
+        start_values = None
+        shift = 0
+        if self.last_slot is not None:
+            shift = min(newest - self.last_slot, width)
+            if shift:
+                self.pixmap.scroll(-shift, 0, self.pixmap.rect())
+        painter = QPainter(self.pixmap)
+        if self.last_slot is not None:
+            if shift:
+                painter.fillRect(QRect(width - shift, 0, shift, height), BACKGROUND)
+            if int(slots[0]) == self.last_slot:
+                painter.fillRect(QRect(width - 1 - shift, 0, 1, height), BACKGROUND)
+                start_values = self.start_values
+            else:
+                start_values = self.last_values
+
+        lines = [[] for _ in self.columns]
+        prev = start_values
+        for slot, low_row, high_row, last_row in zip(slots.tolist(), lows.tolist(), highs.tolist(), lasts.tolist()):
+            x = width - 1 - (newest - slot) + 0.5
+            if x > 0:
+                trace = 0
+                for panel in self.panels:
+                    for _ in panel.columns:
+                        low, high = low_row[trace], high_row[trace]
+                        if low == low:
+                            if prev is not None and prev[trace] == prev[trace]:
+                                # continues from where the trace left the slot before
+                                low, high = min(low, prev[trace]), max(high, prev[trace])
+                            lines[trace].append(QLineF(x, panel.y(high), x, panel.y(low) + 1))
+                        trace += 1
+            start_values, prev = prev, last_row
+
+        trace = 0
+        for panel in self.panels:
+            for color in panel.colors:
+                if lines[trace]:
+                    painter.setPen(QPen(color, 1))
+                    painter.drawLines(lines[trace])
+                trace += 1
+        painter.end()
+
+        self.last_slot = newest
+        self.start_values = start_values
+        self.last_values = prev
+        self.last_count = int(np.count_nonzero(np.floor(timestamps / self.slot_time) == newest))
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), BACKGROUND)
+        if self.pixmap is not None:
+            painter.drawPixmap(LABEL_WIDTH, 0, self.pixmap)
+
+        painter.setPen(QPen(GRID, 1, Qt.DotLine))
+        for panel in self.panels:
+            for y in (panel.top, panel.top + panel.height):
+                painter.drawLine(LABEL_WIDTH, y, self.width(), y)
+        painter.setPen(TEXT)
+        for panel in self.panels:
+            painter.drawText(LABEL_WIDTH + 4, panel.top + 12, panel.title)
+            if panel.low is not None:
+                painter.drawText(2, panel.top + 10, f"{panel.high / panel.unit_divider:.2f}{panel.unit}")
+                painter.drawText(2, panel.top + panel.height, f"{panel.low / panel.unit_divider:.2f}{panel.unit}")
+        painter.drawText(self.width() - 60, self.height() - 4, f"{self.span / 60:.0f} min")
+        painter.end()
+
+
+def plot_window(history: RingHistory, title, span=600.0):
+    """
+    PlotWidget as a window of its own
+    """
+    plot = PlotWidget(history, span)
+    plot.setWindowTitle(title)
+    plot.resize(900, 600)
+    return plot
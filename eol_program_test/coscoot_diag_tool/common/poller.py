@@ -0,0 +1,238 @@
+import logging
+import threading
+from collections import deque
+from time import monotonic
+
+from .can_dispatcher import MASK_EXACT
+from .can_tx import PRIORITY_POLL
+from .latency import LatencyTracker
+
+logger = logging.getLogger('poller')
+
+
+class PollRequest:
+    """
+    One register poll: frame sent to tx_id, answered by a frame where (id & rx_mask) == (rx_id & rx_mask)
+    """
+
+    def __init__(self, tx_id, rx_id=None, data=None, timeout_ms=None, rx_mask=MASK_EXACT):
+        self.tx_id = tx_id
+        self.rx_id = tx_id if rx_id is None else rx_id
+        self.rx_mask = rx_mask
+        self.data = [] if data is None else data
+        self.timeout_ms = timeout_ms
+
+        self.attempt = 0
+        self.sent_at = 0
+        self.deadline = 0
+
+    def matches(self, arbitration_id):
+        return arbitration_id & self.rx_mask == self.rx_id & self.rx_mask
+
+
+class PollResult:
+    def __init__(self):
+        self.answered = set()
+        self.missing = set()
+
+
+class PipelinedPoller:
+    """
+    Keeps up to `window` register polls in flight and matches the replies by arbitration ID.
+
+    poll() runs one pass over a list of requests from the polling thread, the frame handlers
+    call reply_received() from the CAN receive thread. Requests that time out are retried
+    `retries` times, everything else is sent only once per pass.
+    Timeouts are learned per tx_id, timeout_ms (or PollRequest.timeout_ms) is only used until
+    the register has answered a few times.
+    """
+
+    def __init__(self, can_bus, window=4, timeout_ms=50, retries=1, max_timeout_ms=500):
+        self.can_bus = can_bus
+        self.window = max(window, 1)
+        self.timeout_ms = timeout_ms
+        self.max_timeout_ms = max_timeout_ms
+        self.retries = retries
+        self.latency = LatencyTracker(max_ms=max_timeout_ms)
+
+        self.condition = threading.Condition()
+        self.outstanding = []
+        self.answered = []
+
+    def reply_received(self, arbitration_id):
+        """
+        Returns the response time in seconds if the frame answered an outstanding poll, otherwise None
+        """
+        with self.condition:
+            for request in self.outstanding:
+                if request.matches(arbitration_id):
+                    self.outstanding.remove(request)
+                    self.answered.append(request)
+                    self.condition.notify()
+                    response_time = monotonic() - request.sent_at
+                    if request.attempt == 1:
+                        self.latency.sample(request.tx_id, response_time)
+                    return response_time
+        return None
+
+    def send(self, requests):
+        """
+        Called with the condition held. The condition is released while the frames are queued:
+        a full TX queue blocks submit() and reply_received() must never wait for that
+        """
+        timeouts = []
+        for request in requests:
+            request.attempt += 1
+            request.sent_at = monotonic()
+            initial_ms = self.timeout_ms if request.timeout_ms is None else request.timeout_ms
+            timeout = self.latency.timeout_ms(request.tx_id, initial_ms, max(initial_ms, self.max_timeout_ms)) / 1000
+            request.deadline = request.sent_at + timeout
+            timeouts.append(timeout)
+            # outstanding before sending, the reply can arrive before submit() returns
+            self.outstanding.append(request)
+
+        self.condition.release()
+        try:
+            for request, timeout in zip(requests, timeouts):
+                try:
+                    self.can_bus.submit(request.tx_id, request.data, priority=PRIORITY_POLL)
+                except Exception as e:
+                    logger.error(f"Could not TX to ask for data! {e}")
+                # the time spent waiting for the TX queue does not count
+                request.deadline = max(request.deadline, monotonic() + timeout)
+        finally:
+            self.condition.acquire()
+
+    def poll(self, requests) -> PollResult:
+        result = PollResult()
+        pending = deque(requests)
+
+        with self.condition:
+            self.outstanding = []
+            self.answered = []
+
+            while pending or self.outstanding:
+                for request in self.answered:
+                    result.answered.add(request.tx_id)
+                self.answered = []
+
+                now = monotonic()
+                for request in [r for r in self.outstanding if r.deadline <= now]:
+                    self.outstanding.remove(request)
+                    self.latency.timed_out(request.tx_id)
+                    if request.attempt <= self.retries:
+                        # only the registers that did not answer are asked again
+                        pending.append(request)
+                    else:
+                        result.missing.add(request.tx_id)
+
+                sending = []
+                while pending and len(self.outstanding) + len(sending) < self.window:
+                    request = pending.popleft()
+                    if any(r.rx_id & r.rx_mask == request.rx_id & request.rx_mask for r in self.outstanding + sending):
+                        # replies could not be told apart, wait for the previous one
+                        pending.appendleft(request)
+                        break
+                    sending.append(request)
+                if sending:
+                    self.send(sending)
+
+                if self.outstanding:
+                    next_deadline = min(r.deadline for r in self.outstanding)
+                    self.condition.wait(max(next_deadline - monotonic(), 0))
+
+            for request in self.answered:
+                result.answered.add(request.tx_id)
+            self.answered = []
+
+        return result
+
+
+class ScheduledPoll:
+    """
+    Register with its own poll period, period None means once per connection
+    """
+
+    def __init__(self, group, tx_id, period, priority=0, rx_id=None, rx_mask=MASK_EXACT, timeout_ms=None, data=None):
+        self.group = group
+        self.tx_id = tx_id
+        self.rx_id = rx_id
+        self.period = period
+        self.priority = priority
+        self.rx_mask = rx_mask
+        self.timeout_ms = timeout_ms
+        self.data = data
+
+        self.deadline = 0
+        self.done = False
+
+    def request(self):
+        data = self.data() if callable(self.data) else self.data
+        return PollRequest(self.tx_id, self.rx_id, data, self.timeout_ms, self.rx_mask)
+
+
+class PollSchedule:
+    """
+    Earliest-deadline-first poll scheduler.
+
+    Every register has its own period and priority (lower is more important, used when deadlines tie),
+    registers without a period are polled until they answer once and again after reset_group().
+    """
+
+    def __init__(self, retry_period=1.0):
+        self.retry_period = retry_period
+        self.entries = {}
+        # groups of the devices that are timed out
+        self.timed_out = set()
+
+    def set_group(self, group, polls):
+        """
+        Replace the registers of one device, registers that stay keep their deadlines
+        """
+        polls = {p.tx_id: p for p in polls}
+        for tx_id in [k for k, e in self.entries.items() if e.group == group and k not in polls]:
+            del self.entries[tx_id]
+        for tx_id, poll in polls.items():
+            entry = self.entries.get(tx_id)
+            if entry is None or entry.group != group:
+                self.entries[tx_id] = poll
+            else:
+                entry.period = poll.period
+                entry.priority = poll.priority
+                entry.timeout_ms = poll.timeout_ms
+                entry.data = poll.data
+
+    def reset_group(self, group):
+        for entry in self.entries.values():
+            if entry.group == group:
+                entry.deadline = 0
+                entry.done = False
+
+    def set_timed_out(self, group, timed_out):
+        """
+        Called on every pass with the timeout state of a device. Its registers are polled from the start
+        once when it times out, resetting them on every pass would fill each pass with the absent device.
+        """
+        if not timed_out:
+            self.timed_out.discard(group)
+        elif group not in self.timed_out:
+            self.timed_out.add(group)
+            self.reset_group(group)
+
+    def due(self, now, limit=None):
+        due = [e for e in self.entries.values() if not e.done and e.deadline <= now]
+        due.sort(key=lambda e: (e.deadline, e.priority))
+        return due[:limit] if limit else due
+
+    def next_deadline(self):
+        deadlines = [e.deadline for e in self.entries.values() if not e.done]
+        return min(deadlines) if deadlines else None
+
+    def completed(self, polls, result: PollResult, now):
+        for entry in polls:
+            if entry.period is None:
+                entry.done = entry.tx_id in result.answered
+                entry.deadline = now + self.retry_period
+            else:
+                # keep the rate, but do not try to catch up on missed polls
+                entry.deadline = max(entry.deadline + entry.period, now)
@@ -1,6 +1,54 @@
-from can import interface, Message, CanError
+import logging
+import threading
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from can import interface, Message
 from .settings import settings as settings_data
 from .helper import str2bool, TransmitBufferFull
+from .can_dispatcher import CanDispatcher, Subscription, MASK_EXACT
+from .can_tx import TxScheduler, PRIORITY_CONTROL, PRIORITY_BULK
+from .tracing import FrameTrace, log_fields
+
+logger = logging.getLogger('pycan')
+
+
+def is_extended(can_id):
+    """
+    IDs above 0xFF are sent with 29-bit identifiers on the scooter bus
+    """
+    return can_id > 0xFF
+
+
+def can_filter(can_id, can_mask=MASK_EXACT, extended=None):
+    """
+    Acceptance filter of one ID class, extended defaults to the class the ID is sent with
+    """
+    if extended is None:
+        extended = is_extended(can_id)
+    return {"can_id": can_id & can_mask, "can_mask": can_mask, "extended": extended}
+
+
+def merge_filters(filters, max_filters=1):
+    """
+    Fewer filters for drivers with a limited number of acceptance code/mask pairs (kvaser has one).
+
+    Each ID class is merged into the smallest single filter accepting everything its filters accept.
+    When there are still too many, only the class with the most filters (the 29-bit one here) is
+    kept: kvaser applies a filter to its own class only, frames of the other class pass unfiltered
+    and are matched by the dispatcher.
+    """
+    classes = {}
+    for f in filters:
+        classes.setdefault(f["extended"], []).append(f)
+
+    merged = []
+    for extended, group in sorted(classes.items(), key=lambda item: len(item[1]), reverse=True):
+        can_id = group[0]["can_id"]
+        can_mask = MASK_EXACT
+        for f in group:
+            can_mask &= f["can_mask"] & ~(f["can_id"] ^ can_id)
+        merged.append(can_filter(can_id, can_mask, extended))
+    return merged[:max_filters]
 
 
 class PyCan:
@@ -9,38 +57,123 @@ class PyCan:
         self.channel = config.get("CAN", "channel", "can0")
         self.bitrate = config.get("CAN", "bitrate", 250000, int)
         self.bus: interface.Bus = None
-        self.no_clear_buf = not config.get("CAN", "clear_buf", True, str2bool)
         self.can_status = 0
+        self.trace = FrameTrace()
+        self.dispatcher = CanDispatcher(self, config.get("CAN", "rx_timeout", 500, int))
+        self.tx_timeout = config.get("CAN", "tx_timeout", 1000, int) / 1000
+        self.tx = TxScheduler(self, self.bitrate,
+                              config.get("CAN", "max_bus_load", 50, int),
+                              config.get("CAN", "tx_queue_size", 256, int))
+
+        # acceptance filters, installed in the driver/kernel so unwanted frames never reach Python
+        self.hw_filters = config.get("CAN", "hw_filters", True, str2bool)
+        self.max_filters = config.get("CAN", "max_filters", 1 if self.bustype == "kvaser" else 0, int)
+        self.filter_lock = threading.RLock()
+        self.filter_groups = {}
+        self.active_filters = None
 
     def init_can(self):
         self.close()
         if self.bus is not None:
             print("RESETTING CAN")
 
-        self.bus = interface.Bus(bustype=self.bustype, channel=self.channel, bitrate=self.bitrate)
+        with self.filter_lock:
+            self.bus = interface.Bus(bustype=self.bustype, channel=self.channel, bitrate=self.bitrate,
+                                     can_filters=self.active_filters)
+        self.dispatcher.start()
+        self.tx.start()
+
+    def set_filter_group(self, name, filters):
+        """
+        Replace one named group of acceptance filters (e.g. registers of one battery, bootloader session).
+
+        The union of all groups is programmed with a single set_filters() call,
+        so the bus never runs with a half updated filter set.
+        """
+        with self.filter_lock:
+            filters = list(filters)
+            if self.filter_groups.get(name) == filters:
+                return
+            if filters:
+                self.filter_groups[name] = filters
+            else:
+                self.filter_groups.pop(name, None)
+            self.apply_filters()
+
+    def build_filters(self):
+        if not self.hw_filters or not self.filter_groups:
+            return None
+
+        filters = []
+        for group in self.filter_groups.values():
+            for f in group:
+                if f not in filters:
+                    filters.append(f)
+
+        if self.max_filters and len(filters) > self.max_filters:
+            filters = merge_filters(filters, self.max_filters)
+        return filters
 
-    def send_data(self, msg_type, msg, is_extended_id=False, update_can_status=True):
-        if msg_type > 0xFF:
+    def apply_filters(self):
+        with self.filter_lock:
+            filters = self.build_filters()
+            if filters == self.active_filters:
+                return
+            self.active_filters = filters
+            if self.bus is not None:
+                log_fields(logger, logging.DEBUG, "acceptance filters", filters=filters)
+                self.bus.set_filters(filters)
+
+    def subscribe(self, handler, arbitration_id, mask=None) -> Subscription:
+        return self.dispatcher.subscribe(handler, arbitration_id, mask)
+
+    def unsubscribe(self, subscription: Subscription):
+        self.dispatcher.unsubscribe(subscription)
+
+    def make_message(self, msg_type, msg, is_extended_id=False):
+        if is_extended(msg_type):
             is_extended_id=True
-        msg = Message(arbitration_id=msg_type,
-                          data=msg,
-                          is_extended_id=is_extended_id)
-        # self.bus.Message(msg_type, [], False)
+        return Message(arbitration_id=msg_type,
+                       data=msg,
+                       is_extended_id=is_extended_id)
+
+    def submit(self, msg_type, msg, is_extended_id=False, priority=PRIORITY_CONTROL, update_can_status=True, flow=None):
+        """
+        Queue a frame for sending, the returned future completes when the frame has left the driver
+        """
+        return self.tx.submit(self.make_message(msg_type, msg, is_extended_id), priority, update_can_status,
+                              self.tx_timeout, flow)
+
+    def send_many(self, frames, priority=PRIORITY_BULK, is_extended_id=False, flow=None):
+        """
+        Queue (msg_type, data) frames in order, returns one future per frame.
+        Frames of different flows share the bus time fairly (see TxScheduler).
+        When a frame cannot be queued the ones queued before it are cancelled.
+        """
+        futures = []
+        try:
+            for msg_type, msg in frames:
+                futures.append(self.submit(msg_type, msg, is_extended_id, priority, False, flow))
+        except TransmitBufferFull:
+            for future in futures:
+                future.cancel()
+            raise
+        return futures
+
+    def send_data(self, msg_type, msg, is_extended_id=False, update_can_status=True, priority=PRIORITY_CONTROL):
+        future = self.submit(msg_type, msg, is_extended_id, priority, update_can_status)
         try:
-            self.bus.send(msg)
-            if update_can_status:
-                self.can_status = 1
-            # print("Message sent on {}".format(self.bus.channel_info))
-        except CanError as e:
-            # print(f"Message NOT sent: {e}")
-            error_str = str(e)
-            if error_str.find("[Errno 105]") < 0 and error_str.find("Transmit buffer overflow") < 0 and error_str.find("[Error Code 105]") < 0 :  # Is not [Errno 105] No buffer space available
-                if update_can_status:
-                    self.can_status = 0
-                raise
-            raise TransmitBufferFull("Buffer full") from e
+            future.result(self.tx_timeout)
+        except FutureTimeout:
+            # a frame reported as not sent must not go out later
+            if future.cancel():
+                raise TransmitBufferFull("TX timeout")
+            # the scheduler is sending it already
+            future.result()
 
     def close(self):
+        self.tx.stop()
+        self.dispatcher.stop()
         if self.bus is not None:
             self.bus.shutdown()
 
@@ -55,28 +188,6 @@ class PyCan:
         # self.ch1.busOff()
         pass
 
-    def read_data(self, timeout_in_ms=0):
-        try:
-            return self.bus.recv(timeout_in_ms/1000)
-        except CanError:
-            self.can_status = 0
-            # print("Message NOT received, canerror")
-            raise
-
-    def clear_buf(self):
-        if self.no_clear_buf:
-            return
-
-        while 1:
-            try:
-                bms_data = self.read_data(0)
-                if bms_data is None:
-                    return
-
-            except Exception as e:
-                print("clear buf exception: ", e)
-                return
-
     def __enter__(self):
         self.init_can()
         return self
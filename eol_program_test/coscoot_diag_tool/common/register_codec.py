@@ -0,0 +1,106 @@
+import logging
+from struct import Struct
+
+logger = logging.getLogger('register-codec')
+
+# longest classic CAN payload
+MAX_DLC = 8
+
+
+def version_number(values):
+    """
+    Firmware version bytes (major, minor, patch, build) as one number, e.g. 8.0.0.56 -> 8000056
+    """
+    return values[0] * 1000000 + values[1] * 10000 + values[2] * 100 + values[3],
+
+
+class RegisterLayout:
+    """
+    One DLC variant of a register: precompiled struct, target attribute names and scale divisors.
+
+    Fields named None are skipped. convert(values) may turn the unpacked tuple into the field
+    values (e.g. version bytes into one number), apply(target, values) replaces the setattr loop.
+    """
+
+    def __init__(self, fmt, fields=(), scale=None, convert=None, apply=None):
+        self.struct = Struct(fmt)
+        self.size = self.struct.size
+        self.fields = tuple(fields)
+        self.scale = scale or {}
+        self.convert = convert
+        self.apply = apply
+        self.padding = bytes(self.size)
+
+    def decode(self, target, data):
+        if len(data) < self.size:
+            # short frames are zero padded like the firmware does
+            data = bytes(data) + self.padding[len(data):]
+        values = self.struct.unpack_from(data)
+        if self.convert is not None:
+            values = self.convert(values)
+
+        if self.apply is not None:
+            self.apply(target, values)
+            return values
+
+        scale = self.scale
+        for field, value in zip(self.fields, values):
+            if field is not None:
+                if field in scale:
+                    value = value / scale[field]
+                setattr(target, field, value)
+        return values
+
+
+class Register:
+    """
+    Register decoded with the layout matching the frame length, `default` is used for all other lengths.
+    post(target, context) runs after decoding, for fields derived from several registers.
+    """
+
+    def __init__(self, key, *layouts: RegisterLayout, default: RegisterLayout = None, post=None):
+        self.key = key
+        self.name = f"{key:x}" if isinstance(key, int) else str(key)
+        self.post = post
+
+        if default is None:
+            default = layouts[-1]
+        by_length = {layout.size: layout for layout in layouts}
+        # resolved once, decoding is a list index
+        self.layouts = [by_length.get(length, default) for length in range(MAX_DLC + 1)]
+
+    def decode(self, target, data, context=None):
+        length = len(data)
+        layout = self.layouts[length] if length <= MAX_DLC else self.layouts[MAX_DLC]
+        values = layout.decode(target, data)
+        if self.post is not None:
+            self.post(target, context)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: %s", self.name, dict(zip(layout.fields, values)))
+
+
+class RegisterCodec:
+    """
+    Dispatch table from register key (register number, arbitration ID, ...) to its Register
+    """
+
+    def __init__(self, registers=()):
+        self.registers = {}
+        for register in registers:
+            self.add(register)
+
+    def add(self, register: Register):
+        self.registers[register.key] = register
+
+    def get(self, key) -> Register:
+        return self.registers.get(key)
+
+    def decode(self, key, target, data, context=None):
+        """
+        Returns False for unknown registers
+        """
+        register = self.registers.get(key)
+        if register is None:
+            return False
+        register.decode(target, data, context)
+        return True
@@ -0,0 +1,161 @@
+import logging
+import threading
+from datetime import datetime
+from math import nan
+from pathlib import Path
+
+import numpy as np
+
+from .bmsinfo import BmsInfo, CELL_COUNT, log_cells
+from .session_log import SCHEMA, TEXT_FIELDS, CELL_COLUMNS, FLOAT_FIELDS, BOOL_FIELDS
+
+logger = logging.getLogger('ring-history')
+
+# every numeric BmsInfo field, the cell voltages as cell_1 ... cell_12
+COLUMNS = [name for name, _ in SCHEMA if name not in TEXT_FIELDS]
+FIELDS = COLUMNS[:-CELL_COUNT]
+
+
+def from_float(name, value):
+    if value != value:
+        return None
+    if name in FLOAT_FIELDS:
+        return value
+    if name in BOOL_FIELDS:
+        return bool(value)
+    return int(value)
+
+
+class RingHistory:
+    """
+    The last `window` seconds of one battery slot in fixed size numpy arrays, at most `rate` rows a second.
+
+    append() is O(1) and called from the worker thread, the queries copy the rows they need under
+    the lock. The buffer is cleared when another battery is connected.
+    """
+
+    def __init__(self, window=1800.0, rate=2.0):
+        self.window = window
+        self.period = 1 / rate
+        self.capacity = int(window * rate) + 1
+        self.timestamps = np.full(self.capacity, nan)
+        self.values = np.full((self.capacity, len(COLUMNS)), nan)
+        self.column = {name: i for i, name in enumerate(COLUMNS)}
+
+        self.lock = threading.Lock()
+        self.head = 0
+        self.count = 0
+        self.bms_id_int = 0
+
+    def clear(self):
+        with self.lock:
+            self.head = 0
+            self.count = 0
+
+    def append(self, timestamp, data: BmsInfo):
+        """
+        Returns False when the row was skipped (faster than rate or no battery)
+        """
+        if not data.bms_id_int:
+            return False
+        if data.bms_id_int != self.bms_id_int:
+            self.clear()
+            self.bms_id_int = data.bms_id_int
+        elif self.count and timestamp - self.timestamps[self.head - 1] < self.period:
+            return False
+
+        row = [getattr(data, field) for field in FIELDS]
+        row.extend(log_cells(data.cell_voltages))
+        with self.lock:
+            self.timestamps[self.head] = timestamp
+            self.values[self.head] = [nan if value is None else value for value in row]
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+        return True
+
+    def last(self, seconds=None, names=None):
+        """
+        (timestamps, values) of the last seconds (everything when None) in time order,
+        values has a column per name (all COLUMNS when None)
+        """
+        columns = slice(None) if names is None else [self.column[name] for name in names]
+        with self.lock:
+            start = (self.head - self.count) % self.capacity
+            if start + self.count <= self.capacity:
+                rows = slice(start, start + self.count)
+            else:
+                rows = np.r_[start:self.capacity, 0:self.head]
+            timestamps = self.timestamps[rows].copy()
+            values = self.values[rows][:, columns].copy()
+        if seconds is not None and len(timestamps):
+            first = np.searchsorted(timestamps, timestamps[-1] - seconds, "left")
+            timestamps, values = timestamps[first:], values[first:]
+        return timestamps, values
+
+    def since(self, timestamp, names=None):
+        """
+        (timestamps, values) of the rows from timestamp on, like last() but the cost follows the
+        number of returned rows
+        """
+        columns = slice(None) if names is None else [self.column[name] for name in names]
+        with self.lock:
+            count = 0
+            while count < self.count and self.timestamps[(self.head - 1 - count) % self.capacity] >= timestamp:
+                count += 1
+            rows = [(self.head - count + i) % self.capacity for i in range(count)]
+            return self.timestamps[rows], self.values[rows][:, columns]
+
+    def downsample(self, name, seconds=None, buckets=500):
+        """
+        Min, max and mean of a column in `buckets` time buckets: (timestamps, min, max, mean),
+        timestamps are the bucket starts, unknown values are ignored and empty buckets left out
+        """
+        timestamps, values = self.last(seconds, [name])
+        values = values[:, 0]
+        if not len(timestamps):
+            empty = np.empty(0)
+            return empty, empty, empty, empty
+        span = max(timestamps[-1] - timestamps[0], 1e-9)
+        bucket = np.minimum(((timestamps - timestamps[0]) * (buckets / span)).astype(np.int64), buckets - 1)
+        starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+
+        known = ~np.isnan(values)
+        counts = np.add.reduceat(known, starts)
+        sums = np.add.reduceat(np.where(known, values, 0), starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = sums / counts
+        return (timestamps[starts], np.fmin.reduceat(values, starts), np.fmax.reduceat(values, starts), mean)
+
+    def rows(self, seconds=None):
+        """
+        The rows as BmsInfo objects
+        """
+        timestamps, values = self.last(seconds)
+        for timestamp, row in zip(timestamps, values.tolist()):
+            data = BmsInfo()
+            for name, value in zip(FIELDS, row):
+                setattr(data, name, from_float(name, value))
+            data.cell_voltages = [from_float(name, value) for name, value in zip(CELL_COLUMNS, row[len(FIELDS):])]
+            data.timestamp = timestamp
+            data.bms_id = f"{data.bms_id_int:08x}"
+            yield data
+
+    def export_csv(self, seconds=None, folder=Path("exports")):
+        """
+        Writes the last seconds in the to_csv_test layout to exports/<bms_id>/history_<date>_<bms_id>.csv,
+        returns the file path or None when there is nothing to export. The exports are kept out of
+        the csv/ tree, they repeat rows the csv log already has.
+        """
+        if not self.count:
+            return None
+        bms_id = f"{self.bms_id_int:08x}"
+        path = folder / bms_id / f"history_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}_{bms_id}.csv"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        count = 0
+        with open(path, "w") as output:
+            for data in self.rows(seconds):
+                output.write(data.to_csv_test())
+                output.write("\n")
+                count += 1
+        logger.info(f"exported {count} rows to {path}")
+        return path
@@ -0,0 +1,358 @@
+"""
+Columnar binary session log, append only.
+
+    header:  MAGIC, uint32 schema length, schema json [[name, dtype], ...], zero padded to 8 bytes
+    chunk:   CHUNK header (magic, rows, bms_id_int, t_min, t_max), then every column as
+             rows * itemsize bytes of little endian values, each zero padded to 8 bytes
+
+A chunk holds rows of one battery. The sidecar <log>.idx has an INDEX record per chunk
+(bms_id_int, rows, offset, t_min, t_max), it is rebuilt from the chunk headers when missing.
+Unknown (None) values are NaN in float columns, INT_NONE in int columns and -1 in bool columns.
+"""
+import json
+import logging
+from math import isnan
+from pathlib import Path
+from struct import Struct
+
+import numpy as np
+
+from .bmsinfo import BmsInfo, CELL_COUNT, log_cells
+
+logger = logging.getLogger('session-log')
+
+MAGIC = b"BMSLOG\x01\x00"
+SCHEMA_LENGTH = Struct("<I")
+CHUNK = Struct("<4sIIxxxxdd")
+CHUNK_MAGIC = b"CHNK"
+INDEX = Struct("<IIQdd")
+
+INT_NONE = -1 << 63
+
+FLOAT_FIELDS = {"timestamp", "unix_time", "time_diff", "ambient_temp", "up_time", "cpu_usage", "cpu_temp",
+                "mem_usage", "storage_usage"}
+BOOL_FIELDS = {"can_bus", "can_problem", "is_slow_charging", "is_reg_fc"}
+TEXT_FIELDS = {"sw_upgrade_text", "production_date", "production_message"}
+TEXT_SIZE = 32
+# derived from bms_id_int or not data
+SKIPPED_FIELDS = {"bms_id", "cell_voltages", "cell_deltas", "version", "last_snapshot"}
+
+CELL_COLUMNS = [f"cell_{i + 1}" for i in range(CELL_COUNT)]
+
+
+def dtype_of(field):
+    if field in FLOAT_FIELDS:
+        return "<f8"
+    if field in BOOL_FIELDS:
+        return "<i1"
+    if field in TEXT_FIELDS:
+        return f"S{TEXT_SIZE}"
+    return "<i8"
+
+
+# every BmsInfo field, the cell voltages as one column per cell
+SCHEMA = [(field, dtype_of(field)) for field in BmsInfo.__slots__ if field not in SKIPPED_FIELDS] + \
+         [(column, "<i8") for column in CELL_COLUMNS]
+
+
+def padded(size):
+    return (size + 7) & ~7
+
+
+class Column:
+    """
+    Packing of one column: encode(value) gives the stored value, decode(value) the BmsInfo one
+    """
+
+    def __init__(self, name, dtype):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.itemsize = self.dtype.itemsize
+        kind = dtype[1:] if dtype[0] == "<" else dtype
+        if kind == "f8":
+            self.code, self.encode, self.decode = "d", encode_float, decode_float
+        elif kind == "i1":
+            self.code, self.encode, self.decode = "b", encode_bool, decode_bool
+        elif kind == "i8":
+            self.code, self.encode, self.decode = "q", encode_int, decode_int
+        else:
+            self.code, self.encode, self.decode = f"{self.itemsize}s", encode_text, decode_text
+
+    def pack(self, values):
+        data = Struct(f"<{len(values)}{self.code}").pack(*values) if self.code[-1] != "s" else b"".join(values)
+        return data + bytes(padded(len(data)) - len(data))
+
+
+def encode_float(value):
+    return float("nan") if value is None else float(value)
+
+
+def decode_float(value):
+    value = float(value)
+    return None if isnan(value) else value
+
+
+def encode_int(value):
+    return INT_NONE if value is None else int(value)
+
+
+def decode_int(value):
+    value = int(value)
+    return None if value == INT_NONE else value
+
+
+def encode_bool(value):
+    return -1 if value is None else int(bool(value))
+
+
+def decode_bool(value):
+    value = int(value)
+    return None if value < 0 else bool(value)
+
+
+def encode_text(value):
+    value = b"" if value is None else str(value).encode()[:TEXT_SIZE]
+    return value.ljust(TEXT_SIZE, b"\0")
+
+
+def decode_text(value):
+    return bytes(value).rstrip(b"\0").decode(errors="replace") or None
+
+
+def index_path(path: Path):
+    return path.with_name(path.name + ".idx")
+
+
+def encode_header(schema):
+    schema_json = json.dumps(schema).encode()
+    header = MAGIC + SCHEMA_LENGTH.pack(len(schema_json)) + schema_json
+    return header + bytes(padded(len(header)) - len(header))
+
+
+class SessionLogWriter:
+    """
+    Appends BmsInfo rows to a session log. Rows are collected per column and written as a chunk
+    when chunk_rows are buffered, chunk_period seconds of data are buffered, the battery changes
+    or on flush()/close().
+    """
+
+    def __init__(self, path: Path, chunk_rows=4096, chunk_period=60.0):
+        self.path = Path(path)
+        self.chunk_rows = chunk_rows
+        self.chunk_period = chunk_period
+        self.columns = [Column(name, dtype) for name, dtype in SCHEMA]
+        self.fields = [name for name, _ in SCHEMA[:-CELL_COUNT]]
+        self.timestamp_column = self.fields.index("timestamp")
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(encode_header(SCHEMA))
+        else:
+            self.check_schema()
+        self.index_file = open(index_path(self.path), "ab")
+
+        self.rows = []
+        self.bms_id_int = 0
+        self.t_min = 0.0
+        self.t_max = 0.0
+
+    def check_schema(self):
+        with open(self.path, "rb") as f:
+            schema = read_header(f.read(4096 * 4))[0]
+        if schema != [list(column) for column in SCHEMA]:
+            raise ValueError(f"{self.path}: schema differs, use a new file")
+
+    def append(self, timestamp, data: BmsInfo):
+        if self.rows and (data.bms_id_int != self.bms_id_int or timestamp - self.t_min >= self.chunk_period):
+            self.flush()
+        if not self.rows:
+            self.bms_id_int = data.bms_id_int
+            self.t_min = timestamp
+            self.t_max = timestamp
+        self.t_max = max(self.t_max, timestamp)
+
+        row = [getattr(data, field) for field in self.fields]
+        row[self.timestamp_column] = timestamp
+        row.extend(log_cells(data.cell_voltages))
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        rows = len(self.rows)
+        offset = self.file.tell()
+        t_min = min(row[self.timestamp_column] for row in self.rows)
+        parts = [CHUNK.pack(CHUNK_MAGIC, rows, self.bms_id_int, t_min, self.t_max)]
+        for column, values in zip(self.columns, zip(*self.rows)):
+            encode = column.encode
+            parts.append(column.pack([encode(value) for value in values]))
+        self.file.write(b"".join(parts))
+        self.file.flush()
+        # the index is written after the chunk, a missing record is recovered by scanning
+        self.index_file.write(INDEX.pack(self.bms_id_int, rows, offset, t_min, self.t_max))
+        self.index_file.flush()
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.index_file.close()
+
+
+def read_header(data):
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise ValueError("not a session log")
+    start = len(MAGIC) + SCHEMA_LENGTH.size
+    length = SCHEMA_LENGTH.unpack_from(data, len(MAGIC))[0]
+    schema = json.loads(bytes(data[start:start + length]))
+    return schema, padded(start + length)
+
+
+class Chunk:
+    def __init__(self, bms_id_int, rows, offset, t_min, t_max):
+        self.bms_id_int = bms_id_int
+        self.rows = rows
+        self.offset = offset
+        self.t_min = t_min
+        self.t_max = t_max
+
+
+class SessionLog:
+    """
+    Memory mapped reader, columns are returned as zero-copy numpy views into the file.
+
+        log = SessionLog(path)
+        for chunk in log.chunks(bms_id_int, start, end):
+            voltage = log.column(chunk, "voltage")
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        schema, self.data_start = read_header(self.data[:4096 * 4])
+        self.columns = [Column(name, dtype) for name, dtype in schema]
+        self.names = [column.name for column in self.columns]
+        self.by_name = {column.name: column for column in self.columns}
+        self.index = self.read_index()
+        self.by_bms_id = {}
+        for chunk in self.index:
+            self.by_bms_id.setdefault(chunk.bms_id_int, []).append(chunk)
+
+    def read_index(self):
+        chunks = []
+        path = index_path(self.path)
+        if path.exists():
+            data = path.read_bytes()
+            usable = len(data) - len(data) % INDEX.size
+            chunks = [Chunk(*record) for record in INDEX.iter_unpack(data[:usable])]
+        offset = self.data_start
+        for chunk in chunks:
+            if chunk.offset != offset:
+                logger.warning(f"{path}: index does not match the log, scanning chunks")
+                return self.scan(self.data_start)
+            offset = self.chunk_end(chunk)
+        # chunks written after the last index record (or no index at all)
+        scanned = self.scan(offset)
+        if scanned and path.exists():
+            logger.warning(f"{path}: {len(scanned)} chunks missing from the index")
+        return chunks + scanned
+
+    def chunk_size(self, rows):
+        return CHUNK.size + sum(padded(rows * column.itemsize) for column in self.columns)
+
+    def chunk_end(self, chunk: Chunk):
+        return chunk.offset + self.chunk_size(chunk.rows)
+
+    def scan(self, offset):
+        chunks = []
+        size = len(self.data)
+        while offset + CHUNK.size <= size:
+            magic, rows, bms_id_int, t_min, t_max = CHUNK.unpack_from(self.data, offset)
+            end = offset + self.chunk_size(rows)
+            if magic != CHUNK_MAGIC or end > size:
+                # partly written last chunk
+                break
+            chunks.append(Chunk(bms_id_int, rows, offset, t_min, t_max))
+            offset = end
+        return chunks
+
+    def bms_ids(self):
+        return sorted(self.by_bms_id)
+
+    def chunks(self, bms_id_int=None, start=None, end=None):
+        """
+        Chunks of one battery (all when None) overlapping the time window [start, end]
+        """
+        chunks = self.index if bms_id_int is None else self.by_bms_id.get(bms_id_int, [])
+        return [chunk for chunk in chunks
+                if (start is None or chunk.t_max >= start)
+                and (end is None or chunk.t_min <= end)]
+
+    def column(self, chunk: Chunk, name):
+        offset = chunk.offset + CHUNK.size
+        for column in self.columns:
+            if column.name == name:
+                return np.ndarray((chunk.rows,), dtype=column.dtype, buffer=self.data, offset=offset)
+            offset += padded(chunk.rows * column.itemsize)
+        raise KeyError(name)
+
+    def cells(self, chunk: Chunk):
+        """
+        Cell voltages as a (rows, cells) array
+        """
+        return np.column_stack([self.column(chunk, name) for name in CELL_COLUMNS])
+
+    def select(self, names, bms_id_int=None, start=None, end=None):
+        """
+        Columns of the rows in [start, end] as {name: array}, a copy when the rows span several chunks
+        """
+        parts = {name: [] for name in names}
+        for chunk in self.chunks(bms_id_int, start, end):
+            rows = slice(None)
+            if (start is not None and chunk.t_min < start) or (end is not None and chunk.t_max > end):
+                # rows are appended in time order, a slice keeps the views zero-copy
+                timestamps = self.column(chunk, "timestamp")
+                first = 0 if start is None else np.searchsorted(timestamps, start, "left")
+                last = chunk.rows if end is None else np.searchsorted(timestamps, end, "right")
+                rows = slice(first, last)
+            for name in names:
+                parts[name].append(self.column(chunk, name)[rows])
+        return {name: values[0] if len(values) == 1 else
+                np.concatenate(values) if values else np.empty(0, self.by_name[name].dtype)
+                for name, values in parts.items()}
+
+    def rows(self, bms_id_int=None, start=None, end=None):
+        """
+        Rows as BmsInfo objects
+        """
+        for chunk in self.chunks(bms_id_int, start, end):
+            columns = [(column, self.column(chunk, column.name).tolist()) for column in self.columns]
+            for i in range(chunk.rows):
+                data = BmsInfo()
+                cells = []
+                for column, values in columns:
+                    value = column.decode(values[i])
+                    if column.name in CELL_COLUMNS:
+                        cells.append(value)
+                    elif column.name in BmsInfo.__slots__:
+                        setattr(data, column.name, value)
+                if (start is not None and data.timestamp < start) or (end is not None and data.timestamp > end):
+                    continue
+                data.cell_voltages = cells
+                data.bms_id = f"{data.bms_id_int:08x}" if data.bms_id_int else None
+                yield data
+
+
+def export_csv(path: Path, output, bms_id_int=None, start=None, end=None):
+    """
+    Writes the rows in the to_csv_test layout of csv/<bms_id>/ files, returns the number of rows
+    """
+    count = 0
+    for data in SessionLog(path).rows(bms_id_int, start, end):
+        output.write(data.to_csv_test())
+        output.write("\n")
+        count += 1
+    return count
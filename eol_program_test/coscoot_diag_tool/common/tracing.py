@@ -0,0 +1,118 @@
+import logging
+import signal
+import threading
+from datetime import datetime
+from pathlib import Path
+from struct import Struct
+from time import time
+
+from can import Message
+
+logger = logging.getLogger('trace')
+
+# timestamp, arbitration id, flags, dlc, data
+TRACE_RECORD = Struct("<dIBB8s")
+TRACE_RX = 0x01
+TRACE_TX = 0x02
+TRACE_EXTENDED = 0x04
+
+HEX_SUFFIXES = ("_id", "checksum")
+
+
+class Fields:
+    """
+    key=value text of structured log fields, only built when a handler formats the record.
+    Integer fields named id, *_id or *checksum and byte strings are written in hex.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        parts = []
+        for key, value in self.fields.items():
+            if isinstance(value, int) and (key == "id" or key.endswith(HEX_SUFFIXES)):
+                parts.append(f"{key}={value:x}")
+            elif isinstance(value, (bytes, bytearray)):
+                parts.append(f"{key}={value.hex()}")
+            else:
+                parts.append(f"{key}={value}")
+        return " ".join(parts)
+
+
+def log_fields(log: logging.Logger, level, msg, **fields):
+    """
+    Log msg with structured fields, nothing is formatted when the level is disabled.
+    The fields are also passed to handlers as record.fields.
+    """
+    if log.isEnabledFor(level):
+        log.log(level, "%s %s", msg, Fields(fields), extra={"fields": fields})
+
+
+class FrameTrace:
+    """
+    Binary trace of every received and sent CAN frame, for frame rates where text logging can not keep up.
+
+    Switched on and off at runtime, each start() creates trace/<date>.bin with TRACE_RECORD records.
+    The receive and transmit threads check `enabled` before calling record().
+    """
+
+    def __init__(self, folder=Path("trace")):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.file = None
+        self.enabled = False
+
+    def start(self):
+        with self.lock:
+            if self.file is not None:
+                return
+            self.folder.mkdir(parents=True, exist_ok=True)
+            path = self.folder / f"{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.bin"
+            self.file = open(path, "ab", buffering=1 << 16)
+            self.enabled = True
+        logger.info(f"frame trace started: {path}")
+
+    def stop(self):
+        with self.lock:
+            self.enabled = False
+            if self.file is None:
+                return
+            self.file.close()
+            self.file = None
+        logger.info("frame trace stopped")
+
+    def toggle(self):
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    def record(self, msg: Message, flags):
+        if msg.is_extended_id:
+            flags |= TRACE_EXTENDED
+        record = TRACE_RECORD.pack(msg.timestamp or time(), msg.arbitration_id, flags, msg.dlc, bytes(msg.data))
+        with self.lock:
+            if self.file is not None:
+                self.file.write(record)
+
+
+def read_trace(path):
+    """
+    Yields (timestamp, arbitration_id, flags, data) from a trace file
+    """
+    with open(path, "rb") as f:
+        while True:
+            record = f.read(TRACE_RECORD.size)
+            if len(record) < TRACE_RECORD.size:
+                return
+            timestamp, arbitration_id, flags, dlc, data = TRACE_RECORD.unpack(record)
+            yield timestamp, arbitration_id, flags, data[:dlc]
+
+
+def install_trace_signal(trace: FrameTrace):
+    """
+    Toggle the trace with SIGUSR1 (kill -USR1 <pid>), where the platform has it
+    """
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: trace.toggle())
@@ -0,0 +1,86 @@
+from .ui_updates import changed_fields
+
+# value of a binding that has never been painted
+UNSET = object()
+
+
+class Binding:
+    """
+    Widget output computed from model fields: compute(model) gives the value, paint(value) draws it.
+    paint is only called when the value differs from the last painted one.
+    """
+
+    def __init__(self, index, inputs, compute, paint):
+        self.index = index
+        self.inputs = tuple(inputs)
+        self.compute = compute
+        self.paint = paint
+        self.value = UNSET
+
+    def refresh(self, model, force=False):
+        value = self.compute(model)
+        if force or value != self.value:
+            self.value = value
+            self.paint(value)
+
+
+class BindingSet:
+    """
+    Bindings of one model object (BmsInfo, USB_Info, CCUData, ...) to the widgets showing it.
+
+    update() re-evaluates only the bindings that depend on a changed field, so the cost of a UI
+    update follows the number of changes instead of the number of widgets.
+    """
+
+    def __init__(self):
+        self.bindings = []
+        self.by_field = {}
+        self.model = None
+
+    def bind(self, inputs, compute, paint) -> Binding:
+        """
+        inputs: field names the compute function reads
+        """
+        binding = Binding(len(self.bindings), inputs, compute, paint)
+        self.bindings.append(binding)
+        for field in binding.inputs:
+            self.by_field.setdefault(field, []).append(binding)
+        return binding
+
+    def bind_field(self, field, paint, text=None):
+        """
+        Shortcut for a widget showing one field, text(value) formats it
+        """
+        if text is None:
+            return self.bind([field], lambda model: getattr(model, field), paint)
+        return self.bind([field], lambda model: text(getattr(model, field)), paint)
+
+    def update(self, model, changed=None, force=False):
+        """
+        changed: names of the changed fields, compared with the previous model when not given.
+        force repaints every binding. Returns the changed field names, all of them when forced.
+        """
+        if force:
+            changed = changed_fields(None, model)
+            bindings = self.bindings
+        else:
+            if changed is None:
+                changed = changed_fields(self.model, model)
+            bindings = self.affected(changed)
+        self.model = model
+
+        for binding in bindings:
+            binding.refresh(model, force)
+        return changed
+
+    def affected(self, changed):
+        """
+        Bindings depending on the changed fields, in the order they were bound
+        """
+        if len(changed) == 1:
+            return self.by_field.get(next(iter(changed)), ())
+        bindings = {}
+        for field in changed:
+            for binding in self.by_field.get(field, ()):
+                bindings[binding.index] = binding
+        return [bindings[index] for index in sorted(bindings)]
@@ -0,0 +1,114 @@
+import logging
+import threading
+from time import monotonic
+
+from PyQt5.QtCore import QTimer
+
+from .tracing import log_fields
+
+logger = logging.getLogger('ui-updates')
+
+# snapshot bookkeeping, not data
+IGNORED_FIELDS = {"version", "last_snapshot"}
+
+
+def field_names(value):
+    names = getattr(type(value), "__slots__", None)
+    if names is None:
+        names = vars(value).keys()
+    return [name for name in names if name not in IGNORED_FIELDS]
+
+
+def changed_fields(prev, value):
+    """
+    Names of the fields that differ between two data objects, all fields when there is no previous one
+    """
+    names = field_names(value)
+    if prev is None or type(prev) is not type(value):
+        return set(names)
+    return {name for name in names if getattr(prev, name) != getattr(value, name)}
+
+
+class UpdateCoalescer:
+    """
+    Collects data updates from the worker and CAN receive threads and hands them to the GUI thread
+    at most `fps` times a second.
+
+    Only the latest value per key (device) is kept, updates replaced before a flush are counted as
+    merged. A handler is called as handler(value, changed) with the names of the fields that changed
+    since its last call, updates that changed nothing are dropped.
+    """
+
+    def __init__(self, fps=20, report_period=10.0):
+        self.interval_ms = max(int(1000 / fps), 1)
+        self.report_period = report_period
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.handlers = {}
+        self.delivered = {}
+        self.timer = None
+
+        self.submitted = 0
+        self.merged = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.reported = (0, 0, 0, 0)
+        self.last_report = monotonic()
+
+    def add_handler(self, key, handler):
+        self.handlers[key] = handler
+
+    def start(self, parent=None):
+        """
+        Starts flushing from the Qt event loop, call from the GUI thread
+        """
+        self.timer = QTimer(parent)
+        self.timer.timeout.connect(self.flush)  # noqa
+        self.timer.start(self.interval_ms)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+
+    def submit(self, key, value):
+        """
+        Queues value for the next flush, thread safe
+        """
+        with self.lock:
+            self.submitted += 1
+            if key in self.pending:
+                self.merged += 1
+            self.pending[key] = value
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        for key, value in pending.items():
+            changed = changed_fields(self.delivered.get(key), value)
+            if not changed:
+                self.dropped += 1
+                continue
+            self.delivered[key] = value
+            self.flushed += 1
+            try:
+                self.handlers[key](value, changed)
+            except Exception as e:
+                logger.error(f"ui update {key}: {e}")
+
+        now = monotonic()
+        if now - self.last_report >= self.report_period:
+            self.report(now)
+
+    def stats(self):
+        with self.lock:
+            return self.submitted, self.merged, self.dropped, self.flushed
+
+    def report(self, now):
+        stats = self.stats()
+        submitted, merged, dropped, flushed = (value - prev for value, prev in zip(stats, self.reported))
+        self.reported = stats
+        self.last_report = now
+        level = logging.INFO if merged or dropped else logging.DEBUG
+        log_fields(logger, level, "ui updates", submitted=submitted, merged=merged, dropped=dropped, flushed=flushed)
@@ -0,0 +1,36 @@
+#!/bin/python3
+"""
+Exports a columnar session log (csv/session_<date>.bmslog) to the semicolon separated csv/<bms_id>/ layout.
+
+    python export_session_log.py csv/session_20240101_120000.bmslog [--bms-id 1234abcd] [--start ts] [--end ts]
+"""
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+from common.session_log import SessionLog, export_csv
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Export a session log to csv")
+    parser.add_argument("log", type=Path)
+    parser.add_argument("--bms-id", help="hex bms id, all batteries when not given")
+    parser.add_argument("--start", type=float, help="unix timestamp")
+    parser.add_argument("--end", type=float, help="unix timestamp")
+    parser.add_argument("--output", type=Path, help="csv file, stdout when not given")
+    parser.add_argument("--list", action="store_true", help="list the batteries in the log")
+    args = parser.parse_args()
+
+    if args.list:
+        log = SessionLog(args.log)
+        for bms_id_int in log.bms_ids():
+            chunks = log.chunks(bms_id_int)
+            print(f"{bms_id_int:08x} rows {sum(chunk.rows for chunk in chunks)} "
+                  f"{min(chunk.t_min for chunk in chunks):.3f} - {max(chunk.t_max for chunk in chunks):.3f}")
+        sys.exit(0)
+
+    bms_id_int = None if args.bms_id is None else int(args.bms_id, 16)
+    if args.output is None:
+        export_csv(args.log, sys.stdout, bms_id_int, args.start, args.end)
+    else:
+        with open(args.output, "w") as output:
+            export_csv(args.log, output, bms_id_int, args.start, args.end)
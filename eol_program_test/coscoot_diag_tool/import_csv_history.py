@@ -0,0 +1,23 @@
+#!/bin/python3
+"""
+One-time import of the csv/<bms_id>/ tree written by CsvDataLogging into the SQLite history
+database (CSV history_db setting). Can be run again, imported files are skipped.
+
+    python import_csv_history.py csv history.db [--processes 8]
+"""
+import logging
+from argparse import ArgumentParser
+from pathlib import Path
+
+from common.history_store import import_csv_tree
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Import csv logs into the history database")
+    parser.add_argument("csv", type=Path, help="csv folder")
+    parser.add_argument("database", type=Path)
+    parser.add_argument("--processes", type=int, help="parser processes, cpu count when not given")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    count = import_csv_tree(args.csv, args.database, args.processes)
+    print(f"imported {count} files")
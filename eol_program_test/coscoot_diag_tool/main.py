@@ -1,20 +1,32 @@
 import time
 from configparser import ConfigParser
 from struct import unpack
-from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QMainWindow
-from common.bmsinfo import BmsInfo
+from PyQt5.QtGui import QIcon, QKeySequence
+from PyQt5.QtWidgets import QMainWindow, QShortcut, QInputDialog
+from common.bmsinfo import BmsInfo, to_text
+from common.alarms import AlarmEngine, bms_rules, vehicle_rules
 from common.data_handling import BmsReader
+from common.fw_sessions import session_manager
+from common.can_dispatcher import MASK_BMS
+from common.pycan import can_filter
+from common.tracing import install_trace_signal
+from common.poller import PipelinedPoller, PollSchedule, ScheduledPoll
+from common.ui_updates import UpdateCoalescer
+from common.ui_binding import BindingSet
+from common.csv_writer import CsvWriter
+from common.ring_history import RingHistory
+from common.plot_widget import plot_window
 from common.helper import resize_bytes, logging_basic_config, utc_time_seconds, str2bool
 from ccu_data import CCUData
 from iot_data import IoTData
-from vehicledata import VehicleData
-from common.BatteryWindow import MyWindow as BatWindow, ui_attach_status, ui_pack_state
+from vehicledata import VehicleData, VehicleStatus
+from common.BatteryWindow import MyWindow as BatWindow, ui_attach_status, ui_pack_state, session_writers
 from common.mvar import LockableBoolean
 from coscooter_diag_tool_gui import *
 import sys
 import threading
 from PyQt5.QtCore import pyqtSignal
+from can import Message
 from common.settings import settings as settings_data
 from pathlib import Path
 from argparse import ArgumentParser
@@ -22,7 +34,7 @@ from multiprocessing import Queue, Value
 from enum import Enum, auto
 from queue import Empty
 import logging
-from copy import deepcopy
+from copy import copy
 
 from scooter_data_handling import update_ccu, IotMessageHandler
 
@@ -38,6 +50,16 @@ def setup_settings(config_file=Path("config.conf")):
     settings.add_default("CAN", "bitrate", "250000")
     settings.add_default("CAN", "channel", "0")
     settings.add_default("CSV", "data_period", "1")
+    settings.add_default("CSV", "history_db", "")
+
+    settings.add_default("HISTORY", "window", "1800")
+    settings.add_default("HISTORY", "rate", "2")
+    settings.add_default("HISTORY", "export_minutes", "10")
+    settings.add_default("HISTORY", "plot_span", "600")
+
+    settings.add_default("ALARMS", "temp_hysteresis", "1")
+    settings.add_default("ALARMS", "cell_hysteresis", "10")
+    settings.add_default("ALARMS", "debounce", "1.0")
 
     settings.add_default("APP", "log_level", "ERROR")
     settings.add_default("APP", "dark_mode", "False")
@@ -74,22 +96,102 @@ class UiCommand(Enum):
     RESET_IOT = auto()
     TURN_OFF = auto()
 
-
-def set_attach_state(label, bms):
-    label.setText(ui_attach_status(bms))
-
-
-def set_pack_state(label, bms):
-    label.setText(ui_pack_state(bms))
+    FW_UPDATE_ALL = auto()
+
+
+def ui_on_off(value):
+    if value == 0:
+        return "OFF"
+    elif value == 1:
+        return "ON"
+    return "N/A"
+
+
+def ui_iot_nrf_id(iot: IoTData):
+    if iot.iot_nrf_id is not None:
+        return f"{iot.iot_nrf_id:016x}"
+    return "N/A"
+
+
+def ui_iot_fw(iot: IoTData):
+    if iot.iot_nrf_fw_type is not None or iot.iot_nrf_fw_version is not None:
+        return f"{iot.iot_nrf_fw_type}.{iot.iot_nrf_fw_version}"
+    return "N/A"
+
+
+def ui_iot_net_status(iot: IoTData):
+    if iot.iot_net_status is None:
+        return "N/A"
+    net_text = "Connecting"
+
+    if iot.iot_net_status == 0:
+        net_text = "UNKNOWN"
+    elif iot.iot_net_status == 1:
+        net_text = "NETWORK Connected"
+    elif iot.iot_net_status == 2:
+        net_text = "PDP ACTIVATED"
+    elif iot.iot_net_status == 3:
+        net_text = "TCP Connected"
+    elif iot.iot_net_status == 4:
+        net_text = "MQTT Connected"
+    elif iot.iot_net_status == 5:
+        net_text = "MQTT Subscribed"
+
+    return f"{iot.iot_net_status} ({net_text})"
+
+
+def ui_iot_net_signal(iot: IoTData):
+    if iot.iot_net_signal_strength is None:
+        return "N/A"
+    net_type_text = "3G"
+    if iot.iot_net_type == 1 or iot.iot_net_type == 2:
+        net_type_text = "2G"
+    elif iot.iot_net_type == 0:
+        net_type_text = "No tower"
+    return f"{iot.iot_net_signal_strength} ({net_type_text})"
+
+
+def ui_iot_bat_charger(charger):
+    if charger is None:
+        return "N/A"
+    charger_text = ""
+    if charger == 0:
+        charger_text = "Ready"
+    elif charger == 1:
+        charger_text = "Charging"
+    elif charger == 2:
+        charger_text = "Done"
+    elif charger == 3:
+        charger_text = "Fault"
+    return f"{charger} ({charger_text})"
+
+
+def ui_iot_gps_fix(fix_state):
+    if fix_state is None:
+        return "N/A"
+    gps_fix_text = ""
+    if fix_state == 0:
+        gps_fix_text = "No fix"
+    elif fix_state == 1:
+        gps_fix_text = "no fix"
+    elif fix_state == 2:
+        gps_fix_text = "2D fix"
+    elif fix_state == 3:
+        gps_fix_text = "3D fix"
+    elif fix_state == 4:
+        gps_fix_text = "BLE Beacon fix"
+    return f"{fix_state} ({gps_fix_text})"
+
+
+def with_unit(unit):
+    return lambda value: "N/A" if value is None else f"{value}{unit}"
+
+
+def set_num_or_na(label):
+    return lambda value: label.setText("N/A") if value is None else label.setNum(value)
 
 
 class MyWindow(QMainWindow):
-    update_left_signal = pyqtSignal([BmsInfo])
-    update_right_signal = pyqtSignal([BmsInfo])
-    update_ccu_signal = pyqtSignal([CCUData])
-    update_iot_signal = pyqtSignal([IoTData])
-    display_vehicle_signal = pyqtSignal([VehicleData])
-
     update_fw_msg_signal = pyqtSignal([str, int])
 
     def __init__(self, settings, config_file_name):
@@ -103,11 +205,13 @@ class MyWindow(QMainWindow):
         self.timesync_enabled = self.settings.get("BMS", "timesync", True, str2bool)
         self.show_untested_features = self.settings.get("APP", "show_untested_features", function=str2bool)
 
-        self.update_left_signal.connect(self.on_update_left)  # noqa
-        self.update_right_signal.connect(self.on_update_right)  # noqa
-        self.update_ccu_signal.connect(self.on_update_ccu)  # noqa
-        self.update_iot_signal.connect(self.on_update_iot)  # noqa
-        self.display_vehicle_signal.connect(self.display_vehicle_data)  # noqa
+        # device data is handed to the GUI thread at ui_fps, only the latest update per device
+        self.ui_updates = UpdateCoalescer(self.settings.get("APP", "ui_fps", 20, int))
+        self.ui_updates.add_handler("bms_left", self.on_update_left)
+        self.ui_updates.add_handler("bms_right", self.on_update_right)
+        self.ui_updates.add_handler("ccu", self.on_update_ccu)
+        self.ui_updates.add_handler("iot", self.on_update_iot)
+        self.ui_updates.add_handler("vehicle", self.display_vehicle_data)
 
         self.from_ui_queue = Queue()
         self.bms_read_regs = []
@@ -162,15 +266,56 @@ class MyWindow(QMainWindow):
         self.ui.comboBoxErrorList.addItem("Overvoltage error", 5)
         self.ui.comboBoxErrorList.addItem("Overcurrent error", 6)
         self.data_process_state = True
+
+        # widgets repainted only when the data they show changes
+        self.left_bindings = self.bind_battery("left")
+        self.right_bindings = self.bind_battery("right")
+        self.ccu_bindings = self.bind_ccu()
+        self.iot_bindings = self.bind_iot()
         self.ui.textBrowserLogWindow.setText("Welcome Hero!")
+        # error log entries, evaluated when the battery and vehicle fields change
+        self.left_alarms = AlarmEngine(bms_rules(self.settings), "[Left battery]")
+        self.right_alarms = AlarmEngine(bms_rules(self.settings), "[Right battery]")
+        self.vehicle_alarms = AlarmEngine(vehicle_rules())
+        for alarms in (self.left_alarms, self.right_alarms, self.vehicle_alarms):
+            alarms.subscribe(self.log_alarm)
 
-        self.bms_register_poll_counter = 0
 
         self.setWindowIcon(QIcon('icon.png'))
 
         self.bms_reader = BmsReader(self.settings)
+        # binary trace of all CAN frames, for debugging at full frame rate
+        self.trace_shortcut = QShortcut(QKeySequence("Ctrl+Shift+T"), self)
+        self.trace_shortcut.activated.connect(self.bms_reader.can_bus.trace.toggle)  # noqa
+        # the last minutes of both batteries, exported with Ctrl+Shift+E
+        history_window = self.settings.get("HISTORY", "window", 1800, float)
+        history_rate = self.settings.get("HISTORY", "rate", 2, float)
+        self.left_history = RingHistory(history_window, history_rate)
+        self.right_history = RingHistory(history_window, history_rate)
+        self.history_export_minutes = self.settings.get("HISTORY", "export_minutes", 10, float)
+        self.export_shortcut = QShortcut(QKeySequence("Ctrl+Shift+E"), self)
+        self.export_shortcut.activated.connect(self.export_history)  # noqa
+        # trend plots of both batteries
+        plot_span = self.settings.get("HISTORY", "plot_span", 600, float)
+        self.left_plot = plot_window(self.left_history, "Left battery trends", plot_span)
+        self.right_plot = plot_window(self.right_history, "Right battery trends", plot_span)
+        self.plot_shortcut = QShortcut(QKeySequence("Ctrl+Shift+P"), self)
+        self.plot_shortcut.activated.connect(self.show_plots)  # noqa
+        # firmware update of all batteries on the bus at once, Ctrl+Shift+U
+        self.fw_sessions = session_manager(self.bms_reader)
+        self.update_fw_msg_signal.connect(self.on_update_fw_msg)  # noqa
+        self.fw_update_shortcut = QShortcut(QKeySequence("Ctrl+Shift+U"), self)
+        self.fw_update_shortcut.activated.connect(self.ui_update_all_fw)  # noqa
+        self.poller = PipelinedPoller(self.bms_reader.can_bus,
+                                      self.settings.get("CAN", "poll_window", 4, int),
+                                      self.settings.get("CAN", "poll_timeout", 50, int),
+                                      max_timeout_ms=self.settings.get("CAN", "poll_timeout_max", 500, int))
+        self.poll_schedule = PollSchedule()
+        self.poll_schedule.set_group("ccu", [ScheduledPoll("ccu", 0x40f, None),
+                                             ScheduledPoll("ccu", 0x401, 1.0)])
         self.vehicle_data = VehicleData()
-        self.iot_msg_handler = IotMessageHandler()
+        self.iot_msg_handler = IotMessageHandler(self.settings.get("IOT", "timeout", 2000, int),
+                                                 self.settings.get("IOT", "cycle_period", 1.0, float))
         # ---------------------------------------------------------
         self.left_bat_window = BatWindow(self.settings, False)
         self.right_bat_window = BatWindow(self.settings, False)
@@ -181,6 +326,15 @@ class MyWindow(QMainWindow):
         self.iot_info = IoTData()
         self.testRunning = LockableBoolean()
         self.testRunning.set()
+        # optional session log and SQLite history of both batteries with the vehicle they were in,
+        # the battery windows are embedded and leave them to this one writer
+        self.history = None
+        session_log, history = session_writers(self.settings)
+        if session_log is not None or history is not None:
+            self.history = CsvWriter(session_log=session_log, history=history)
+        self.history_period = self.settings.get("CSV", "data_period", 1, float)
+        self.next_history_time = 0
+        self.ui_updates.start(self)
         self.windowThread = threading.Thread(target=self.windowThreadRun)
         self.windowThread.start()
 
@@ -188,7 +342,7 @@ class MyWindow(QMainWindow):
         self.ui_bms_info_right = self.bms_info_right
         self.ui_ccu_info = self.ccu_info
         self.ui_iot_info = self.iot_info
-        self.ui_vehicle_data = self.vehicle_data
+        self.ui_vehicle_data = self.vehicle_data.snapshot()
 
 
     def item_visibility(item, show):
@@ -225,20 +379,49 @@ class MyWindow(QMainWindow):
     def on_append_log(self, msg):
         self.ui.textBrowserLogWindow.append(msg)
 
+    def update_fw_msg(self, bms_id, text, percent):
+        self.update_fw_msg_signal.emit(f"[{bms_id:08X}] {text}", percent)  # noqa
+
+    def on_update_fw_msg(self, msg, percent):
+        # the block progress is not logged, only the start, retries and the result
+        if percent <= 0 or percent == 100 or "Retrying" in msg:
+            self.on_append_log(f"Firmware update {msg}")
+
+    def ui_update_all_fw(self):
+        fw_version, ok = QInputDialog.getInt(self, "Firmware update", "Firmware version for all batteries:", 0, 0)
+        if ok and fw_version:
+            self.to_worker((UiCommand.FW_UPDATE_ALL, fw_version))
+
+    def detected_batteries(self):
+        """
+        (bms_id, attach_status, fw_type) of the batteries answering on the bus, the unattached ones
+        are only known by their id and keep fw_type 0
+        """
+        batteries = []
+        for bms, last_data in ((self.bms_info_left, self.vehicle_data.last_data_bms_left),
+                               (self.bms_info_right, self.vehicle_data.last_data_bms_right)):
+            if bms.bms_id_int and bms.attach_status is not None and not last_data.is_timeout():
+                batteries.append((bms.bms_id_int, bms.attach_status, bms.fw_type))
+        if not self.vehicle_data.last_data_other.is_timeout():
+            for bms_id in (self.vehicle_data.unattached_battery_one_id, self.vehicle_data.unattached_battery_two_id):
+                if bms_id:
+                    batteries.append((bms_id, 0xFF, 0))
+        return batteries
+
     def update_bms_left(self, bms):
-        self.update_left_signal.emit(deepcopy(bms))  # noqa
+        self.ui_updates.submit("bms_left", bms.snapshot())
 
     def update_bms_right(self, bms):
-        self.update_right_signal.emit(deepcopy(bms))  # noqa
+        self.ui_updates.submit("bms_right", bms.snapshot())
 
     def update_ccu(self, ccu):
-        self.update_ccu_signal.emit(deepcopy(ccu))  # noqa
+        self.ui_updates.submit("ccu", copy(ccu))
 
     def update_iot(self, iot):
-        self.update_iot_signal.emit(deepcopy(iot))  # noqa
+        self.ui_updates.submit("iot", copy(iot))
 
-    def update_vehicle_data(self, data):
-        self.display_vehicle_signal.emit(deepcopy(data))  # noqa
+    def update_vehicle_data(self, data: VehicleData):
+        self.ui_updates.submit("vehicle", data.snapshot())
 
     def open_left_bat(self):
 
@@ -330,139 +513,22 @@ class MyWindow(QMainWindow):
         print("iot_command_turn_off")
         self.to_worker((UiCommand.TURN_OFF, ""))
 
-    def append_bat_error(self, bat_msg, msg):
-        self.on_append_log(f"{bat_msg} {msg}!")
-
-    def analyze_bat_errors(self, bms, bat_msg):
-        error_flags_left = self.bms_info_left.error_flags
-        if error_flags_left != "":
-            if error_flags_left & 0x01:
-                self.append_bat_error(bat_msg, "Initial config error")
-
-            if error_flags_left & 0x02:
-                self.append_bat_error(bat_msg, "Requested off error")
-
-            if error_flags_left & 0x04:
-                self.append_bat_error(bat_msg, "Primary error present")
-
-            if error_flags_left & 0x08:
-                self.append_bat_error(bat_msg, "Precharge error")
-
-            if error_flags_left & 0x10:
-                self.append_bat_error(bat_msg, "Undervoltage error")
-
-            if error_flags_left & 0x20:
-                self.append_bat_error(bat_msg, "Overvoltage error")
-
-            if error_flags_left & 0x40:
-                self.append_bat_error(bat_msg, "Overcurrent error")
-
-            if error_flags_left & 0x80:
-                self.append_bat_error(bat_msg, "Overtemperature error")
-
-            if error_flags_left == 0:
-                self.append_bat_error(bat_msg, "No error flags")
-                
-        error_flags_right = self.bms_info_right.error_flags
-        if error_flags_right != "":
-            if error_flags_right & 0x01:
-                self.append_bat_error(bat_msg, "Initial config error")
-
-            if error_flags_right & 0x02:
-                self.append_bat_error(bat_msg, "Requested off error")
-
-            if error_flags_right & 0x04:
-                self.append_bat_error(bat_msg, "Primary error present")
-
-            if error_flags_right & 0x08:
-                self.append_bat_error(bat_msg, "Precharge error")
-
-            if error_flags_right & 0x10:
-                self.append_bat_error(bat_msg, "Undervoltage error")
-
-            if error_flags_right & 0x20:
-                self.append_bat_error(bat_msg, "Overvoltage error")
-
-            if error_flags_right & 0x40:
-                self.append_bat_error(bat_msg, "Overcurrent error")
-
-            if error_flags_right & 0x80:
-                self.append_bat_error(bat_msg, "Overtemperature error")
-
-            if error_flags_right == 0:
-                self.append_bat_error(bat_msg, "No error flags")
-
-        bq_sys_stat_left = self.bms_info_left.bq_sys_stat
-
-        if bq_sys_stat_left != "":
-            bq_sys_stat_left &= 0x3F
-            if bq_sys_stat_left & 0x01:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Overcurrent detected")
-
-            if bq_sys_stat_left & 0x02:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Short circuit detected")
-
-            if bq_sys_stat_left & 0x04:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Cell overvoltage detected")
-
-            if bq_sys_stat_left & 0x08:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Cell undervoltage detected")
-
-            if bq_sys_stat_left & 0x10:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Alert pin external override detected")
-
-            if bq_sys_stat_left & 0x20:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Internal chip fault detected")
-
-            if bq_sys_stat_left == 0:
-                self.append_bat_error(f"{bat_msg}[Primary]", "No Errors")
-                
-        bq_sys_stat_right = self.bms_info_right.bq_sys_stat
-
-        if bq_sys_stat_right != "":
-            bq_sys_stat_right &= 0x3F
-            if bq_sys_stat_right & 0x01:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Overcurrent detected")
-
-            if bq_sys_stat_right & 0x02:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Short circuit detected")
-
-            if bq_sys_stat_right & 0x04:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Cell overvoltage detected")
-
-            if bq_sys_stat_right & 0x08:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Cell undervoltage detected")
-
-            if bq_sys_stat_right & 0x10:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Alert pin external override detected")
-
-            if bq_sys_stat_right & 0x20:
-                self.append_bat_error(f"{bat_msg}[Primary]", "Internal chip fault detected")
-
-            if bq_sys_stat_right == 0:
-                self.append_bat_error(f"{bat_msg}[Primary]", "No Errors")
-
-    def update_error_log(self):
-        self.on_clear_log()
-
-        self.analyze_bat_errors(self.ui_bms_info_left, "[Left battery]")
-        self.analyze_bat_errors(self.ui_bms_info_right, "[Right battery]")
-
-        if self.ui_vehicle_data.unattached_battery_one_id != 0:
-            self.on_append_log(f"Unattached battery detected! ID: {self.ui_vehicle_data.unattached_battery_one_id:08X}")
-
-        if self.ui_vehicle_data.unattached_battery_two_id != 0:
-            self.on_append_log(f"Unattached battery detected! ID: {self.ui_vehicle_data.unattached_battery_two_id:08X}")
+    def log_alarm(self, event):
+        """
+        The error log shows the alarm events as they come, nothing is rebuilt
+        """
+        prefix = f"{event.source} " if event.source else ""
+        self.on_append_log(f"{prefix}{event.text()}")
 
     def reset_read_regs(self):
         # read pack info and pcb/fw types
         self.bms_read_regs = [0xff, 0xfc]
 
-    def display_vehicle_data(self, vehicle_data: VehicleData):
+    def display_vehicle_data(self, vehicle_data: VehicleStatus, changed):
 
         self.ui_vehicle_data = vehicle_data
         can_status = "N/A"
-        if not vehicle_data.last_data_bms_left.is_timeout() or not vehicle_data.last_data_bms_right.is_timeout() or not vehicle_data.last_data_ccu.is_timeout():
+        if vehicle_data.can_active:
             if vehicle_data.receive_only:
                 can_status = "Active, Receive only"
             else:
@@ -474,12 +540,62 @@ class MyWindow(QMainWindow):
                 can_status = "Inactive"
 
         self.ui.label_can_status.setText(can_status)
-        self.update_error_log()
+        self.vehicle_alarms.update(vehicle_data, changed)
 
     def to_worker(self, command):
         self.from_ui_queue.put(command)
 
-    def on_update_left(self, bms: BmsInfo):
+    def bind_battery(self, side) -> BindingSet:
+        """
+        Battery summary widgets of the left or right battery
+        """
+        ui = self.ui
+        bindings = BindingSet()
+        bindings.bind(["bms_id"], BmsInfo.ui_bms_id, getattr(ui, f"label_battery_id_{side}").setText)
+        bindings.bind(["pack_state"], ui_pack_state, getattr(ui, f"label_battery_state_{side}").setText)
+        bindings.bind(["attach_status"], ui_attach_status, getattr(ui, f"label_attach_status_{side}").setText)
+        bindings.bind(["bms_sw_version"], BmsInfo.ui_bms_sw_version, getattr(ui, f"label_fw_version_{side}").setText)
+        bindings.bind(["error_flags"], BmsInfo.ui_error_flags, getattr(ui, f"label_bms_error_state_{side}").setNum)
+        # primary fault
+        bindings.bind(["bq_sys_stat"], lambda bms: bms.ui_error_bq_flags() & 0x7F,
+                      getattr(ui, f"label_bms_prim_faults_{side}").setNum)
+
+        for field, display in (("pack_soc", "display_soc"),
+                               ("voltage", "display_voltage"),
+                               ("current", "display_current"),
+                               ("cell_voltage_lowest", "display_min_cell_voltage"),
+                               ("cell_voltage_highest", "display_max_cell_voltage"),
+                               ("fet_temp", "display_fet_temperature"),
+                               ("precharge_result", "display_precharge_result")):
+            bindings.bind_field(field, getattr(ui, f"{display}_{side}").display, to_text)
+        return bindings
+
+    def bind_ccu(self) -> BindingSet:
+        ui = self.ui
+        bindings = BindingSet()
+        bindings.bind_field("ccu_fw_version", ui.label_ccu_fw_version.setText, with_unit(""))
+        bindings.bind_field("ccu_comms_config_state", set_num_or_na(ui.label_ccu_comms_config))
+        bindings.bind_field("ccu_asi_status", ui.label_asi_status.setText, ui_on_off)
+        bindings.bind_field("ccu_lights_status", ui.label_ccu_lights_status.setText, ui_on_off)
+        return bindings
+
+    def bind_iot(self) -> BindingSet:
+        ui = self.ui
+        bindings = BindingSet()
+        bindings.bind(["iot_nrf_id"], ui_iot_nrf_id, ui.label_iot_nrfid.setText)
+        bindings.bind(["iot_nrf_fw_type", "iot_nrf_fw_version"], ui_iot_fw, ui.label_iot_fw_version.setText)
+        bindings.bind(["iot_net_status"], ui_iot_net_status, ui.label_iot_net_status.setText)
+        bindings.bind(["iot_net_signal_strength", "iot_net_type"], ui_iot_net_signal, ui.label_iot_net_signal_strength.setText)
+        bindings.bind_field("iot_bat_voltage", ui.label_iot_bat_voltage.setText, with_unit(" V"))
+        bindings.bind_field("iot_bat_temperature", ui.label_iot_bat_temp.setText, with_unit(" °C"))
+        bindings.bind_field("iot_bat_charger", ui.label_iot_bat_charger.setText, ui_iot_bat_charger)
+        bindings.bind_field("iot_module_vin", ui.label_iot_module_vin.setText, with_unit(" V"))
+        bindings.bind_field("iot_gps_fix_state", ui.label_iot_gps_fix_state.setText, ui_iot_gps_fix)
+        bindings.bind_field("iot_gps_used_sats", ui.label_iot_gps_used_sats.setText, with_unit(""))
+        bindings.bind_field("iot_gps_max_cno", ui.label_iot_gps_max_cno.setText, with_unit(""))
+        return bindings
+
+    def on_update_left(self, bms: BmsInfo, changed):
         self.ui_bms_info_left = bms
 
         # UI update left bat
@@ -487,331 +603,97 @@ class MyWindow(QMainWindow):
             if self.left_bat_window.window_open:
                 self.left_bat_window.display_bms_data(bms)
 
-        # Battery ID
-        self.ui.label_battery_id_left.setText(bms.ui_bms_id())
-
-        # Battery state
-        set_pack_state(self.ui.label_battery_state_left, bms)
-
-        # Attach Status
-        set_attach_state(self.ui.label_attach_status_left, bms)
-
-        self.ui.label_fw_version_left.setText(bms.ui_bms_sw_version())
-
-        # Error state
-        self.ui.label_bms_error_state_left.setNum(bms.ui_error_flags())
-
-        # Primary fault
-        self.ui.label_bms_prim_faults_left.setNum(bms.ui_error_bq_flags() & 0x7F)
+        self.left_bindings.update(bms, changed)
+        self.left_alarms.update(bms, changed)
 
-        # State of charge
-        self.ui.display_soc_left.display(bms.pack_soc)
-
-        # Pack voltage
-        self.ui.display_voltage_left.display(bms.voltage)
-        # Pack current
-        self.ui.display_current_left.display(bms.current)
-        # MIN cell voltage
-        self.ui.display_min_cell_voltage_left.display(bms.cell_voltage_lowest)
-        # MAX cell voltage
-        self.ui.display_max_cell_voltage_left.display(bms.cell_voltage_highest)
-        # FET temp
-        self.ui.display_fet_temperature_left.display(bms.fet_temp)
-        # Precharge result
-        self.ui.display_precharge_result_left.display(bms.precharge_result)
-
-        # self.update_error_log()
-
-    def on_update_right(self, bms: BmsInfo):
+    def on_update_right(self, bms: BmsInfo, changed):
         self.ui_bms_info_right = bms
         # UI update right bat
         if self.right_bat_window is not None:
             if self.right_bat_window.window_open:
                 self.right_bat_window.display_bms_data(bms)
-        # Battery ID
-        self.ui.label_battery_id_right.setText(bms.ui_bms_id())
-
-        # Battery state
-        set_pack_state(self.ui.label_battery_state_right, bms)
-
-        # Attach Status
-        set_attach_state(self.ui.label_attach_status_right, bms)
-
-        # FW Version
-        self.ui.label_fw_version_right.setText(bms.ui_bms_sw_version())
 
-        # Error state
-        self.ui.label_bms_error_state_right.setNum(bms.ui_error_flags())
+        self.right_bindings.update(bms, changed)
+        self.right_alarms.update(bms, changed)
 
-        # Primary fault
-        self.ui.label_bms_prim_faults_right.setNum(bms.ui_error_bq_flags() & 0x7F)
-
-        # State of charge
-        self.ui.display_soc_right.display(bms.pack_soc)
-
-        # Pack voltage
-        self.ui.display_voltage_right.display(bms.voltage)
-        # Pack current
-        self.ui.display_current_right.display(bms.current)
-        # MIN cell voltage
-        self.ui.display_min_cell_voltage_right.display(bms.cell_voltage_lowest)
-        # MAX cell voltage
-        self.ui.display_max_cell_voltage_right.display(bms.cell_voltage_highest)
-        # FET temp
-        self.ui.display_fet_temperature_right.display(bms.fet_temp)
-        # Precharge result
-        self.ui.display_precharge_result_right.display(bms.precharge_result)
-
-        # self.update_error_log()
-
-    def on_update_ccu(self, ccu: CCUData):
+    def on_update_ccu(self, ccu: CCUData, changed):
         self.ui_ccu_info = ccu
-        # UI Update
-        # FW Version
-        if ccu.ccu_fw_version is not None:
-            self.ui.label_ccu_fw_version.setText(str(ccu.ccu_fw_version))
-        else:
-            self.ui.label_ccu_fw_version.setText("N/A")
+        self.ccu_bindings.update(ccu, changed)
 
-        # Comms Config
-        if ccu.ccu_comms_config_state is not None:
-            self.ui.label_ccu_comms_config.setNum(ccu.ccu_comms_config_state)
-        else:
-            self.ui.label_ccu_comms_config.setText("N/A")
-
-        # ASI Status
-        if ccu.ccu_asi_status == 0:
-            self.ui.label_asi_status.setText("OFF")
-        elif ccu.ccu_asi_status == 1:
-            self.ui.label_asi_status.setText("ON")
-        else:
-            self.ui.label_asi_status.setText("N/A")
-
-        # Lights Status
-
-        if ccu.ccu_lights_status == 0:
-            self.ui.label_ccu_lights_status.setText("OFF")
-        elif ccu.ccu_lights_status == 1:
-            self.ui.label_ccu_lights_status.setText("ON")
-        else:
-            self.ui.label_ccu_lights_status.setText("N/A")
-
-        # self.update_error_log()
-
-    def on_update_iot(self, iot: IoTData):
+    def on_update_iot(self, iot: IoTData, changed):
         self.ui_iot_info = iot
-        # UI Update
-        # IoT ID
-        nrf_id = "N/A"
-        if iot.iot_nrf_id is not None:
-            nrf_id = f"{iot.iot_nrf_id:016x}"
-        self.ui.label_iot_nrfid.setText(nrf_id)
-
-        # FW Version
-        iot_fw = "N/A"
-        if iot.iot_nrf_fw_type is not None or iot.iot_nrf_fw_version is not None:
-            iot_fw = f"{iot.iot_nrf_fw_type}.{iot.iot_nrf_fw_version}"
-        self.ui.label_iot_fw_version.setText(iot_fw)
-
-        # Network Status
-        net_signal = "N/A"
-        if iot.iot_net_status is not None:
-            net_text = "Connecting"
-
-            if iot.iot_net_status == 0:
-                net_text = "UNKNOWN"
-            elif iot.iot_net_status == 1:
-                net_text = "NETWORK Connected"
-            elif iot.iot_net_status == 2:
-                net_text = "PDP ACTIVATED"
-            elif iot.iot_net_status == 3:
-                net_text = "TCP Connected"
-            elif iot.iot_net_status == 4:
-                net_text = "MQTT Connected"
-            elif iot.iot_net_status == 5:
-                net_text = "MQTT Subscribed"
-
-            net_signal = f"{iot.iot_net_status} ({net_text})"
-        self.ui.label_iot_net_status.setText(net_signal)
-
-        # Signal Strength
-        net_signal = "N/A"
-        if iot.iot_net_signal_strength is not None:
-            net_type_text = "3G"
-            if iot.iot_net_type == 1 or iot.iot_net_type == 2:
-                net_type_text = "2G"
-            elif iot.iot_net_type == 0:
-                net_type_text = "No tower"
-            net_signal = f"{iot.iot_net_signal_strength} ({net_type_text})"
-        self.ui.label_iot_net_signal_strength.setText(net_signal)
-
-        # Battery Voltage
-
-        bat_voltage = "N/A"
-        if iot.iot_bat_voltage is not None:
-            bat_voltage = f"{iot.iot_bat_voltage} V"
-        self.ui.label_iot_bat_voltage.setText(bat_voltage)
-
-        # Battery Temp
-        bat_temp = "N/A"
-        if iot.iot_bat_temperature is not None:
-            bat_temp = f"{iot.iot_bat_temperature} °C"
-        self.ui.label_iot_bat_temp.setText(bat_temp)
-
-        # Battery Charger
-        charger_text = "N/A"
-        if iot.iot_bat_charger is not None:
-            charger_text = ""
-            if iot.iot_bat_charger == 0:
-                charger_text = "Ready"
-            elif iot.iot_bat_charger == 1:
-                charger_text = "Charging"
-            elif iot.iot_bat_charger == 2:
-                charger_text = "Done"
-            elif iot.iot_bat_charger == 3:
-                charger_text = "Fault"
-            charger_text = f"{iot.iot_bat_charger} ({charger_text})"
-
-        self.ui.label_iot_bat_charger.setText(charger_text)
-
-        # Module Vin
-        module_vin = "N/A"
-        if iot.iot_module_vin is not None:
-            module_vin = f"{iot.iot_module_vin} V"
-        self.ui.label_iot_module_vin.setText(module_vin)
-
-        # GNSS fix
-        gps_fix_text = "N/A"
-        if iot.iot_gps_fix_state is not None:
-            gps_fix_text = ""
-            if iot.iot_gps_fix_state == 0:
-                gps_fix_text = "No fix"
-            elif iot.iot_gps_fix_state == 1:
-                gps_fix_text = "no fix"
-            elif iot.iot_gps_fix_state == 2:
-                gps_fix_text = "2D fix"
-            elif iot.iot_gps_fix_state == 3:
-                gps_fix_text = "3D fix"
-            elif iot.iot_gps_fix_state == 4:
-                gps_fix_text = "BLE Beacon fix"
-            gps_fix_text = f"{iot.iot_gps_fix_state} ({gps_fix_text})"
-
-        self.ui.label_iot_gps_fix_state.setText(gps_fix_text)
-
-        # GNSS used sats
-        gps_sats = "N/A"
-        if iot.iot_gps_used_sats is not None:
-            gps_sats = f"{iot.iot_gps_used_sats}"
-        self.ui.label_iot_gps_used_sats.setText(gps_sats)
-
-        # GNSS max cno
-        gps_max_cno = "N/A"
-        if iot.iot_gps_max_cno is not None:
-            gps_max_cno = f"{iot.iot_gps_max_cno}"
-        self.ui.label_iot_gps_max_cno.setText(gps_max_cno)
-
-        self.update_error_log()
-
-    def send_receive_frames(self, id_to_ask, timeout_ms):
-
-        if id_to_ask and not self.vehicle_data.receive_only:
-            msg = []
-            if id_to_ask == 0xd101:
-                msg = self.iot_msg_handler.get_next_message(self.iot_info.iot_nrf_id)
-
-            try:
-                # print(f"[CAN SEND] id: {id_to_ask:04x} bms {hexlify(bytes(msg))}")
-                self.bms_reader.can_bus.send_data(id_to_ask, msg)
-            except Exception as e:
-                print(f"Could not TX to ask for data! {e}")
-        wait_end = utc_time_seconds()+timeout_ms/1000
-        # print(f"wait_end {wait_end}| now {utc_time_seconds()}")
-
-        while utc_time_seconds() < wait_end:
-            try:
-                timeout = (wait_end-utc_time_seconds())*1000
-                bms_message = self.bms_reader.can_bus.read_data(timeout)
-                if bms_message is not None and len(bms_message.data) and not bms_message.is_error_frame:
-
-                    msg_id = bms_message.arbitration_id
-                    # print(f"[CAN RECV] id: {msg_id:04x} bms {hexlify(bms_message.data)}")
-                    data = resize_bytes(bms_message.data, 8)
-
-                    if msg_id == 0x40f or msg_id == 0x401:
-                        self.vehicle_data.last_data_ccu.update()
-                        update_ccu(msg_id, bms_message.data, self.ccu_info)
-                        self.update_ccu(self.ccu_info)
-
-                    elif msg_id == 0xc0:
-                        self.vehicle_data.last_data_other.update()
-
-                        _, bat_id = unpack(">II", data)
-
-                        if self.vehicle_data.unattached_battery_one_id == 0:
-                            self.vehicle_data.unattached_battery_one_id = bat_id
-                        else:
-                            if self.vehicle_data.unattached_battery_one_id != bat_id:
-                                self.vehicle_data.unattached_battery_two_id = bat_id
-
-                    elif msg_id == 0xda01:
-                        self.vehicle_data.last_data_iot.update()
-                        self.iot_msg_handler.update_iot(msg_id, bms_message.dlc, bms_message.data, self.iot_info)
-                        self.update_iot(self.iot_info)
-                        # print(f"[CAN RECV] id: {msg_id:04x} bms {hexlify(bms_message.data)}")
-                        break
-
-                    elif msg_id & 0x100:
-                        self.bms_reader.update_reg(msg_id, bms_message.data, 0, self.bms_info_right)
-                        self.vehicle_data.last_data_bms_right.update()
-                        self.update_bms_right(self.bms_info_right)
-
-                    elif msg_id & 0x200:
-                        self.bms_reader.update_reg(msg_id, bms_message.data, 0, self.bms_info_left)
-                        self.vehicle_data.last_data_bms_left.update()
-                        self.update_bms_left(self.bms_info_left)
-
-                    if id_to_ask and not self.vehicle_data.receive_only:
-                        if msg_id == id_to_ask:
-                            break
-                    # else:
-                    #     print(f"No RX ID match from CAN {msg_id:04x}")
-            except Exception as e:
-
-                print(f"Nothing received from CAN ({e})")
-                time.sleep(1)
-
-
+        self.iot_bindings.update(iot, changed)
+
+    def subscribe_frames(self):
+        can_bus = self.bms_reader.can_bus
+        can_bus.set_filter_group("vehicle", [can_filter(0x40f), can_filter(0x401), can_filter(0xc0), can_filter(0xda01)])
+        can_bus.subscribe(self.on_ccu_frame, 0x40f)
+        can_bus.subscribe(self.on_ccu_frame, 0x401)
+        can_bus.subscribe(self.on_unattached_bms_frame, 0xc0)
+        can_bus.subscribe(self.on_iot_frame, 0xda01)
+        can_bus.subscribe(self.on_bms_right_frame, 0x100, MASK_BMS)
+        can_bus.subscribe(self.on_bms_left_frame, 0x200, MASK_BMS)
+
+    # frame handlers, called from the CAN receive thread
+    def on_ccu_frame(self, msg: Message):
+        self.vehicle_data.last_data_ccu.update()
+        update_ccu(msg.arbitration_id, msg.data, self.ccu_info)
+        self.update_ccu(self.ccu_info)
+        self.poller.reply_received(msg.arbitration_id)
+
+    def on_unattached_bms_frame(self, msg: Message):
+        self.vehicle_data.last_data_other.update()
+
+        _, bat_id = unpack(">II", resize_bytes(msg.data, 8))
+
+        if self.vehicle_data.unattached_battery_one_id == 0:
+            self.vehicle_data.unattached_battery_one_id = bat_id
+        else:
+            if self.vehicle_data.unattached_battery_one_id != bat_id:
+                self.vehicle_data.unattached_battery_two_id = bat_id
+
+    def on_iot_frame(self, msg: Message):
+        self.vehicle_data.last_data_iot.update()
+        self.iot_msg_handler.on_frame(msg, self.iot_info)
+        self.update_iot(self.iot_info)
+
+    def on_bms_right_frame(self, msg: Message):
+        self.bms_reader.update_reg(msg.arbitration_id, msg.data, 0, self.bms_info_right)
+        self.vehicle_data.last_data_bms_right.update()
+        self.update_bms_right(self.bms_info_right)
+        self.poller.reply_received(msg.arbitration_id)
+
+    def on_bms_left_frame(self, msg: Message):
+        self.bms_reader.update_reg(msg.arbitration_id, msg.data, 0, self.bms_info_left)
+        self.vehicle_data.last_data_bms_left.update()
+        self.update_bms_left(self.bms_info_left)
+        self.poller.reply_received(msg.arbitration_id)
 
     def poll_vehicle_data(self):
-        id_to_ask_for_data = 0
-        timeout_ms = 50
-
         if not self.vehicle_data.receive_only:
-            read_regs = []
             self.left_bat_window.set_read_regs(self.bms_info_left)
-            for reg in self.left_bat_window.bms_read_regs:
-                read_regs.append(0x200 | reg)
-
             self.right_bat_window.set_read_regs(self.bms_info_right)
-            for reg in self.right_bat_window.bms_read_regs:
-                read_regs.append(0x100 | reg)
-
-            read_regs.extend([0x40f, 0x401, 0xd101])
-            # print(read_regs)
-            # read_regs = [0x1ff, 0x2ff, 0x1c2, 0x2c2, 0x40f, 0x401, 0xd101]
-            if self.bms_register_poll_counter >= len(read_regs):
-                self.bms_register_poll_counter = 0
-
-            id_to_ask_for_data = read_regs[self.bms_register_poll_counter]
-
-            if id_to_ask_for_data == 0xd101:
-                timeout_ms = 2000
-
-            self.bms_register_poll_counter += 1
+            self.poll_schedule.set_group("bms_left", self.left_bat_window.scheduled_polls("bms_left", 0x200))
+            self.poll_schedule.set_group("bms_right", self.right_bat_window.scheduled_polls("bms_right", 0x100))
+
+            can_bus = self.bms_reader.can_bus
+            can_bus.set_filter_group("bms_left", self.left_bat_window.read_reg_filters(0x200))
+            can_bus.set_filter_group("bms_right", self.right_bat_window.read_reg_filters(0x100))
+
+            now = time.monotonic()
+            # the IoT session sends at most one request here and never waits for the reply
+            self.iot_msg_handler.step(can_bus, now)
+
+            due = self.poll_schedule.due(now, 2 * self.poller.window)
+            if due:
+                # the due registers are in flight concurrently, frames are handled in the receive thread
+                result = self.poller.poll([poll.request() for poll in due])
+                self.poll_schedule.completed(due, result, now)
+            else:
+                next_deadline = self.poll_schedule.next_deadline()
+                time.sleep(0.02 if next_deadline is None else min(max(next_deadline - now, 0), 0.02))
         else:
-            self.bms_register_poll_counter = 0
-
-        self.send_receive_frames(id_to_ask_for_data, timeout_ms)
+            time.sleep(0.05)
 
         # check for data timeout
         if self.vehicle_data.last_data_other.is_timeout():
@@ -819,15 +701,21 @@ class MyWindow(QMainWindow):
             self.vehicle_data.unattached_battery_two_id = 0
             self.update_vehicle_data(self.vehicle_data)
 
-        if self.vehicle_data.last_data_bms_left.is_timeout():
+        left_timeout = self.vehicle_data.last_data_bms_left.is_timeout()
+        self.poll_schedule.set_timed_out("bms_left", left_timeout)
+        if left_timeout:
             self.bms_info_left = BmsInfo(2)
             self.update_bms_left(self.bms_info_left)
 
-        if self.vehicle_data.last_data_bms_right.is_timeout():
+        right_timeout = self.vehicle_data.last_data_bms_right.is_timeout()
+        self.poll_schedule.set_timed_out("bms_right", right_timeout)
+        if right_timeout:
             self.bms_info_right = BmsInfo(1)
             self.update_bms_right(self.bms_info_right)
 
-        if self.vehicle_data.last_data_ccu.is_timeout():
+        ccu_timeout = self.vehicle_data.last_data_ccu.is_timeout()
+        self.poll_schedule.set_timed_out("ccu", ccu_timeout)
+        if ccu_timeout:
             self.ccu_info = CCUData()
             self.update_ccu(self.ccu_info)
 
@@ -838,10 +726,40 @@ class MyWindow(QMainWindow):
 
 
         self.update_vehicle_data(self.vehicle_data)
+        timestamp = utc_time_seconds()
+        self.left_history.append(timestamp, self.bms_info_left)
+        self.right_history.append(timestamp, self.bms_info_right)
+        self.log_history()
+
+    def show_plots(self):
+        for plot in (self.left_plot, self.right_plot):
+            plot.show()
+            plot.activateWindow()
+
+    def export_history(self):
+        for history, bat_msg in ((self.left_history, "Left battery"), (self.right_history, "Right battery")):
+            path = history.export_csv(self.history_export_minutes * 60)
+            if path is not None:
+                self.on_append_log(f"{bat_msg} history saved to {path}")
+
+    def log_history(self):
+        if self.history is None:
+            return
+        now = time.monotonic()
+        if now < self.next_history_time:
+            return
+        self.next_history_time = now + self.history_period
+
+        timestamp = utc_time_seconds()
+        self.history.vehicle(timestamp, copy(self.ccu_info), copy(self.iot_info))
+        for bms in (self.bms_info_left, self.bms_info_right):
+            if bms.bms_id_int:
+                self.history.write(timestamp, bms.snapshot())
 
     def windowThreadRun(self):
         time.sleep(1)
 
+        self.subscribe_frames()
         self.bms_reader.open_can()
         while self.testRunning.get():
 
@@ -891,12 +809,21 @@ class MyWindow(QMainWindow):
 
                 elif data_cmd == UiCommand.RESET_IOT:
                     self.iot_info = IoTData()
+                    self.iot_msg_handler.reset()
                     self.bms_reader.send_message_to_can(0xd101, [0xcc, 0x01, 0x00, 0x00, 0x00, 0x64])
 
                 elif data_cmd == UiCommand.TURN_OFF:
                     self.iot_info = IoTData()
+                    self.iot_msg_handler.reset()
                     self.bms_reader.send_message_to_can(0xd101, [0xcc, 0x02, 0x00, 0x00, 0x13, 0x88])
 
+                elif data_cmd == UiCommand.FW_UPDATE_ALL:
+                    # the sessions run in their own threads, their frames share the bus fairly
+                    batteries = self.detected_batteries()
+                    if not batteries:
+                        self.update_fw_msg(0, "Failed: no batteries detected", -2)
+                    self.fw_sessions.start_all(data[1], batteries, progress=self.update_fw_msg)
+
                 elif data_cmd == UiCommand.CAN_TALK:
                     self.vehicle_data.receive_only = not self.vehicle_data.receive_only
                     if self.vehicle_data.receive_only:
@@ -921,6 +848,9 @@ class MyWindow(QMainWindow):
 
         self.testRunning.clear()
         self.windowThread.join(timeout=5)
+        self.ui_updates.stop()
+        if self.history is not None:
+            self.history.stop()
 
         print("Thread finished")
 
@@ -930,6 +860,9 @@ class MyWindow(QMainWindow):
         if self.right_bat_window.window_open:
             self.right_bat_window.close()
 
+        self.left_plot.close()
+        self.right_plot.close()
+
         event.accept()  # let the window close
 
         # [END closeEvent]
@@ -984,6 +917,7 @@ def main():
     config = ConfigParser()
     config.read(config_file_name)
     application = MyWindow(settings, config_file_name)
+    install_trace_signal(application.bms_reader.can_bus.trace)
     
 
     if application.fullscreen_mode:
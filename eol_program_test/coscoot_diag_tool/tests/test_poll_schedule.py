@@ -0,0 +1,74 @@
+import unittest
+from collections import Counter
+
+from common.poller import PollSchedule, PollResult, ScheduledPoll
+
+# registers of a fresh BmsInfo: once per connection and periodic ones
+BMS_REGISTERS = [(0xc0, 0.2), (0xc1, 0.2), (0xc2, 0.5), (0xc3, 1.0), (0xd1, 1.0), (0xd2, 1.0), (0xd3, 1.0),
+                 (0xfc, None), (0xfd, None), (0xfe, None), (0xff, None)]
+WINDOW = 4
+
+
+def bms_polls(group, base_id):
+    return [ScheduledPoll(group, base_id | reg, period) for reg, period in BMS_REGISTERS]
+
+
+class SingleBatteryTest(unittest.TestCase):
+    """
+    The main window loop with the left battery absent: its timeout is reported on every pass
+    """
+
+    def run_passes(self, passes=500, step=0.02):
+        schedule = PollSchedule()
+        schedule.set_group("ccu", [ScheduledPoll("ccu", 0x40f, None), ScheduledPoll("ccu", 0x401, 1.0)])
+        schedule.set_group("bms_left", bms_polls("bms_left", 0x200))
+        schedule.set_group("bms_right", bms_polls("bms_right", 0x100))
+        polled = Counter()
+        now = 0.0
+        for _ in range(passes):
+            now += step
+            due = schedule.due(now, 2 * WINDOW)
+            result = PollResult()
+            for poll in due:
+                polled[poll.group] += 1
+                if poll.group == "bms_left":
+                    result.missing.add(poll.tx_id)
+                else:
+                    result.answered.add(poll.tx_id)
+            schedule.completed(due, result, now)
+            schedule.set_timed_out("bms_left", True)
+            schedule.set_timed_out("bms_right", False)
+            schedule.set_timed_out("ccu", False)
+        return polled
+
+    def test_present_devices_are_not_starved(self):
+        polled = self.run_passes()
+        # 10 s: the periodic registers of the right battery are polled at their rate
+        self.assertGreaterEqual(polled["bms_right"], 10 * (2 / 0.2 + 1 / 0.5 + 4 / 1.0))
+        self.assertGreaterEqual(polled["ccu"], 10)
+        # the absent battery is polled at its normal rate (the registers it never answered once
+        # every retry_period), not on every pass
+        self.assertLessEqual(polled["bms_left"], polled["bms_right"] + 10 * 4 + 10)
+
+    def test_reset_when_timing_out_again(self):
+        schedule = PollSchedule()
+        schedule.set_group("bms_left", bms_polls("bms_left", 0x200))
+
+        def poll_all(now):
+            # twice: the first pass only moves the initial deadlines up to now
+            for _ in range(2):
+                schedule.completed(schedule.due(now), PollResult(), now)
+
+        poll_all(1.0)
+        self.assertEqual(schedule.due(1.1), [])
+        schedule.set_timed_out("bms_left", True)
+        self.assertEqual(len(schedule.due(1.1)), len(BMS_REGISTERS))
+        poll_all(1.1)
+        schedule.set_timed_out("bms_left", True)
+        self.assertEqual(schedule.due(1.2), [])
+        schedule.set_timed_out("bms_left", False)
+        schedule.set_timed_out("bms_left", True)
+        self.assertEqual(len(schedule.due(1.2)), len(BMS_REGISTERS))
+
+if __name__ == "__main__":
+    unittest.main()